@@ -0,0 +1,13 @@
+#!/bin/sh
+# one keep-alive "hello world" request through WSGIHandler over a socketpair, without the accept and the spawn
+set -e -x
+python -mtimeit -r 6 -s'
+from gevent import socket
+from gevent.pywsgi import WSGIServer, WSGIHandler
+def application(env, start_response):
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return ["hello world"]
+server = WSGIServer(("127.0.0.1", 0), application, log=None)
+client, sock = socket.socketpair()
+handler = WSGIHandler(sock, ("127.0.0.1", 12345), server)
+request = "GET /hello?x=1 HTTP/1.1\r\nHost: localhost\r\nUser-Agent: timeit\r\nAccept: */*\r\n\r\n"' 'client.sendall(request); handler.handle_one_request(); client.recv(4096)'
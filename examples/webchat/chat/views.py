@@ -3,7 +3,10 @@ import simplejson
 from django.shortcuts import render_to_response
 from django.template.loader import render_to_string
 from django.http import HttpResponse
+import gevent
+from gevent import socket
 from gevent.event import Event
+from gevent.websocket import WebSocketError
 from webchat import settings
 
 
@@ -48,10 +51,43 @@ class ChatRoom(object):
             else:
                 request.session.pop('cursor', None)
 
+    def message_socket(self, request):
+        """Push the new messages over a WebSocket instead of long polling."""
+        ws = request.META.get('wsgi.websocket')
+        if ws is None:
+            return HttpResponse('WebSocket expected', status=400)
+        ws.accept()
+        sender = gevent.spawn(self._push_messages, ws)
+        try:
+            # the client does not send anything, but reading is how a close or a disconnect is noticed
+            while ws.receive() is not None:
+                pass
+        finally:
+            # stop waiting for the new messages
+            sender.kill()
+        return HttpResponse()
+
+    def _push_messages(self, ws):
+        cursor = self.cache[-1]['id'] if self.cache else None
+        while not ws.closed:
+            self.new_message_event.wait()
+            ids = [m['id'] for m in self.cache]
+            if cursor in ids:
+                messages = self.cache[ids.index(cursor) + 1:]
+            else:
+                messages = self.cache
+            if messages:
+                cursor = messages[-1]['id']
+                try:
+                    ws.send(simplejson.dumps({'messages': messages}))
+                except (WebSocketError, socket.error):
+                    break
+
 room = ChatRoom()
 main = room.main
 message_new = room.message_new
 message_updates = room.message_updates
+message_socket = room.message_socket
 
 
 def create_message(from_, body):
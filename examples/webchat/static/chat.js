@@ -27,7 +27,11 @@ $(document).ready(function() {
 	}
     });
     $("#message").select();
-    updater.poll();
+    if (window.WebSocket) {
+	updater.listen();
+    } else {
+	updater.poll();
+    }
 });
 
 function newMessage(form) {
@@ -96,6 +100,17 @@ var updater = {
 		error: updater.onError});
     },
 
+    listen: function() {
+	var socket = new WebSocket("ws://" + window.location.host + "/a/message/socket");
+	socket.onmessage = function(event) {
+	    updater.newMessages(eval("(" + event.data + ")"));
+	};
+	socket.onclose = function() {
+	    console.log("WebSocket closed; falling back to polling");
+	    updater.poll();
+	};
+    },
+
     onSuccess: function(response) {
 	try {
 	    updater.newMessages(eval("(" + response + ")"));
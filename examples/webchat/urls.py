@@ -4,7 +4,8 @@ from webchat import settings
 urlpatterns = patterns('webchat.chat.views',
                        ('^$', 'main'),
                        ('^a/message/new$', 'message_new'),
-                       ('^a/message/updates$', 'message_updates'))
+                       ('^a/message/updates$', 'message_updates'),
+                       ('^a/message/socket$', 'message_socket'))
 
 urlpatterns += patterns('django.views.static',
     (r'^%s(?P<path>.*)$' % settings.MEDIA_URL.lstrip('/'), 'serve',
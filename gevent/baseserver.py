@@ -1,8 +1,10 @@
 """Base class for implementing servers"""
 # Copyright (c) 2009-2012 Denis Bilenko. See LICENSE for details.
 import sys
+import time
 import _socket
 import errno
+from collections import deque
 from gevent.greenlet import Greenlet, getfuncname
 from gevent.event import Event
 from gevent.hub import string_types, integer_types, get_hub
@@ -23,7 +25,7 @@ class BaseServer(object):
 
     * a :class:`gevent.pool.Pool` instance -- *handle* will be executed
       using :meth:`Pool.spawn` method only if the pool is not full.
-      While it is full, all the connection are dropped;
+      While it is full, all the connection are dropped, unless :attr:`max_queue` is set;
     * :func:`gevent.spawn_raw` -- *handle* will be executed in a raw
       greenlet which have a little less overhead then :class:`gevent.Greenlet` instances spawned by default;
     * ``None`` -- *handle* will be executed right away, in the :class:`Hub` greenlet.
@@ -44,6 +46,24 @@ class BaseServer(object):
     # to 1 when environ["wsgi.multiprocess"] is true)
     max_accept = 100
 
+    # If true, the number of consecutive accepts per wake up adapts to the load: it doubles (up to max_accept)
+    # while the accept queue is still not empty at the end of a batch and halves (down to 1) when the
+    # event loop lags behind by more than max_accept_lag seconds.
+    adaptive_accept = False
+    max_accept_lag = 0.01
+
+    # If true, the handlers of the connections accepted on a wake up are not spawned right away
+    # but from a single loop callback, so that a burst of connections does not delay the rest of
+    # the loop iteration.
+    defer_spawn = False
+
+    # When the pool is full, the new connections are normally left in the listen backlog of the kernel.
+    # If max_queue is set, they are accepted and wait in a queue of at most max_queue connections
+    # for at most max_queue_wait seconds for a free slot. The connections that do not fit in the
+    # queue or wait for too long are passed to reject().
+    max_queue = None
+    max_queue_wait = 1
+
     _spawn = Greenlet.spawn
 
     # the default timeout that we wait for the client connections to close in stop()
@@ -56,6 +76,10 @@ class BaseServer(object):
         self._stop_event.set()
         self._watcher = None
         self._timer = None
+        self._deferred = []
+        self._deferred_callback = None
+        self._queue = deque()
+        self._queue_timer = None
         self.pool = None
         try:
             self.set_listener(listener)
@@ -65,6 +89,7 @@ class BaseServer(object):
             self.loop = get_hub().loop
             if self.max_accept < 1:
                 raise ValueError('max_accept must be positive int: %r' % (self.max_accept, ))
+            self.accept_batch = self.max_accept
         except:
             self.close()
             raise
@@ -96,7 +121,7 @@ class BaseServer(object):
         if hasattr(self.pool, 'full'):
             self.full = self.pool.full
         if self.pool is not None:
-            self.pool._semaphore.rawlink(self._start_accepting_if_started)
+            self.pool._semaphore.rawlink(self._on_pool_release)
 
     def set_handle(self, handle):
         if handle is not None:
@@ -110,6 +135,11 @@ class BaseServer(object):
         if self.started:
             self.start_accepting()
 
+    def _on_pool_release(self, _semaphore=None):
+        if self._queue:
+            self._dequeue()
+        self._start_accepting_if_started()
+
     def start_accepting(self):
         if self._watcher is None:
             # just stop watcher without creating a new one?
@@ -132,15 +162,21 @@ class BaseServer(object):
             spawn(self._handle, *args)
 
     def _do_read(self):
-        for _ in range(self.max_accept):
-            if self.full():
+        if self.adaptive_accept:
+            batch = max(1, min(self.accept_batch, self.max_accept))
+        else:
+            batch = self.max_accept
+        accepted = 0
+        for _ in range(batch):
+            full = self.full() or (self._deferred and self._deferred_full())
+            if full and self.max_queue is None:
                 self.stop_accepting()
                 return
             try:
                 args = self.do_read()
                 self.delay = self.min_delay
                 if not args:
-                    return
+                    break
             except:
                 self.loop.handle_error(self, *sys.exc_info())
                 ex = sys.exc_info()[1]
@@ -155,6 +191,15 @@ class BaseServer(object):
                     self.delay = min(self.max_delay, self.delay * 2)
                 break
             else:
+                accepted += 1
+                if full:
+                    self._enqueue(args)
+                    continue
+                if self.defer_spawn:
+                    self._deferred.append(args)
+                    if self._deferred_callback is None:
+                        self._deferred_callback = self.loop.run_callback(self._spawn_deferred)
+                    continue
                 try:
                     self.do_handle(*args)
                 except:
@@ -165,6 +210,87 @@ class BaseServer(object):
                         self._timer.start(self._start_accepting_if_started)
                         self.delay = min(self.max_delay, self.delay * 2)
                     break
+        if self.adaptive_accept:
+            self._adjust_accept_batch(batch, accepted)
+
+    def _adjust_accept_batch(self, batch, accepted):
+        if self.loop_lag() > self.max_accept_lag:
+            self.accept_batch = max(1, batch // 2)
+        elif accepted >= batch:
+            # the accept queue was not drained: there are more connections waiting
+            self.accept_batch = min(self.max_accept, batch * 2)
+
+    def loop_lag(self):
+        """Return how many seconds have passed since the current loop iteration has started."""
+        return time.time() - self.loop.now()
+
+    def _deferred_full(self):
+        pool = self.pool
+        if pool is None or getattr(pool, 'size', None) is None:
+            return False
+        return len(self._deferred) >= pool.free_count()
+
+    def _enqueue(self, args):
+        if self.max_queue is not None and len(self._queue) >= self.max_queue:
+            self._reject(args)
+            return
+        self._queue.append((self.loop.now() + self.max_queue_wait, args))
+        if self._queue_timer is None:
+            self._queue_timer = self.loop.timer(self.max_queue_wait)
+            self._queue_timer.start(self._expire_queue)
+
+    def _dequeue(self):
+        queue = self._queue
+        while queue and not self.full():
+            _deadline, args = queue.popleft()
+            try:
+                self.do_handle(*args)
+            except:
+                self.loop.handle_error((args[1:], self), *sys.exc_info())
+
+    def _expire_queue(self):
+        self._queue_timer.stop()
+        self._queue_timer = None
+        queue = self._queue
+        now = self.loop.now()
+        while queue and queue[0][0] <= now:
+            self._reject(queue.popleft()[1])
+        if queue:
+            self._queue_timer = self.loop.timer(max(0, queue[0][0] - now))
+            self._queue_timer.start(self._expire_queue)
+
+    def _reject(self, args):
+        try:
+            self.reject(*args)
+        except:
+            self.loop.handle_error((args[1:], self), *sys.exc_info())
+
+    def reject(self, *args):
+        """Called in the :class:`Hub <gevent.hub.Hub>` with the arguments returned by :meth:`do_read`
+        for the connections that could not be admitted into the queue described by :attr:`max_queue`.
+
+        The default implementation closes the connection. Subclasses may send a short protocol-specific
+        error first, but they must not block."""
+        close = getattr(args[0], 'close', None)
+        if close is not None:
+            close()
+
+    def _spawn_deferred(self):
+        self._deferred_callback = None
+        deferred = self._deferred
+        self._deferred = []
+        for args in deferred:
+            if self.closed:
+                close = getattr(args[0], 'close', None)
+                if close is not None:
+                    close()
+                continue
+            try:
+                self.do_handle(*args)
+            except:
+                self.loop.handle_error((args[1:], self), *sys.exc_info())
+        if self._watcher is None and self._timer is None and not self.closed and not self.full():
+            self._start_accepting_if_started()
 
     def full(self):
         return False
@@ -256,7 +382,12 @@ class BaseServer(object):
                 self.__dict__.pop('_spawn', None)
                 self.__dict__.pop('full', None)
                 if self.pool is not None:
-                    self.pool._semaphore.unlink(self._start_accepting_if_started)
+                    self.pool._semaphore.unlink(self._on_pool_release)
+                if self._queue_timer is not None:
+                    self._queue_timer.stop()
+                    self._queue_timer = None
+                while self._queue:
+                    self._reject(self._queue.popleft()[1])
 
     @property
     def closed(self):
@@ -158,10 +158,7 @@ class Greenlet(greenlet):
         a) cancel the event that will start it
         b) fire the notifications as if an exception was raised in a greenlet
         """
-        if self._start_event is None:
-            self._start_event = _dummy_event
-        else:
-            self._start_event.stop()
+        self._cancel_start()
         try:
             greenlet.throw(self, *args)
         finally:
@@ -181,6 +178,13 @@ class Greenlet(greenlet):
                     args = (GreenletExit, GreenletExit(), None)
                 self._report_error(args)
 
+    def _cancel_start(self):
+        # make sure the greenlet is never started if it was not switched to yet
+        if self._start_event is None:
+            self._start_event = _dummy_event
+        else:
+            self._start_event.stop()
+
     def start(self):
         """Schedule the greenlet to run in this loop iteration"""
         if self._start_event is None:
@@ -224,10 +228,7 @@ class Greenlet(greenlet):
         """
         # XXX this function should not switch out if greenlet is not started but it does
         # XXX fix it (will have to override 'dead' property of greenlet.greenlet)
-        if self._start_event is None:
-            self._start_event = _dummy_event
-        else:
-            self._start_event.stop()
+        self._cancel_start()
         if not self.dead:
             waiter = Waiter()
             self.parent.loop.run_callback(_kill, self, exception, waiter)
@@ -430,10 +431,34 @@ def _killall(greenlets, exception):
                 g.parent.handle_error(g, *sys.exc_info())
 
 
+class _Countdown(object):
+    """A link that switches to *waiter* once it is called *count* times."""
+    __slots__ = ['count', 'waiter']
+
+    def __init__(self, count, waiter):
+        self.count = count
+        self.waiter = waiter
+
+    def __call__(self, source):
+        self.count -= 1
+        if self.count == 0:
+            self.waiter.switch(None)
+
+
 def killall(greenlets, exception=GreenletExit, block=True, timeout=None):
+    """Kill all the *greenlets* with a single callback that throws *exception* into each one in turn.
+
+    If *block* is ``True`` (the default), wait until they are all dead or the optional timeout expires.
+    The greenlets that survived the throw are waited for with a single shared link and waiter.
+    """
     if not greenlets:
         return
-    loop = greenlets[0].loop
+    for g in greenlets:
+        # like kill(), do not let the greenlets that were not switched to yet start before the exception is thrown
+        cancel_start = getattr(g, '_cancel_start', None)
+        if cancel_start is not None:
+            cancel_start()
+    loop = get_hub().loop
     if block:
         waiter = Waiter()
         loop.run_callback(_killall3, greenlets, exception, waiter)
@@ -441,7 +466,16 @@ def killall(greenlets, exception=GreenletExit, block=True, timeout=None):
         try:
             alive = waiter.get()
             if alive:
-                joinall(alive, raise_error=False)
+                waiter = Waiter()
+                countdown = _Countdown(len(alive), waiter)
+                for g in alive:
+                    g.rawlink(countdown)
+                try:
+                    waiter.get()
+                finally:
+                    # on timeout, the survivors must not keep the link (and switch into the stale waiter later)
+                    for g in alive:
+                        g.unlink(countdown)
         finally:
             t.cancel()
     else:
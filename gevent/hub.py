@@ -38,6 +38,15 @@ else:
     integer_types = (int, int)
 
 
+if PY3:
+    def reraise(tp, value, tb=None):
+        if value.__traceback__ is not tb:
+            raise value.with_traceback(tb)
+        raise value
+else:
+    exec("def reraise(tp, value, tb=None):\n    raise tp, value, tb\n")
+
+
 if sys.version_info[0] <= 2:
     import _thread
 else:
@@ -7,18 +7,23 @@ When a greenlet dies, it's automatically removed from the group.
 The :class:`Pool` which a subclass of :class:`Group` provides a way to limit
 concurrency: its :meth:`spawn <Pool.spawn>` method blocks if the number of
 greenlets in the pool has already reached the limit, until there is a free slot.
+
+The :class:`TaskGroup`, another subclass of :class:`Group`, is a context manager
+that does not let its greenlets outlive the ``with`` block and kills them all
+as soon as one of them fails.
 """
 
 import sys
-from bisect import insort_right
+from functools import partial
+from itertools import islice
 
-from gevent.hub import GreenletExit, getcurrent, kill as _kill, PY3
-from gevent.greenlet import joinall, Greenlet
+from gevent.hub import GreenletExit, getcurrent, kill as _kill, reraise, PY3
+from gevent.greenlet import joinall, killall, Greenlet
 from gevent.timeout import Timeout
 from gevent.event import Event
 from gevent.lock import Semaphore, DummySemaphore
 
-__all__ = ['Group', 'Pool']
+__all__ = ['Group', 'Pool', 'TaskGroup']
 
 
 class Group(object):
@@ -30,14 +35,17 @@ class Group(object):
 
     def __init__(self, *args):
         assert len(args) <= 1, args
-        self.greenlets = {*args}
+        self.greenlets = set(*args)
         if args:
             for greenlet in args[0]:
                 greenlet.rawlink(self._discard)
         # each item we kill we place in dying, to avoid killing the same greenlet twice
-        self.dying = {}
+        self.dying = set()
         self._empty_event = Event()
         self._empty_event.set()
+        # set when none of the greenlets in dying is left
+        self._killed_event = Event()
+        self._killed_event.set()
 
     def __repr__(self):
         return '<%s at 0x%x %s>' % (self.__class__.__name__, id(self), self.greenlets)
@@ -63,7 +71,11 @@ class Group(object):
 
     def _discard(self, greenlet):
         self.greenlets.discard(greenlet)
-        self.dying.discard(greenlet)
+        dying = self.dying
+        if greenlet in dying:
+            dying.discard(greenlet)
+            if not dying:
+                self._killed_event.set()
         if not self.greenlets:
             self._empty_event.set()
 
@@ -100,22 +112,22 @@ class Group(object):
             self._empty_event.wait(timeout=timeout)
 
     def kill(self, exception=GreenletExit, block=True, timeout=None):
+        """Kill all the greenlets in the group.
+
+        The exception is thrown into all of them from a single callback (see :func:`gevent.killall`).
+        If *block* is ``True``, wait until they are all dead; the wait is on a single event
+        set when the last killed greenlet leaves the group, not on a link per greenlet.
+        The greenlets added in the meantime are killed too.
+        """
         timer = Timeout.start_new(timeout)
         try:
             try:
                 while self.greenlets:
-                    for greenlet in list(self.greenlets):
-                        if greenlet not in self.dying:
-                            try:
-                                kill = greenlet.kill
-                            except AttributeError:
-                                _kill(greenlet, exception)
-                            else:
-                                kill(exception, block=False)
-                            self.dying.add(greenlet)
+                    dying = self.dying
+                    self._kill_batch([greenlet for greenlet in self.greenlets if greenlet not in dying], exception)
                     if not block:
                         break
-                    joinall(self.greenlets)
+                    self._killed_event.wait()
             except Timeout:
                 ex = sys.exc_info()[1]
                 if ex is not timer:
@@ -123,10 +135,15 @@ class Group(object):
         finally:
             timer.cancel()
 
+    def _kill_batch(self, greenlets, exception):
+        if greenlets:
+            self.dying.update(greenlets)
+            self._killed_event.clear()
+            killall(greenlets, exception, block=False)
+
     def killone(self, greenlet, exception=GreenletExit, block=True, timeout=None):
         if greenlet not in self.dying and greenlet in self.greenlets:
-            greenlet.kill(exception, block=False)
-            self.dying.add(greenlet)
+            self._kill_batch([greenlet], exception)
             if block:
                 greenlet.join(timeout)
 
@@ -165,8 +182,12 @@ class Group(object):
                 greenlet.link(pass_value(callback))
             return greenlet
 
-    def map(self, func, iterable):
-        return list(self.imap(func, iterable))
+    def map(self, func, iterable, chunksize=None):
+        """Return the list of ``func(item)`` for each item of *iterable*.
+
+        With *chunksize*, *iterable* is split into lists of that many items and each list is
+        processed by a single greenlet, which saves the per-item overhead for many small items."""
+        return list(self.imap(func, iterable, chunksize=chunksize))
 
     def map_cb(self, func, iterable, callback=None):
         result = self.map(func, iterable)
@@ -183,14 +204,25 @@ class Group(object):
         """
         return Greenlet.spawn(self.map_cb, func, iterable, callback)
 
-    def imap(self, func, iterable):
-        """An equivalent of itertools.imap()"""
-        return IMap.spawn(func, iterable, spawn=self.spawn)
+    def imap(self, func, iterable, maxsize=None, chunksize=None):
+        """An equivalent of itertools.imap()
+
+        If *maxsize* is given, at most that many items are taken from *iterable* ahead of
+        the consumer of the results: the items being processed plus the results not consumed yet.
+        This keeps the memory constant when the results are consumed slower than produced.
+
+        If *chunksize* is given, the items are processed in chunks as described in :meth:`map`
+        (and *maxsize* counts the chunks). An error then ends the iteration: it is raised once,
+        the rest of the failed chunk is lost and the following calls raise :exc:`StopIteration`.
+
+        The result is a greenlet; if the iteration may stop early, use it as a context manager or call its
+        :meth:`close <IMap.close>` method, otherwise the greenlet keeps waiting for a free slot in the window."""
+        return IMap.spawn(func, iterable, spawn=self.spawn, maxsize=maxsize, chunksize=chunksize)
 
-    def imap_unordered(self, func, iterable):
+    def imap_unordered(self, func, iterable, maxsize=None, chunksize=None):
         """The same as imap() except that the ordering of the results from the
         returned iterator should be considered in arbitrary order."""
-        return IMapUnordered.spawn(func, iterable, spawn=self.spawn)
+        return IMapUnordered.spawn(func, iterable, spawn=self.spawn, maxsize=maxsize, chunksize=chunksize)
 
     def full(self):
         return False
@@ -201,22 +233,52 @@ class Group(object):
 
 class IMapUnordered(Greenlet):
 
-    def __init__(self, func, iterable, spawn=None):
+    def __init__(self, func, iterable, spawn=None, maxsize=None, chunksize=None):
         from gevent.queue import Queue
         Greenlet.__init__(self)
         if spawn is not None:
             self.spawn = spawn
+        if maxsize is not None:
+            if maxsize < 1:
+                raise ValueError('maxsize must be positive: %r' % (maxsize, ))
+            # a slot is taken for each item taken from the iterable and given back when its result is consumed
+            self._window = Semaphore(maxsize)
+        if chunksize is not None and chunksize != 1:
+            if chunksize < 1:
+                raise ValueError('chunksize must be positive: %r' % (chunksize, ))
+            # each greenlet maps a list of items; __next__ hands out the results one by one
+            func = partial(_map_chunk, func)
+            iterable = _iter_chunks(iterable, chunksize)
+            self._chunk = []
         self.func = func
         self.iterable = iterable
         self.queue = Queue()
         self.count = 0
         self.rawlink(self._on_finish)
 
+    _window = DummySemaphore()
+    # the results of the current chunk not handed out yet, reversed (None without chunksize)
+    _chunk = None
+    # true once a chunk has failed (see _next_chunked)
+    _chunk_failed = False
+
     def __iter__(self):
         return self
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     def __next__(self):
+        if self._chunk is None:
+            return self._next()
+        return _next_chunked(self)
+
+    def _next(self):
         value = self.queue.get()
+        self._window.release()
         if isinstance(value, Failure):
             raise value.exc
         return value
@@ -224,18 +286,35 @@ class IMapUnordered(Greenlet):
     def _run(self):
         try:
             func = self.func
-            empty = True
-            for item in self.iterable:
+            window = self._window
+            iterator = iter(self.iterable)
+            while True:
+                # wait for a free slot before taking the next item
+                window.acquire()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
                 self.count += 1
                 self.spawn(func, item).rawlink(self._on_result)
-                empty = False
-            if empty:
+            if self.count <= 0:
+                # no results to wait for (the results are already in if the window made the iterable wait)
                 self.queue.put(Failure(StopIteration))
         finally:
             self.__dict__.pop('spawn', None)
             self.__dict__.pop('func', None)
             self.__dict__.pop('iterable', None)
 
+    def close(self):
+        """Stop taking the items from the iterable: the iteration ends with the results already being computed.
+
+        A greenlet waiting for a free slot in the window is never garbage collected,
+        so the results that are not consumed to the end must be closed."""
+        if not self.ready():
+            self.kill()
+            if self.count <= 0:
+                self.queue.put(Failure(StopIteration))
+
     def _on_result(self, greenlet):
         self.count -= 1
         if greenlet.successful():
@@ -252,49 +331,84 @@ class IMapUnordered(Greenlet):
 
 class IMap(Greenlet):
 
-    def __init__(self, func, iterable, spawn=None):
+    def __init__(self, func, iterable, spawn=None, maxsize=None, chunksize=None):
         from gevent.queue import Queue
         Greenlet.__init__(self)
         if spawn is not None:
             self.spawn = spawn
+        if maxsize is not None:
+            if maxsize < 1:
+                raise ValueError('maxsize must be positive: %r' % (maxsize, ))
+            # with the window, the results arrived ahead of their turn never exceed maxsize
+            self._window = Semaphore(maxsize)
+        if chunksize is not None and chunksize != 1:
+            if chunksize < 1:
+                raise ValueError('chunksize must be positive: %r' % (chunksize, ))
+            # each greenlet maps a list of items; __next__ hands out the results one by one
+            func = partial(_map_chunk, func)
+            iterable = _iter_chunks(iterable, chunksize)
+            self._chunk = []
         self.func = func
         self.iterable = iterable
         self.queue = Queue()
         self.count = 0
-        self.waiting = []  # QQQ maybe deque will work faster there?
+        # the results that arrived before their turn, by index
+        self.waiting = {}
         self.index = 0
         self.maxindex = -1
         self.rawlink(self._on_finish)
 
+    _window = DummySemaphore()
+    # the results of the current chunk not handed out yet, reversed (None without chunksize)
+    _chunk = None
+    # true once a chunk has failed (see _next_chunked)
+    _chunk_failed = False
+
     def __iter__(self):
         return self
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     def __next__(self):
-        while True:
-            if self.waiting and self.waiting[0][0] <= self.index:
-                index, value = self.waiting.pop(0)
-            else:
-                index, value = self.queue.get()
-                if index > self.index:
-                    insort_right(self.waiting, (index, value))
-                    continue
-            self.index += 1
-            if isinstance(value, Failure):
-                raise value.exc
-            return value
+        if self._chunk is None:
+            return self._next()
+        return _next_chunked(self)
+
+    def _next(self):
+        waiting = self.waiting
+        while self.index not in waiting:
+            index, value = self.queue.get()
+            waiting[index] = value
+        value = waiting.pop(self.index)
+        self.index += 1
+        self._window.release()
+        if isinstance(value, Failure):
+            raise value.exc
+        return value
 
     def _run(self):
         try:
-            empty = True
             func = self.func
-            for item in self.iterable:
+            window = self._window
+            iterator = iter(self.iterable)
+            while True:
+                # wait for a free slot before taking the next item
+                window.acquire()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
                 self.count += 1
                 g = self.spawn(func, item)
                 g.rawlink(self._on_result)
                 self.maxindex += 1
                 g.index = self.maxindex
-                empty = False
-            if empty:
+            if self.count <= 0:
+                # no results to wait for (the results are already in if the window made the iterable wait)
                 self.maxindex += 1
                 self.queue.put((self.maxindex, Failure(StopIteration)))
         finally:
@@ -302,6 +416,14 @@ class IMap(Greenlet):
             self.__dict__.pop('func', None)
             self.__dict__.pop('iterable', None)
 
+    def close(self):
+        """Stop taking the items from the iterable (see :meth:`IMapUnordered.close`)."""
+        if not self.ready():
+            self.kill()
+            if self.count <= 0:
+                self.maxindex += 1
+                self.queue.put((self.maxindex, Failure(StopIteration)))
+
     def _on_result(self, greenlet):
         self.count -= 1
         if greenlet.successful():
@@ -318,6 +440,39 @@ class IMap(Greenlet):
             self.queue.put((self.maxindex, Failure(self.exception)))
 
 
+def _map_chunk(func, chunk):
+    return [func(item) for item in chunk]
+
+
+def _next_chunked(imap):
+    chunk = imap._chunk
+    while not chunk:
+        if imap._chunk_failed:
+            raise StopIteration
+        try:
+            chunk = imap._next()
+        except StopIteration:
+            raise
+        except:
+            # the other results of the failed chunk are lost, so rather than skip them the iteration ends here
+            exc_info = sys.exc_info()
+            imap._chunk_failed = True
+            imap.close()
+            reraise(*exc_info)
+        chunk.reverse()
+        imap._chunk = chunk
+    return chunk.pop()
+
+
+def _iter_chunks(iterable, chunksize):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+
 class Failure(object):
     __slots__ = ['exc']
 
@@ -363,6 +518,103 @@ class Pool(Group):
         self._semaphore.release()
 
 
+class _TaskGreenlet(Greenlet):
+    # keeps the traceback of its error for TaskGroup to re-raise it
+
+    exc_info = None
+
+    def _report_error(self, exc_info):
+        if not isinstance(exc_info[1], GreenletExit):
+            self.exc_info = exc_info
+        Greenlet._report_error(self, exc_info)
+
+
+class TaskGroup(Group):
+    """A group of greenlets bound to a ``with`` block.
+
+        with TaskGroup(timeout=5) as tasks:
+            for url in urls:
+                tasks.spawn(fetch, url)
+        # all the greenlets are finished here
+
+    Leaving the block waits for all the greenlets of the group. If one of them fails, the others
+    are killed at once (with a single callback) and its exception is raised from the ``with``
+    statement after they are finished; :attr:`exception` holds it.
+    If the block itself raises, the greenlets are killed and waited for before the exception propagates.
+
+    *timeout* is the deadline for the whole block, started on entering it. When it expires,
+    the greenlets are killed and the :class:`gevent.Timeout` is raised like the one created with
+    ``Timeout(timeout, exception)`` would be; pass ``exception=False`` to leave the block silently instead.
+
+    Task groups nest: a task group inside the block or inside one of the greenlets is cancelled
+    together with the outer one, as the exception that leaves the outer block (or kills the greenlet)
+    passes through the inner ``with`` statement first.
+    """
+
+    greenlet_class = _TaskGreenlet
+
+    def __init__(self, timeout=None, exception=None):
+        Group.__init__(self)
+        self.timeout = timeout
+        self.timeout_exception = exception
+        # the error of the first greenlet that failed and its exc_info (with the traceback if it is known)
+        self.exception = None
+        self._exc_info = None
+        self.cancelled = False
+        self._timer = None
+
+    def __enter__(self):
+        self._timer = Timeout.start_new(self.timeout, self.timeout_exception)
+        return self
+
+    def __exit__(self, typ, value, tb):
+        timer = self._timer
+        self._timer = None
+        if typ is None:
+            try:
+                self._empty_event.wait()
+            except:
+                value = sys.exc_info()[1]
+                self._cancel_and_wait(timer)
+                if value is timer and timer.exception is False:
+                    return
+                raise
+            timer.cancel()
+            exc_info = self._exc_info
+            if exc_info is not None:
+                self._exc_info = None
+                reraise(*exc_info)
+        else:
+            self._cancel_and_wait(timer)
+            if value is timer and timer.exception is False:
+                return True
+
+    def _cancel_and_wait(self, timer):
+        timer.cancel()
+        self.cancel()
+        self._empty_event.wait()
+
+    def add(self, greenlet):
+        Group.add(self, greenlet)
+        if self.cancelled:
+            killall([greenlet], block=False)
+
+    def _discard(self, greenlet):
+        Group._discard(self, greenlet)
+        if self.exception is None and getattr(greenlet, 'exception', None) is not None:
+            exception = self.exception = greenlet.exception
+            self._exc_info = getattr(greenlet, 'exc_info', None) or (type(exception), exception, None)
+            self.cancel()
+
+    def cancel(self):
+        """Kill all the greenlets of the group without waiting for them.
+
+        The greenlets spawned into the group afterwards are killed too."""
+        self.cancelled = True
+        dying = self.dying
+        self._kill_batch([greenlet for greenlet in self.greenlets if greenlet not in dying], GreenletExit)
+
+
 class pass_value(object):
     __slots__ = ['callback']
 
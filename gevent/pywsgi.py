@@ -1,21 +1,41 @@
 # Copyright (c) 2005-2009, eventlet contributors
 # Copyright (c) 2009-2011, gevent contributors
 
+import calendar
 import errno
+import mimetypes
+import os
+import stat
 import sys
+import tempfile
 import time
 import traceback
-import mimetools
+import zlib
 from datetime import datetime
+from email.utils import parsedate
+from io import BytesIO
+from math import frexp, ldexp
 from urllib.parse import unquote
 
 from gevent import socket
 import gevent
 from gevent.server import StreamServer
-from gevent.hub import GreenletExit
+from gevent.hub import GreenletExit, get_hub, getcurrent, kill
+from gevent.event import Event
+from gevent.lock import Semaphore
+from gevent.websocket import WebSocket
 
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        # http://pypi.python.org/pypi/py-sendfile/
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
 
-__all__ = ['WSGIHandler', 'WSGIServer']
+
+__all__ = ['WSGIHandler', 'WSGIServer', 'FileWrapper', 'StaticFiles', 'BufferedLog', 'LatencyHistogram', 'ServerMetrics']
 
 
 MAX_REQUEST_LINE = 8192
@@ -32,6 +52,34 @@ _INTERNAL_ERROR_HEADERS = [('Content-Type', 'text/plain'),
 _REQUEST_TOO_LONG_RESPONSE = "HTTP/1.1 414 Request URI Too Long\r\nConnection: close\r\nContent-length: 0\r\n\r\n"
 _BAD_REQUEST_RESPONSE = "HTTP/1.1 400 Bad Request\r\nConnection: close\r\nContent-length: 0\r\n\r\n"
 _CONTINUE_RESPONSE = "HTTP/1.1 100 Continue\r\n\r\n"
+_REQUEST_TIMEOUT_RESPONSE = "HTTP/1.1 408 Request Timeout\r\nConnection: close\r\nContent-length: 0\r\n\r\n"
+_SERVICE_UNAVAILABLE_RESPONSE = "HTTP/1.1 503 Service Unavailable\r\nConnection: close\r\nContent-length: 0\r\n\r\n"
+_OVERLOADED_RESPONSE = "HTTP/1.1 503 Service Unavailable\r\nConnection: close\r\nRetry-After: 1\r\nContent-length: 0\r\n\r\n"
+
+
+def _buffered_request(rfile):
+    """Return true if the read buffer of *rfile* already holds the request line and the headers of the next request."""
+    buf = getattr(rfile, '_rbuf', None)
+    if buf is None:
+        return False
+    data = buf.getvalue()
+    return '\n\r\n' in data or '\n\n' in data
+
+
+def _buffer_empty(rfile):
+    """Return true if the read buffer of *rfile* is known to be empty."""
+    buf = getattr(rfile, '_rbuf', None)
+    if buf is None:
+        return False
+    return not buf.getvalue()
+
+
+def _close_socket(sock):
+    try:
+        sock._sock.close()  # do not rely on garbage collection
+        sock.close()
+    except socket.error:
+        pass
 
 
 def format_date_time(timestamp):
@@ -39,8 +87,306 @@ def format_date_time(timestamp):
     return "%s, %02d %3s %4d %02d:%02d:%02d GMT" % (_WEEKDAYNAME[wd], day, _MONTHNAME[month], year, hh, mm, ss)
 
 
+# [second, value of the Date header] of the last response
+_date = [None, None]
+
+
+def _format_date():
+    now = int(time.time())
+    if now != _date[0]:
+        _date[:] = [now, format_date_time(now)]
+    return _date[1]
+
+
+# status -> status line, e.g. '200 OK' -> 'HTTP/1.1 200 OK\r\n'; bounded, as the applications may vary the reason
+_status_lines = {}
+_MAX_STATUS_LINES = 256
+
+
+def _status_line(status):
+    try:
+        return _status_lines[status]
+    except KeyError:
+        line = 'HTTP/1.1 %s\r\n' % status
+        if len(_status_lines) < _MAX_STATUS_LINES:
+            _status_lines[status] = line
+        return line
+
+
+# [second, formatted local time] of the last access log line
+_log_time = [None, None]
+
+
+def _format_log_time():
+    now = int(time.time())
+    if now != _log_time[0]:
+        _log_time[:] = [now, str(datetime.fromtimestamp(now))]
+    return _log_time[1]
+
+
+class BufferedLog(object):
+    """A file-like object to pass as *log* to :class:`WSGIServer` so that the access log does not block the hub.
+
+    :meth:`write` only appends to an in-memory buffer. A background greenlet writes the buffered lines
+    to *file* in batches, every *flush_interval* seconds or as soon as *batch* lines are collected;
+    the blocking write itself happens in the hub's threadpool.
+
+    At most *maxsize* lines are buffered. When the buffer is full, :meth:`write` either drops the line
+    (*policy* ``'drop'``, counted in :attr:`dropped`) or waits until the buffer is flushed (*policy* ``'block'``).
+    """
+
+    def __init__(self, file, maxsize=10000, batch=1000, flush_interval=1, policy='drop'):
+        if policy not in ('drop', 'block'):
+            raise ValueError('policy must be "drop" or "block": %r' % (policy, ))
+        self.file = file
+        self.maxsize = maxsize
+        self.batch = batch
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.dropped = 0
+        self._lines = []
+        self._wakeup = Event()
+        self._space = Event()
+        self._space.set()
+        self._lock = Semaphore()
+        self._writer = None
+
+    def write(self, data):
+        while len(self._lines) >= self.maxsize:
+            if self.policy == 'drop':
+                self.dropped += 1
+                return
+            self._wakeup.set()
+            self._space.wait()
+        lines = self._lines
+        lines.append(data)
+        if len(lines) >= self.maxsize:
+            self._space.clear()
+        if len(lines) >= self.batch:
+            self._wakeup.set()
+        if self._writer is None:
+            self._writer = gevent.spawn(self._run)
+
+    def flush(self):
+        """Write out the buffered lines now. Blocks the calling greenlet but not the hub."""
+        self._lock.acquire()
+        try:
+            lines = self._lines
+            if lines:
+                self._lines = []
+                self._space.set()
+                get_hub().threadpool.apply(self._write, (lines, ))
+        finally:
+            self._lock.release()
+
+    def _write(self, lines):
+        self.file.write(''.join(lines))
+        flush = getattr(self.file, 'flush', None)
+        if flush is not None:
+            flush()
+
+    def _run(self):
+        # exits once the buffer is empty so that an idle log does not keep the loop alive
+        try:
+            while self._lines:
+                self._wakeup.wait(self.flush_interval)
+                self._wakeup.clear()
+                self.flush()
+        finally:
+            self._writer = None
+
+
+def _accepts_gzip(accept_encoding):
+    # true if the Accept-Encoding header value allows gzip
+    for coding in accept_encoding.split(','):
+        params = coding.split(';')
+        name = params[0].strip().lower()
+        if name in ('gzip', '*'):
+            for param in params[1:]:
+                param = param.strip()
+                if param.startswith('q='):
+                    try:
+                        return float(param[2:]) > 0
+                    except ValueError:
+                        return False
+            return True
+    return False
+
+
+def _gzip_compress(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class LatencyHistogram(object):
+    """A histogram of durations in seconds that takes constant memory and constant time per :meth:`record`.
+
+    The buckets are log-linear: every power of two between *minimum* and *maximum* is split into
+    *subbuckets* buckets of equal width, so a value is known within ``1/subbuckets`` of its magnitude.
+    The values below *minimum* and above *maximum* go into two more buckets.
+    """
+
+    def __init__(self, minimum=0.00001, maximum=100, subbuckets=4):
+        self.subbuckets = subbuckets
+        self.minimum = minimum
+        self._min_exponent = frexp(minimum)[1]
+        self._size = (frexp(maximum)[1] - self._min_exponent + 1) * subbuckets + 2
+        self.counts = [0] * self._size
+        self.count = 0
+        self.sum = 0.0
+
+    def record(self, value):
+        if value < self.minimum:
+            index = 0
+        else:
+            mantissa, exponent = frexp(value)
+            index = (exponent - self._min_exponent) * self.subbuckets + int((mantissa - 0.5) * 2 * self.subbuckets) + 1
+            if index >= self._size:
+                index = self._size - 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def upper_bound(self, index):
+        """Return the upper bound of the bucket *index*."""
+        if index == 0:
+            return self.minimum
+        if index >= self._size - 1:
+            return float('inf')
+        exponent, sub = divmod(index - 1, self.subbuckets)
+        return ldexp(0.5 + (sub + 1) / (2.0 * self.subbuckets), self._min_exponent + exponent)
+
+    def buckets(self, empty=False):
+        """Return the list of ``(upper bound, cumulative count)`` for the buckets that are not empty,
+        or for all the buckets if *empty* is true."""
+        result = []
+        total = 0
+        for index, count in enumerate(self.counts):
+            if count or empty:
+                total += count
+                result.append((self.upper_bound(index), total))
+        return result
+
+    def percentile(self, fraction):
+        """Return the upper bound of the bucket containing the given *fraction* (between 0 and 1) of the values.
+
+        Return ``None`` if nothing was recorded."""
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        total = 0
+        for index, count in enumerate(self.counts):
+            total += count
+            if count and total >= rank:
+                return self.upper_bound(index)
+
+
+class ServerMetrics(object):
+    """The request metrics of a :class:`WSGIServer`, see :meth:`WSGIServer.enable_metrics`.
+
+    All the counters are totals since the metrics were enabled, except :attr:`in_flight`
+    and :attr:`keepalive`, which are current values.
+    """
+
+    status_classes = ('1xx', '2xx', '3xx', '4xx', '5xx')
+
+    def __init__(self, server=None):
+        self.server = server
+        # status class ('2xx', ...) -> LatencyHistogram of the response times
+        self.latency = dict((name, LatencyHistogram()) for name in self.status_classes)
+        # the number of the responses being handled
+        self.in_flight = 0
+        # the request lines, headers and bodies read
+        self.bytes_received = 0
+        # the responses (headers included) sent
+        self.bytes_sent = 0
+        # the requests rejected with 400 or 414 without calling the application
+        self.parse_errors = 0
+        # the requests rejected with 408 (see WSGIServer.header_timeout)
+        self.timeouts = 0
+        # the connections rejected with 503 because the server was overloaded (see WSGIServer.max_loop_lag)
+        self.shed = 0
+
+    @property
+    def keepalive(self):
+        """The number of the keep-alive connections waiting for their next request."""
+        server = self.server
+        if server is None:
+            return 0
+        return len(server._parked) + len([handler for handler in server.handlers if handler.idle and handler.requests])
+
+    def record(self, handler):
+        """Account the response that *handler* has just finished."""
+        self.in_flight -= 1
+        if handler.status:
+            code = abs(handler.code)
+        else:
+            # no response could be sent
+            code = 500
+        if 100 <= code < 600:
+            self.latency[self.status_classes[code // 100 - 1]].record(handler.time_finish - handler.time_start)
+        self.bytes_received += len(handler.requestline) + 2 + getattr(handler.headers, 'size', 0) + handler.wsgi_input.bytes_read
+        self.bytes_sent += handler.response_length
+
+    def record_error(self, status, response):
+        """Account the *response* that was sent for a request the application never saw."""
+        if status == '408':
+            self.timeouts += 1
+        else:
+            self.parse_errors += 1
+        self.bytes_sent += len(response)
+
+    def snapshot(self):
+        """Return the current metrics as a dictionary."""
+        latency = {}
+        for name, histogram in self.latency.items():
+            latency[name] = {'count': histogram.count,
+                             'sum': histogram.sum,
+                             'p50': histogram.percentile(0.5),
+                             'p90': histogram.percentile(0.9),
+                             'p99': histogram.percentile(0.99)}
+        return {'latency': latency,
+                'in_flight': self.in_flight,
+                'keepalive': self.keepalive,
+                'bytes_received': self.bytes_received,
+                'bytes_sent': self.bytes_sent,
+                'parse_errors': self.parse_errors,
+                'timeouts': self.timeouts,
+                'shed': self.shed}
+
+    def format(self, prefix='pywsgi_'):
+        """Return the metrics in the Prometheus text format.
+
+        Every latency bucket is listed, empty or not, so that the series stay the same between the scrapes."""
+        lines = ['# TYPE %srequest_duration_seconds histogram' % prefix]
+        for name in self.status_classes:
+            histogram = self.latency[name]
+            for bound, count in histogram.buckets(empty=True):
+                if bound != float('inf'):
+                    lines.append('%srequest_duration_seconds_bucket{status="%s",le="%.6g"} %d' % (prefix, name, bound, count))
+            lines.append('%srequest_duration_seconds_bucket{status="%s",le="+Inf"} %d' % (prefix, name, histogram.count))
+            lines.append('%srequest_duration_seconds_sum{status="%s"} %.6f' % (prefix, name, histogram.sum))
+            lines.append('%srequest_duration_seconds_count{status="%s"} %d' % (prefix, name, histogram.count))
+        for name, kind, value in (('requests_in_flight', 'gauge', self.in_flight),
+                                  ('keepalive_connections', 'gauge', self.keepalive),
+                                  ('received_bytes_total', 'counter', self.bytes_received),
+                                  ('sent_bytes_total', 'counter', self.bytes_sent),
+                                  ('parse_errors_total', 'counter', self.parse_errors),
+                                  ('request_timeouts_total', 'counter', self.timeouts),
+                                  ('shed_connections_total', 'counter', self.shed)):
+            lines.append('# TYPE %s%s %s' % (prefix, name, kind))
+            lines.append('%s%s %d' % (prefix, name, value))
+        lines.append('')
+        return '\n'.join(lines)
+
+
 class Input(object):
 
+    # the WSGIHandler whose body_timeout applies to the reads, if any
+    handler = None
+    # the size of the chunks read before the current one
+    _chunks_read = 0
+
     def __init__(self, rfile, content_length, socket=None, chunked_input=False):
         self.rfile = rfile
         self.content_length = content_length
@@ -53,7 +399,8 @@ class Input(object):
         if self.socket is None and (self.position < (self.content_length or 0) or self.chunked_input):
             # ## Read and discard body
             while True:
-                d = self.read(16384)
+                # not self.read(), which SpooledInput overrides
+                d = Input.read(self, 16384)
                 if not d:
                     break
 
@@ -62,6 +409,12 @@ class Input(object):
             self.socket.sendall(_CONTINUE_RESPONSE)
             self.socket = None
 
+    def _begin_read(self):
+        self._send_100_continue()
+        handler = self.handler
+        if handler is not None:
+            handler.set_deadline(handler.server.body_timeout)
+
     def _do_read(self, length=None, use_readline=False):
         if use_readline:
             reader = self.rfile.readline
@@ -72,7 +425,7 @@ class Input(object):
             # Either Content-Length or "Transfer-Encoding: chunked" must be present in a request with a body
             # if it was chunked, then this function would have not been called
             return ''
-        self._send_100_continue()
+        self._begin_read()
         left = content_length - self.position
         if length is None:
             length = left
@@ -88,14 +441,43 @@ class Input(object):
 
         return read
 
+    def _read_chunk_header(self):
+        line = self.rfile.readline(MAX_REQUEST_LINE)
+        if not line.endswith("\n"):
+            self.chunk_length = 0
+            raise IOError("unexpected end of file while reading chunked data header")
+        self.chunk_length = int(line.split(";", 1)[0], 16)
+        self._chunks_read += self.position
+        self.position = 0
+        if self.chunk_length == 0:
+            self.rfile.readline()
+
+    def _chunked_piece(self, length, reader):
+        # return the next piece of the current chunk, at most *length* bytes if it's not None; '' at the end of the body
+        while self.chunk_length != 0:
+            maxreadlen = self.chunk_length - self.position
+            if maxreadlen <= 0:
+                self._read_chunk_header()
+                continue
+            if length is not None and length < maxreadlen:
+                maxreadlen = length
+            data = reader(maxreadlen)
+            if not data:
+                self.chunk_length = 0
+                raise IOError("unexpected end of file while parsing chunked data")
+            self.position += len(data)
+            if self.chunk_length == self.position:
+                self.rfile.readline()
+            return data
+        return ''
+
     def _chunked_read(self, length=None, use_readline=False):
-        rfile = self.rfile
-        self._send_100_continue()
+        self._begin_read()
 
         if length == 0:
             return ""
 
-        if length < 0:
+        if length is not None and length < 0:
             length = None
 
         if use_readline:
@@ -104,41 +486,26 @@ class Input(object):
             reader = self.rfile.read
 
         response = []
-        while self.chunk_length != 0:
-            maxreadlen = self.chunk_length - self.position
-            if length is not None and length < maxreadlen:
-                maxreadlen = length
-
-            if maxreadlen > 0:
-                data = reader(maxreadlen)
-                if not data:
-                    self.chunk_length = 0
-                    raise IOError("unexpected end of file while parsing chunked data")
-
-                datalen = len(data)
-                response.append(data)
-
-                self.position += datalen
-                if self.chunk_length == self.position:
-                    rfile.readline()
-
-                if length is not None:
-                    length -= datalen
-                    if length == 0:
-                        break
-                if use_readline and data[-1] == "\n":
+        while True:
+            data = self._chunked_piece(length, reader)
+            if not data:
+                break
+            response.append(data)
+            if length is not None:
+                length -= len(data)
+                if length == 0:
                     break
-            else:
-                line = rfile.readline()
-                if not line.endswith("\n"):
-                    self.chunk_length = 0
-                    raise IOError("unexpected end of file while reading chunked data header")
-                self.chunk_length = int(line.split(";", 1)[0], 16)
-                self.position = 0
-                if self.chunk_length == 0:
-                    rfile.readline()
+            if use_readline and data[-1] == "\n":
+                break
+        if len(response) == 1:
+            return response[0]
         return ''.join(response)
 
+    @property
+    def bytes_read(self):
+        """The number of the body bytes read so far."""
+        return self._chunks_read + self.position
+
     def read(self, length=None):
         if self.chunked_input:
             return self._chunked_read(length)
@@ -153,6 +520,46 @@ class Input(object):
     def readlines(self, hint=None):
         return list(self)
 
+    def readinto(self, buf):
+        """Read up to ``len(buf)`` bytes of the body into the writable buffer *buf* (e.g. a :class:`bytearray`).
+
+        Return the number of bytes read; 0 means the end of the body.
+        """
+        view = memoryview(buf)
+        size = len(view)
+        total = 0
+        while total < size:
+            if self.chunked_input:
+                self._begin_read()
+                data = self._chunked_piece(size - total, self.rfile.read)
+            else:
+                data = self._do_read(size - total)
+            if not data:
+                break
+            view[total:total + len(data)] = data
+            total += len(data)
+        return total
+
+    def iter_chunks(self, size=65536):
+        """Iterate over the body in pieces of at most *size* bytes, without collecting the whole body in memory.
+
+        With chunked input, a piece never spans two chunks of the request.
+        """
+        if self.chunked_input:
+            self._begin_read()
+            read = self.rfile.read
+            while True:
+                data = self._chunked_piece(size, read)
+                if not data:
+                    break
+                yield data
+        else:
+            while True:
+                data = self._do_read(size)
+                if not data:
+                    break
+                yield data
+
     def __iter__(self):
         return self
 
@@ -163,9 +570,552 @@ class Input(object):
         return line
 
 
+# the spooled body is written to the disk in pieces of this size
+_SPOOL_BATCH = 256 * 1024
+
+
+class SpooledInput(Input):
+    """The ``wsgi.input`` used for the bodies that may be larger than :attr:`WSGIServer.spool_threshold`.
+
+    On the first access, the whole body is read from the connection. A body of at most *threshold* bytes
+    is kept in memory; a larger one is written to an unlinked temporary file in *directory*, the writes
+    being done in the hub's threadpool. After that, the body is read from there, so the memory used
+    does not depend on the size of the upload, and it can be seeked.
+    """
+
+    def __init__(self, rfile, content_length, socket=None, chunked_input=False, threshold=0, directory=None):
+        Input.__init__(self, rfile, content_length, socket=socket, chunked_input=chunked_input)
+        self.threshold = threshold
+        self.directory = directory
+        self.file = None
+
+    def spool(self):
+        """Read the rest of the body from the connection, if it was not done yet, and return the file it is in."""
+        if self.file is not None:
+            return self.file
+        threadpool = get_hub().threadpool
+        pieces = []
+        buffered = 0
+        file = None
+        try:
+            for data in Input.iter_chunks(self, 65536):
+                pieces.append(data)
+                buffered += len(data)
+                if file is None:
+                    if buffered <= self.threshold:
+                        continue
+                    file = threadpool.apply(tempfile.TemporaryFile, (), {'dir': self.directory})
+                if buffered >= _SPOOL_BATCH:
+                    threadpool.apply(file.write, (''.join(pieces), ))
+                    pieces = []
+                    buffered = 0
+            if file is None:
+                file = BytesIO(''.join(pieces))
+            else:
+                if pieces:
+                    threadpool.apply(file.write, (''.join(pieces), ))
+                threadpool.apply(file.seek, (0, ))
+        except:
+            if file is not None:
+                file.close()
+            raise
+        self.file = file
+        return file
+
+    def read(self, length=None):
+        if length is None or length < 0:
+            return self.spool().read()
+        return self.spool().read(length)
+
+    def readline(self, size=None):
+        if size is None or size < 0:
+            return self.spool().readline()
+        return self.spool().readline(size)
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def iter_chunks(self, size=65536):
+        read = self.spool().read
+        while True:
+            data = read(size)
+            if not data:
+                break
+            yield data
+
+    def seek(self, offset, whence=0):
+        self.spool().seek(offset, whence)
+
+    def tell(self):
+        return self.spool().tell()
+
+    def _discard(self):
+        if self.file is None:
+            Input._discard(self)
+        else:
+            self.file.close()
+
+
+class FileWrapper(object):
+    """The ``wsgi.file_wrapper`` (see PEP 333).
+
+    When the application returns a :class:`FileWrapper` around a regular file and the connection is not SSL,
+    :class:`WSGIHandler` transmits the file with ``sendfile()`` (:func:`os.sendfile` or the py-sendfile package)
+    instead of reading it into memory. Otherwise the file is iterated over in *blksize* blocks.
+    """
+
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize = blksize
+        if hasattr(filelike, 'close'):
+            self.close = filelike.close
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        data = self.filelike.read(self.blksize)
+        if data:
+            return data
+        raise StopIteration
+
+
+class _CachedFile(object):
+    """An open file kept by :class:`StaticFiles` together with its stat result and response headers."""
+
+    def __init__(self, filename, fd, st, headers):
+        self.filename = filename
+        self.fd = fd
+        self.size = st.st_size
+        self.identity = (st.st_ino, st.st_size, st.st_mtime)
+        self.etag = '"%x-%x"' % (int(st.st_mtime), st.st_size)
+        self.last_modified = format_date_time(st.st_mtime)
+        self.mtime = int(st.st_mtime)
+        self.headers = headers + [('Last-Modified', self.last_modified), ('ETag', self.etag)]
+        self.checked = 0
+        self.used = 0
+        # the responses being sent from fd; it is closed once the file is evicted and not used anymore
+        self.users = 0
+        self.evicted = False
+
+    def acquire(self):
+        self.users += 1
+
+    def release(self):
+        self.users -= 1
+        if self.evicted and not self.users:
+            os.close(self.fd)
+
+    def evict(self):
+        self.evicted = True
+        if not self.users:
+            os.close(self.fd)
+
+
+class _FileRange(object):
+    """A file-like view of a part of a :class:`_CachedFile`, to be wrapped in a :class:`FileWrapper`.
+
+    It keeps its own position, so any number of responses can share the descriptor: :meth:`tell` gives
+    ``sendfile()`` its offset and :meth:`read` (used when ``sendfile()`` is not available) seeks before
+    every read without yielding in between.
+    """
+
+    def __init__(self, entry, start, end):
+        entry.acquire()
+        self.entry = entry
+        self.position = start
+        self.end = end
+
+    def fileno(self):
+        return self.entry.fd
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        left = self.end - self.position
+        if size < 0 or size > left:
+            size = left
+        if size <= 0:
+            return ''
+        fd = self.entry.fd
+        os.lseek(fd, self.position, 0)
+        data = os.read(fd, size)
+        self.position += len(data)
+        return data
+
+    def close(self):
+        entry = self.entry
+        if entry is not None:
+            self.entry = None
+            entry.release()
+
+
+def _parse_range(value, size):
+    # return (start, end) (end is exclusive) for a single satisfiable range, False if it is not satisfiable,
+    # None if the header should be ignored (malformed, multiple ranges)
+    if not value.startswith('bytes=') or ',' in value:
+        return None
+    try:
+        start, end = value[6:].split('-', 1)
+        start = start.strip()
+        end = end.strip()
+        if not start:
+            length = int(end)
+            if length <= 0:
+                return False
+            return max(size - length, 0), size
+        start = int(start)
+        if end:
+            end = int(end) + 1
+            if end < start:
+                return None
+        else:
+            end = size
+    except ValueError:
+        return None
+    if start >= size:
+        return False
+    return start, min(end, size)
+
+
+class StaticFiles(object):
+    """A WSGI application that serves the files under the directory *root*.
+
+    The open descriptors, stat results and response headers of up to *cache_size* recently served files
+    are kept in a LRU cache. A cached file is stat'ed again at most every *revalidate* seconds and reopened
+    if it has changed, so the conditional requests (``If-None-Match``, ``If-Modified-Since``) are
+    usually answered with ``304 Not Modified`` without touching the disk. Single byte ranges are supported.
+    With :class:`WSGIServer`, the bodies are sent with ``sendfile()`` (see :class:`FileWrapper`).
+
+    If *max_age* is not None, the responses get ``Cache-Control: public, max-age=<max_age>``.
+    """
+
+    def __init__(self, root, cache_size=256, revalidate=1, max_age=None):
+        self.root = os.path.abspath(root)
+        self.cache_size = cache_size
+        self.revalidate = revalidate
+        self.max_age = max_age
+        # filename -> _CachedFile
+        self._cache = {}
+        self._clock = 0
+
+    def __call__(self, env, start_response):
+        method = env['REQUEST_METHOD']
+        if method not in ('GET', 'HEAD'):
+            start_response('405 Method Not Allowed', [('Allow', 'GET, HEAD'), ('Content-Type', 'text/plain')])
+            return ['Method Not Allowed']
+        filename = self.get_filename(env.get('PATH_INFO', ''))
+        entry = None
+        if filename is not None:
+            entry = self._lookup(filename)
+        if entry is None:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return ['Not Found']
+
+        if self._not_modified(env, entry):
+            start_response('304 Not Modified', [('ETag', entry.etag), ('Last-Modified', entry.last_modified)])
+            return []
+
+        start = 0
+        end = entry.size
+        status = '200 OK'
+        headers = list(entry.headers)
+        value = env.get('HTTP_RANGE')
+        if value is not None and env.get('HTTP_IF_RANGE', entry.etag) in (entry.etag, entry.last_modified):
+            byte_range = _parse_range(value, entry.size)
+            if byte_range is False:
+                start_response('416 Requested Range Not Satisfiable',
+                               [('Content-Range', 'bytes */%d' % entry.size), ('Content-Type', 'text/plain')])
+                return ['Requested Range Not Satisfiable']
+            if byte_range is not None:
+                start, end = byte_range
+                status = '206 Partial Content'
+                headers.append(('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, entry.size)))
+        headers.append(('Content-Length', str(end - start)))
+        start_response(status, headers)
+        if method == 'HEAD':
+            return []
+        file_wrapper = env.get('wsgi.file_wrapper', FileWrapper)
+        return file_wrapper(_FileRange(entry, start, end), 65536)
+
+    def get_filename(self, path):
+        """Return the name of the file under :attr:`root` for the request *path* or None if there cannot be one."""
+        parts = []
+        for part in path.split('/'):
+            if not part or part == '.':
+                continue
+            if part == '..' or os.sep in part or (os.altsep and os.altsep in part) or '\0' in part:
+                return None
+            parts.append(part)
+        if not parts:
+            return None
+        return os.path.join(self.root, *parts)
+
+    def _not_modified(self, env, entry):
+        if_none_match = env.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return entry.etag in tags or '*' in tags
+        if_modified_since = env.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified_since is not None:
+            if if_modified_since == entry.last_modified:
+                return True
+            date = parsedate(if_modified_since)
+            if date is not None:
+                return calendar.timegm(date) >= entry.mtime
+        return False
+
+    def _lookup(self, filename):
+        now = time.time()
+        entry = self._cache.get(filename)
+        if entry is not None and now - entry.checked >= self.revalidate:
+            try:
+                st = os.stat(filename)
+            except OSError:
+                sys.exc_clear()
+                st = None
+            if st is None or (st.st_ino, st.st_size, st.st_mtime) != entry.identity:
+                del self._cache[filename]
+                entry.evict()
+                entry = None
+            else:
+                entry.checked = now
+        if entry is None:
+            entry = self._open(filename)
+            if entry is None:
+                return None
+            entry.checked = now
+            if len(self._cache) >= self.cache_size:
+                self._evict()
+            self._cache[filename] = entry
+        self._clock += 1
+        entry.used = self._clock
+        return entry
+
+    def _open(self, filename):
+        try:
+            fd = os.open(filename, os.O_RDONLY)
+        except (OSError, IOError):
+            sys.exc_clear()
+            return None
+        try:
+            st = os.fstat(fd)
+            if not stat.S_ISREG(st.st_mode):
+                os.close(fd)
+                return None
+        except:
+            os.close(fd)
+            raise
+        content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        headers = [('Content-Type', content_type), ('Accept-Ranges', 'bytes')]
+        if self.max_age is not None:
+            headers.append(('Cache-Control', 'public, max-age=%d' % self.max_age))
+        return _CachedFile(filename, fd, st, headers)
+
+    def _evict(self):
+        # drop the least recently used quarter of the cache
+        entries = sorted(self._cache.values(), key=lambda entry: entry.used)
+        for entry in entries[:max(1, len(entries) // 4)]:
+            del self._cache[entry.filename]
+            entry.evict()
+
+    def clear(self):
+        """Forget all the cached files."""
+        cache = self._cache
+        self._cache = {}
+        for entry in cache.values():
+            entry.evict()
+
+
+# header name -> environ key, e.g. 'User-Agent' -> 'HTTP_USER_AGENT'; bounded, as the names come from the clients
+_environ_keys = {'Content-Type': 'CONTENT_TYPE',
+                 'Content-Length': 'CONTENT_LENGTH'}
+_MAX_ENVIRON_KEYS = 512
+
+
+def _environ_key(name):
+    try:
+        return _environ_keys[name]
+    except KeyError:
+        key = name.replace('-', '_').upper()
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        if len(_environ_keys) < _MAX_ENVIRON_KEYS:
+            _environ_keys[name] = key
+        return key
+
+
+# the name of a header that is being skipped (see Headers)
+_IGNORED = object()
+
+
+class Headers(object):
+    """The request headers.
+
+    A lightweight replacement for :class:`mimetools.Message` that parses the header block
+    in a single pass and keeps the fields ready to be put into the WSGI environ
+    (see :meth:`WSGIHandler.get_environ`). It supports the subset of the :class:`mimetools.Message`
+    interface used by pywsgi and by the applications: :attr:`headers`, :attr:`status`, :attr:`typeheader`,
+    :meth:`get`, :meth:`getheader`, :meth:`getheaders`, ``in``, ``[]`` and ``del``.
+
+    The header lines are subject to the same limit as the request line (``MAX_REQUEST_LINE``);
+    a longer line raises :exc:`ValueError`.
+
+    The fields whose names contain ``_`` are ignored (they stay only in :attr:`headers`):
+    in the environ ``Foo_Bar`` would be indistinguishable from ``Foo-Bar``, so a client could
+    sneak it past a proxy that only filters the latter.
+    """
+
+    def __init__(self, fp, seekable=0):
+        self.fp = fp
+        self.status = ''
+        # the raw header lines, like mimetools.Message.headers
+        self.headers = []
+        # lowercase name -> value of the last occurrence
+        self.dict = {}
+        # (environ key, value) pairs in the order received, continuation lines folded
+        self.fields = []
+        # the number of bytes read, the empty line included
+        self.size = 0
+        self.readheaders()
+
+    def readheaders(self):
+        readline = self.fp.readline
+        lines = self.headers
+        fields = self.fields
+        values = self.dict
+        name = None
+        size = 0
+        while True:
+            line = readline(MAX_REQUEST_LINE)
+            size += len(line)
+            if not line:
+                self.status = 'EOF in headers'
+                break
+            if len(line) >= MAX_REQUEST_LINE and line[-1] != '\n':
+                raise ValueError('Header line too long')
+            if line == '\r\n' or line == '\n':
+                break
+            if line[0] in ' \t':
+                if name is None:
+                    self.status = 'Non-header line where header expected'
+                    break
+                # continuation line: fold it into the previous field
+                lines.append(line)
+                if name is _IGNORED:
+                    continue
+                key, value = fields[-1]
+                value = value + ' ' + line.strip()
+                fields[-1] = (key, value)
+                values[name] = value
+                continue
+            index = line.find(':')
+            if index <= 0:
+                self.status = 'Non-header line where header expected'
+                break
+            lines.append(line)
+            raw_name = line[:index]
+            if '_' in raw_name:
+                name = _IGNORED
+                continue
+            name = raw_name.lower()
+            value = line[index + 1:].strip()
+            values[name] = value
+            fields.append((_environ_key(raw_name), value))
+        self.size = size
+
+    @property
+    def typeheader(self):
+        return self.dict.get('content-type')
+
+    def get(self, name, default=None):
+        return self.dict.get(name.lower(), default)
+
+    getheader = get
+
+    def getheaders(self, name):
+        if '_' in name:
+            # such fields are ignored; do not let the environ key match 'Foo-Bar' for 'Foo_Bar'
+            return []
+        key = _environ_key(name)
+        return [value for (field_key, value) in self.fields if field_key == key]
+
+    def __getitem__(self, name):
+        return self.dict[name.lower()]
+
+    def __contains__(self, name):
+        return name.lower() in self.dict
+
+    def __delitem__(self, name):
+        name = name.lower()
+        del self.dict[name]
+        key = _environ_key(name)
+        self.fields = [field for field in self.fields if field[0] != key]
+        prefix = name + ':'
+        self.headers = [line for line in self.headers if not line.lower().startswith(prefix)]
+
+    def keys(self):
+        return list(self.dict.keys())
+
+    def items(self):
+        return list(self.dict.items())
+
+    def __len__(self):
+        return len(self.dict)
+
+    def __iter__(self):
+        return iter(self.dict)
+
+
 class WSGIHandler(object):
     protocol_version = 'HTTP/1.1'
-    MessageClass = mimetools.Message
+    MessageClass = Headers
+    # put into environ['wsgi.websocket'] for the WebSocket upgrade requests (see gevent.websocket)
+    WebSocketClass = WebSocket
+    # true once the connection was handed over to another protocol, see upgrade()
+    upgraded = False
+    # the greenlet running handle(), set by WSGIServer.handle()
+    greenlet = None
+    # true while waiting for the next request
+    idle = False
+    # If the next request has already arrived (HTTP pipelining), the responses are collected
+    # and sent with a single sendall() once there are no more complete requests in the read buffer
+    # or once this many bytes are collected.
+    max_pipeline_buffer = 65536
+    # the collected responses or None if the responses are sent right away
+    _output = None
+    # the loop time by which the current read must complete (see WSGIServer.idle_timeout and others)
+    deadline = None
+    # the number of requests read on this connection
+    requests = 0
+    # see _connection_environ()
+    _base_environ = None
+    # true if the current response is to be compressed (see WSGIServer.gzip)
+    _gzip = False
+    # the ETag of the current response if it is to be compressed
+    _gzip_etag = None
+    # the zlib compressor of the current response while it is being compressed incrementally
+    _compressor = None
+    # The pieces of the response body written after the headers are collected and sent together once
+    # the application lets the hub run (e.g. blocks on I/O between two yields), once the response is complete,
+    # or once write_buffer_high bytes are collected. In the last case the application is suspended until
+    # at most write_buffer_low bytes are left unsent, that is, only while the socket cannot take more data.
+    # None disables the collecting; it is not done for SSL connections nor for the pipelined requests.
+    write_buffer_high = 65536
+    write_buffer_low = 16384
+    # the body pieces (with their chunk headers) not handed to the socket yet and their size
+    _pending = None
+    _pending_size = 0
+    # the formatted data that did not fit into the socket yet
+    _unsent = None
+    # the callback that sends the pending data from the hub and the watcher that sends the rest when possible
+    _flush_callback = None
+    _flush_watcher = None
+    # the socket error that happened while sending from the hub, raised on the next write
+    _write_error = None
 
     def __init__(self, socket, address, server, rfile=None):
         self.socket = socket
@@ -185,8 +1135,21 @@ class WSGIHandler(object):
                 if result is None:
                     break
                 if result is True:
+                    if self.server.closed:
+                        # the server is stopping: do not wait for more requests
+                        break
+                    server = self.server
+                    # SSL may have decrypted data buffered, which the read watcher would not notice
+                    if server.park_idle and not server.ssl_enabled and self._output is None and _buffer_empty(self.rfile):
+                        # wait for the next request without this greenlet
+                        server.park(self.socket, self.client_address, self.requests)
+                        self.socket = None
+                        break
                     continue
                 self.status, response_body = result
+                if self.server.metrics is not None:
+                    self.server.metrics.record_error(self.status, response_body)
+                self._flush_output()
                 self.socket.sendall(response_body)
                 if self.time_finish == 0:
                     self.time_finish = time.time()
@@ -195,6 +1158,7 @@ class WSGIHandler(object):
         finally:
             if self.socket is not None:
                 try:
+                    self._flush_output()
                     # read out request data to prevent error: [Errno 104] Connection reset by peer
                     try:
                         self.socket._sock.recv(16384)
@@ -208,6 +1172,8 @@ class WSGIHandler(object):
 
     def _check_http_version(self):
         version = self.request_version
+        if version == "HTTP/1.1" or version == "HTTP/1.0":
+            return True
         if not version.startswith("HTTP/"):
             return False
         version = tuple(int(x) for x in version[5:].split("."))  # "HTTP/"
@@ -268,6 +1234,39 @@ class WSGIHandler(object):
 
         return True
 
+    def set_deadline(self, seconds):
+        """Allow the current read *seconds* seconds to complete; ``None`` means no limit.
+
+        The deadlines are enforced by the server (see :attr:`WSGIServer.idle_timeout`)."""
+        if seconds is None:
+            self.deadline = None
+        else:
+            self.deadline = self.server.loop.now() + seconds
+
+    def timeout_read(self):
+        """Make the read the handler is blocked in, if any, fail with :class:`socket.timeout`. Return true if it did.
+
+        Called by :class:`WSGIServer` when :attr:`deadline` has passed."""
+        sock = getattr(self.rfile, '_sock', None)
+        watcher = getattr(sock, '_read_event', None)
+        if watcher is not None and watcher.active:
+            self.close_connection = True
+            sock.hub.cancel_wait(watcher, socket.timeout('timed out'))
+            return True
+        return False
+
+    def close_if_idle(self):
+        """Close the connection if it is waiting for the next request. Return true if it was closed.
+
+        Called by :meth:`WSGIServer.stop`."""
+        if self.idle:
+            # the handler is blocked reading from rfile; closing its socket wakes it up with EBADF
+            sock = getattr(self.rfile, '_sock', None)
+            if sock is not None:
+                sock.close()
+                return True
+        return False
+
     def log_error(self, msg, *args):
         try:
             message = msg % args
@@ -290,11 +1289,16 @@ class WSGIHandler(object):
         if self.rfile.closed:
             return
 
+        server = self.server
+        self.idle = True
+        self.set_deadline(server.idle_timeout if self.requests else server.header_timeout)
         try:
             self.requestline = self.read_requestline()
         except socket.error:
             # "Connection reset by peer" or other socket errors aren't interesting here
             return
+        finally:
+            self.idle = False
 
         if not self.requestline:
             return
@@ -304,21 +1308,36 @@ class WSGIHandler(object):
         if len(self.requestline) >= MAX_REQUEST_LINE:
             return ('414', _REQUEST_TOO_LONG_RESPONSE)
 
+        self.requests += 1
+        if self.requests > 1:
+            self.set_deadline(server.header_timeout)
         try:
             # for compatibility with older versions of pywsgi, we pass self.requestline as an argument there
             if not self.read_request(self.requestline):
                 return ('400', _BAD_REQUEST_RESPONSE)
+        except socket.timeout:
+            # see WSGIServer.header_timeout
+            return ('408', _REQUEST_TIMEOUT_RESPONSE)
         except Exception:
             ex = sys.exc_info()[1]
             if not isinstance(ex, ValueError):
                 traceback.print_exc()
             self.log_error('Invalid request: %s', str(ex) or ex.__class__.__name__)
             return ('400', _BAD_REQUEST_RESPONSE)
+        self.deadline = None
 
         self.environ = self.get_environ()
         self.application = self.server.application
         try:
+            if self.content_length or self.wsgi_input.chunked_input:
+                # reading the body might block: send the collected responses first
+                self._flush_output()
+            elif self._output is None and _buffered_request(self.rfile):
+                # the next request is already here: batch the responses
+                self._output = bytearray()
             self.handle_one_response()
+            if self._output is not None and (self.close_connection or not _buffered_request(self.rfile)):
+                self._flush_output()
         except socket.error:
             ex = sys.exc_info()[1]
             # Broken pipe, connection reset by peer
@@ -338,7 +1357,7 @@ class WSGIHandler(object):
 
     def finalize_headers(self):
         if self.provided_date is None:
-            self.response_headers.append(('Date', format_date_time(time.time())))
+            self.response_headers.append(('Date', _format_date()))
 
         if self.code not in (304, 204):
             # the reply will include message-body; make sure we have either Content-Length or chunked
@@ -351,6 +1370,15 @@ class WSGIHandler(object):
                         self.response_headers.append(('Transfer-Encoding', 'chunked'))
 
     def _sendall(self, data):
+        length = len(data)
+        output = self._output
+        if output is not None:
+            output.extend(data)
+            if len(output) < self.max_pipeline_buffer:
+                self.response_length += length
+                return
+            self._output = bytearray()
+            data = output
         try:
             self.socket.sendall(data)
         except socket.error as ex:
@@ -358,7 +1386,14 @@ class WSGIHandler(object):
             if self.code > 0:
                 self.code = -self.code
             raise
-        self.response_length += len(data)
+        self.response_length += length
+
+    def _flush_output(self):
+        output = self._output
+        if output is not None:
+            self._output = None
+            if output:
+                self.socket.sendall(output)
 
     def _write(self, data):
         if not data:
@@ -366,12 +1401,111 @@ class WSGIHandler(object):
         if self.response_use_chunked:
             ## Write the chunked encoding
             data = "%x\r\n%s\r\n" % (len(data), data)
-        self._sendall(data)
+        if self.write_buffer_high is None or self._output is not None or self.server.ssl_enabled:
+            self._sendall(data)
+            return
+        pending = self._pending
+        if pending is None:
+            pending = self._pending = []
+        pending.append(data)
+        self._pending_size += len(data)
+        if self._pending_size >= self.write_buffer_high:
+            self._flush_pending(self.write_buffer_low)
+        elif self._flush_callback is None:
+            self._flush_callback = self.server.loop.run_callback(self._flush_nowait)
+
+    def _take_pending(self):
+        # return the data to send: the unsent rest followed by the pending pieces
+        towrite = []
+        if self._unsent is not None:
+            towrite.append(self._unsent)
+            self._unsent = None
+        if self._pending:
+            towrite.extend(self._pending)
+            self.response_length += self._pending_size
+            self._pending = None
+            self._pending_size = 0
+        if len(towrite) == 1:
+            return towrite[0]
+        try:
+            return ''.join(towrite)
+        except TypeError:
+            # e.g. a bytearray
+            return bytearray().join(towrite)
+
+    def _stop_flushing(self):
+        if self._flush_callback is not None:
+            self._flush_callback.stop()
+            self._flush_callback = None
+        if self._flush_watcher is not None:
+            self._flush_watcher.stop()
+            self._flush_watcher = None
+
+    def _flush_pending(self, limit=0, tail=''):
+        """Send the collected body data followed by *tail*, until at most *limit* bytes are left unsent."""
+        self._stop_flushing()
+        error = self._write_error
+        if error is not None:
+            self._write_error = None
+            self.status = 'socket error: %s' % error
+            if self.code > 0:
+                self.code = -self.code
+            raise error
+        data = self._take_pending()
+        if tail:
+            data += tail
+            self.response_length += len(tail)
+        if len(data) <= limit:
+            if data:
+                self._unsent = data
+                self._flush_callback = self.server.loop.run_callback(self._flush_nowait)
+            return
+        view = memoryview(data)
+        sock = self.socket
+        try:
+            while len(view) > limit:
+                view = view[sock.send(view):]
+        except socket.error as ex:
+            self.status = 'socket error: %s' % ex
+            if self.code > 0:
+                self.code = -self.code
+            raise
+        if len(view):
+            self._unsent = view.tobytes()
+            self._flush_callback = self.server.loop.run_callback(self._flush_nowait)
+
+    def _flush_nowait(self):
+        # called in the hub, so only a non-blocking send is possible here
+        self._flush_callback = None
+        if self._write_error is not None or self.socket is None:
+            return
+        data = self._take_pending()
+        try:
+            sent = self.socket._sock.send(data)
+        except socket.error as ex:
+            if ex.args[0] != errno.EWOULDBLOCK:
+                self._write_error = ex
+                self._stop_flushing()
+                return
+            sent = 0
+        if sent < len(data):
+            self._unsent = data[sent:]
+            if self._flush_watcher is None:
+                self._flush_watcher = self.server.loop.io(self.socket.fileno(), 2)
+                self._flush_watcher.start(self._flush_nowait)
+        elif self._flush_watcher is not None:
+            self._flush_watcher.stop()
+            self._flush_watcher = None
 
     def write(self, data):
         if self.code in (304, 204) and data:
             raise AssertionError('The %s response must have no body' % self.code)
 
+        if self._gzip:
+            data = self._gzip_write(data)
+            if not data and self.headers_sent:
+                return
+
         if self.headers_sent:
             self._write(data)
         else:
@@ -379,48 +1513,30 @@ class WSGIHandler(object):
                 raise AssertionError("The application did not call start_response()")
             self._write_with_headers(data)
 
-    if sys.version_info[:2] >= (2, 6):
-
-        def _write_with_headers(self, data):
-            towrite = bytearray()
-            self.headers_sent = True
-            self.finalize_headers()
-
-            towrite.extend('HTTP/1.1 %s\r\n' % self.status)
-            for header in self.response_headers:
-                towrite.extend('%s: %s\r\n' % header)
-
-            towrite.extend('\r\n')
-            if data:
-                if self.response_use_chunked:
-                    ## Write the chunked encoding
-                    towrite.extend("%x\r\n%s\r\n" % (len(data), data))
-                else:
-                    towrite.extend(data)
-            self._sendall(towrite)
-
-    else:
-        # Python 2.5 does not have bytearray
-
-        def _write_with_headers(self, data):
-            towrite = []
-            self.headers_sent = True
-            self.finalize_headers()
-
-            towrite.append('HTTP/1.1 %s\r\n' % self.status)
-            for header in self.response_headers:
-                towrite.append('%s: %s\r\n' % header)
-
-            towrite.append('\r\n')
-            if data:
-                if self.response_use_chunked:
-                    ## Write the chunked encoding
-                    towrite.append("%x\r\n%s\r\n" % (len(data), data))
-                else:
-                    towrite.append(data)
+    def _write_with_headers(self, data):
+        self.headers_sent = True
+        self.finalize_headers()
+
+        towrite = [_status_line(self.status)]
+        towrite.extend(['%s: %s\r\n' % header for header in self.response_headers])
+        towrite.append('\r\n')
+        if data:
+            if self.response_use_chunked:
+                ## Write the chunked encoding
+                towrite.append("%x\r\n" % len(data))
+                towrite.append(data)
+                towrite.append("\r\n")
+            else:
+                towrite.append(data)
+        if isinstance(data, str):
             self._sendall(''.join(towrite))
+        else:
+            # e.g. a bytearray
+            self._sendall(bytearray().join(towrite))
 
     def start_response(self, status, headers, exc_info=None):
+        if self.upgraded:
+            return self.write
         if exc_info:
             try:
                 if self.headers_sent:
@@ -451,21 +1567,181 @@ class WSGIHandler(object):
             self.close_connection = True
         elif provided_connection == 'close':
             self.close_connection = True
+        elif self.server.closed or (self.server.max_requests is not None and self.requests >= self.server.max_requests):
+            # the server is stopping or the connection has served enough requests: this is the last response on it
+            if provided_connection is None:
+                headers.append(('Connection', 'close'))
+            self.close_connection = True
 
         if self.code in (304, 204):
             if self.provided_content_length is not None and self.provided_content_length != '0':
                 msg = 'Invalid Content-Length for %s response: %r (must be absent or zero)' % (self.code, self.provided_content_length)
                 raise AssertionError(msg)
 
+        if self.server.gzip:
+            self._gzip = self.should_gzip(headers)
+
         return self.write
 
+    def should_gzip(self, headers):
+        """Return true if the response with *headers* is to be compressed (see :attr:`WSGIServer.gzip`)."""
+        server = self.server
+        # a partial (206) or any other non-200 body is sent as it is; Content-Range describes the uncompressed bytes
+        if self.code != 200 or self.command == 'HEAD':
+            return False
+        accept_encoding = self.environ.get('HTTP_ACCEPT_ENCODING')
+        if not accept_encoding or not _accepts_gzip(accept_encoding):
+            return False
+        content_type = None
+        etag = None
+        for header, value in headers:
+            header = header.lower()
+            if header == 'content-type':
+                content_type = value
+            elif header == 'etag':
+                etag = value
+            elif header in ('content-encoding', 'content-range'):
+                return False
+            elif header == 'cache-control' and 'no-transform' in value:
+                return False
+        if content_type is None or not content_type.startswith(server.gzip_types):
+            return False
+        if self.provided_content_length is not None and int(self.provided_content_length) < server.gzip_min_length:
+            return False
+        self._gzip_etag = etag
+        return True
+
+    def _begin_gzip(self):
+        # switch the response headers to the compressed body
+        headers = []
+        vary = None
+        for header, value in self.response_headers:
+            name = header.lower()
+            if name == 'content-length':
+                continue
+            if name == 'vary':
+                vary = value
+                continue
+            headers.append((header, value))
+        headers.append(('Content-Encoding', 'gzip'))
+        if vary is None:
+            headers.append(('Vary', 'Accept-Encoding'))
+        elif 'accept-encoding' in vary.lower() or vary.strip() == '*':
+            headers.append(('Vary', vary))
+        else:
+            headers.append(('Vary', vary + ', Accept-Encoding'))
+        self.response_headers = headers
+        self.provided_content_length = None
+
+    def _gzip_write(self, data):
+        # compress the data passed to write(); every piece is flushed so that streaming responses are not delayed
+        compressor = self._compressor
+        if compressor is None:
+            if self.headers_sent:
+                # the headers went out uncompressed (write('') was called first)
+                self._gzip = False
+                return data
+            if not data:
+                return data
+            self._begin_gzip()
+            compressor = self._compressor = zlib.compressobj(self.server.gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        if not data:
+            return ''
+        return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def _gzip_finish(self):
+        self._gzip = False
+        compressor = self._compressor
+        if compressor is not None:
+            self._compressor = None
+            self.write(compressor.flush())
+
+    def _gzip_buffered(self):
+        """Compress the body as a whole if it is known up front and not too big. Return true if it was sent."""
+        server = self.server
+        result = self.result
+        if isinstance(result, FileWrapper):
+            if self.provided_content_length is None or int(self.provided_content_length) > server.gzip_buffer_size:
+                return False
+        elif not isinstance(result, (list, tuple)):
+            return False
+        key = None
+        compressed = None
+        environ = self.environ
+        if self._gzip_etag is not None and server.gzip_cache_size and 'HTTP_RANGE' not in environ:
+            key = (environ.get('HTTP_HOST'), environ.get('PATH_INFO'), environ.get('QUERY_STRING'), self._gzip_etag)
+            cache = server._gzip_cache
+            if cache is None:
+                cache = server._gzip_cache = {}
+            compressed = cache.get(key)
+        if compressed is None:
+            try:
+                body = ''.join(result)
+            except TypeError:
+                # e.g. bytearrays: compress them incrementally
+                return False
+            if len(body) > server.gzip_buffer_size:
+                self.result = [body]
+                return False
+            if len(body) < server.gzip_min_length:
+                self._gzip = False
+                self.write(body)
+                return True
+            if len(body) >= server.gzip_threadpool_size:
+                # do not block the other greenlets while compressing a big body
+                compressed = get_hub().threadpool.apply(_gzip_compress, (body, server.gzip_level))
+            else:
+                compressed = _gzip_compress(body, server.gzip_level)
+            if key is not None:
+                if len(cache) >= server.gzip_cache_size:
+                    cache.clear()
+                cache[key] = compressed
+        self._gzip = False
+        self._begin_gzip()
+        self.provided_content_length = str(len(compressed))
+        self.response_headers.append(('Content-Length', self.provided_content_length))
+        self.write(compressed)
+        return True
+
+    def upgrade(self, status, headers):
+        """Send the response head made of *status* and *headers* and hand the connection over to another protocol.
+
+        Used by :class:`gevent.websocket.WebSocket` to switch protocols. The response returned by the application
+        is discarded and the connection is closed once the application returns."""
+        if self.headers_sent:
+            raise AssertionError('The response headers have already been sent')
+        self._flush_output()
+        self.code = int(status.split(' ', 1)[0])
+        self.status = status
+        self.headers_sent = True
+        self.upgraded = True
+        self.close_connection = True
+        towrite = [_status_line(status)]
+        towrite.extend(['%s: %s\r\n' % header for header in headers])
+        towrite.append('\r\n')
+        self._sendall(''.join(towrite))
+
+    def make_websocket(self, env):
+        """Return a :attr:`WebSocketClass` instance if the request asks for the WebSocket upgrade, ``None`` otherwise."""
+        if env.get('HTTP_UPGRADE', '').lower() != 'websocket':
+            return None
+        if self.command != 'GET' or self.request_version != 'HTTP/1.1':
+            return None
+        if 'upgrade' not in [token.strip() for token in env.get('HTTP_CONNECTION', '').lower().split(',')]:
+            return None
+        key = env.get('HTTP_SEC_WEBSOCKET_KEY')
+        if not key or env.get('HTTP_SEC_WEBSOCKET_VERSION') != '13':
+            return None
+        protocols = [protocol.strip() for protocol in env.get('HTTP_SEC_WEBSOCKET_PROTOCOL', '').split(',')]
+        return self.WebSocketClass(self, key, [protocol for protocol in protocols if protocol])
+
     def log_request(self):
         log = self.server.log
         if log:
             log.write(self.format_request() + '\n')
 
     def format_request(self):
-        now = datetime.now().replace(microsecond=0)
+        now = _format_log_time()
         length = self.response_length or '-'
         if self.time_finish:
             delta = '%.6f' % (self.time_finish - self.time_start)
@@ -481,17 +1757,82 @@ class WSGIHandler(object):
             delta)
 
     def process_result(self):
+        if self.upgraded:
+            # the connection belongs to another protocol now: the response is discarded
+            return
+        if self._gzip:
+            if not self.headers_sent and self._gzip_buffered():
+                return
+        elif isinstance(self.result, FileWrapper) and self._send_file(self.result.filelike):
+            return
         for data in self.result:
             if data:
                 self.write(data)
+        if self._gzip:
+            self._gzip_finish()
         if self.status and not self.headers_sent:
             self.write('')
-        if self.response_use_chunked:
-            self.socket.sendall('0\r\n\r\n')
-            self.response_length += 5
+        if self._pending is not None or self._unsent is not None:
+            if self.response_use_chunked:
+                self._flush_pending(tail='0\r\n\r\n')
+            else:
+                self._flush_pending()
+        elif self.response_use_chunked:
+            self._sendall('0\r\n\r\n')
+
+    def _send_file(self, filelike):
+        """Transmit *filelike* from its current position with ``sendfile()``. Return false if it cannot be done."""
+        if sendfile is None or self.server.ssl_enabled or self.code in (304, 204) or self.headers_sent:
+            return False
+        try:
+            fileno = filelike.fileno()
+            offset = filelike.tell()
+            st = os.fstat(fileno)
+        except (AttributeError, IOError, OSError):
+            sys.exc_clear()
+            return False
+        if not stat.S_ISREG(st.st_mode):
+            return False
+        if self.provided_content_length is None:
+            count = max(st.st_size - offset, 0)
+            self.provided_content_length = str(count)
+            self.response_headers.append(('Content-Length', self.provided_content_length))
+        else:
+            count = int(self.provided_content_length)
+        self.write('')
+        self._flush_output()
+        sock = self.socket
+        out_fileno = sock.fileno()
+        sent = 0
+        while sent < count:
+            try:
+                result = sendfile(out_fileno, fileno, offset + sent, count - sent)
+            except OSError as ex:
+                if ex.args[0] not in (errno.EAGAIN, errno.EINTR):
+                    self.status = 'socket error: %s' % ex
+                    self.code = -self.code
+                    raise socket.error(*ex.args)
+                sys.exc_clear()
+                sock._wait(sock._write_event)
+                continue
+            if isinstance(result, tuple):
+                # older py-sendfile returns (offset, sent)
+                result = result[1]
+            if not result:
+                # the file is shorter than the Content-Length: the client would wait for the rest forever
+                self.close_connection = True
+                break
+            sent += result
+            self.response_length += result
+        return True
 
     def run_application(self):
-        self.result = self.application(self.environ, self.start_response)
+        path = self.server.metrics_path
+        if path is not None and self.environ['PATH_INFO'] == path and self.command == 'GET':
+            self.start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4')])
+            self.result = [self.server.metrics.format()]
+        else:
+            self.result = self.application(self.environ, self.start_response)
         self.process_result()
 
     def handle_one_response(self):
@@ -502,6 +1843,13 @@ class WSGIHandler(object):
         self.result = None
         self.response_use_chunked = False
         self.response_length = 0
+        self._gzip = False
+        self._compressor = None
+        self._write_error = None
+        metrics = self.server.metrics
+        if metrics is not None:
+            metrics.in_flight += 1
+        self.server.in_flight += 1
 
         try:
             try:
@@ -514,14 +1862,21 @@ class WSGIHandler(object):
         except:
             self.handle_error(*sys.exc_info())
         finally:
+            self._stop_flushing()
+            self._pending = None
+            self._pending_size = 0
+            self._unsent = None
+            self.server.in_flight -= 1
             self.time_finish = time.time()
+            if metrics is not None:
+                metrics.record(self)
             self.log_request()
 
     def handle_error(self, type, value, tb):
         if not issubclass(type, GreenletExit):
             self.server.loop.handle_error(self.environ, type, value, tb)
         del tb
-        if self.response_length:
+        if self.response_length or self.upgraded:
             self.close_connection = True
         else:
             self.start_response(_INTERNAL_ERROR_STATUS, _INTERNAL_ERROR_HEADERS)
@@ -535,19 +1890,29 @@ class WSGIHandler(object):
                 value += header
                 continue
 
-            if key not in (None, 'CONTENT_TYPE', 'CONTENT_LENGTH'):
+            if key not in (None, 'CONTENT_TYPE', 'CONTENT_LENGTH') and '_' not in raw_key:
                 yield 'HTTP_' + key, value.strip()
 
-            key, value = header.split(':', 1)
-            key = key.replace('-', '_').upper()
+            raw_key, value = header.split(':', 1)
+            key = raw_key.replace('-', '_').upper()
 
-        if key not in (None, 'CONTENT_TYPE', 'CONTENT_LENGTH'):
+        if key not in (None, 'CONTENT_TYPE', 'CONTENT_LENGTH') and '_' not in raw_key:
             yield 'HTTP_' + key, value.strip()
 
-    def get_environ(self):
+    def _connection_environ(self):
+        # the part of the environ that is the same for all the requests on this connection
         env = self.server.get_environ()
-        env['REQUEST_METHOD'] = self.command
         env['SCRIPT_NAME'] = ''
+        client_address = self.client_address
+        if isinstance(client_address, tuple):
+            env['REMOTE_ADDR'] = str(client_address[0])
+            env['REMOTE_PORT'] = str(client_address[1])
+        self._base_environ = env
+        return env
+
+    def get_environ(self):
+        env = (self._base_environ or self._connection_environ()).copy()
+        env['REQUEST_METHOD'] = self.command
 
         if '?' in self.path:
             path, query = self.path.split('?', 1)
@@ -556,20 +1921,22 @@ class WSGIHandler(object):
         env['PATH_INFO'] = unquote(path)
         env['QUERY_STRING'] = query
 
-        if self.headers.typeheader is not None:
-            env['CONTENT_TYPE'] = self.headers.typeheader
+        headers = self.headers
+        if headers.typeheader is not None:
+            env['CONTENT_TYPE'] = headers.typeheader
 
-        length = self.headers.getheader('content-length')
+        length = headers.getheader('content-length')
         if length:
             env['CONTENT_LENGTH'] = length
         env['SERVER_PROTOCOL'] = self.request_version
 
-        client_address = self.client_address
-        if isinstance(client_address, tuple):
-            env['REMOTE_ADDR'] = str(client_address[0])
-            env['REMOTE_PORT'] = str(client_address[1])
-
-        for key, value in self._headers():
+        fields = getattr(headers, 'fields', None)
+        if fields is None:
+            # MessageClass is not Headers (e.g. mimetools.Message): parse the raw lines
+            fields = self._headers()
+        for key, value in fields:
+            if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                continue
             if key in env:
                 if 'COOKIE' in key:
                     env[key] += '; ' + value
@@ -578,31 +1945,156 @@ class WSGIHandler(object):
             else:
                 env[key] = value
 
+        if 'HTTP_UPGRADE' in env:
+            websocket = self.make_websocket(env)
+            if websocket is not None:
+                env['wsgi.websocket'] = websocket
+
         if env.get('HTTP_EXPECT') == '100-continue':
             socket = self.socket
         else:
             socket = None
         chunked = env.get('HTTP_TRANSFER_ENCODING', '').lower() == 'chunked'
-        self.wsgi_input = Input(self.rfile, self.content_length, socket=socket, chunked_input=chunked)
+        threshold = self.server.spool_threshold
+        if threshold is not None and (chunked or (self.content_length or 0) > threshold):
+            self.wsgi_input = SpooledInput(self.rfile, self.content_length, socket=socket, chunked_input=chunked,
+                                           threshold=threshold, directory=self.server.spool_dir)
+        else:
+            self.wsgi_input = Input(self.rfile, self.content_length, socket=socket, chunked_input=chunked)
+        if self.server.body_timeout is not None:
+            self.wsgi_input.handler = self
         env['wsgi.input'] = self.wsgi_input
         return env
 
 
+class _ParkedConnection(object):
+    """A keep-alive connection waiting for its next request with just a read watcher (see :attr:`WSGIServer.park_idle`)."""
+
+    __slots__ = ['server', 'socket', 'address', 'requests', 'watcher', 'deadline']
+
+    def __init__(self, server, socket, address, requests=0):
+        self.server = server
+        self.socket = socket
+        self.address = address
+        # the number of requests served on the connection so far, for max_requests
+        self.requests = requests
+        loop = server.loop
+        self.watcher = loop.io(socket.fileno(), 1)
+        self.watcher.start(self._on_readable)
+        if server.idle_timeout is not None:
+            self.deadline = loop.now() + server.idle_timeout
+        else:
+            self.deadline = None
+
+    def _stop(self):
+        self.watcher.stop()
+        self.server._parked.discard(self)
+
+    def _on_readable(self):
+        self._stop()
+        self.server._unpark(self.socket, self.address, self.requests)
+
+    def close(self):
+        self._stop()
+        _close_socket(self.socket)
+
+
 class WSGIServer(StreamServer):
     """A WSGI server based on :class:`StreamServer` that supports HTTPS."""
 
     handler_class = WSGIHandler
+
+    # If true, a keep-alive connection that has no more data to read after a response is parked:
+    # the handler greenlet exits (freeing its slot in the pool) and the connection waits for the next
+    # request with just a read watcher. When the request arrives, a new handler is spawned for it.
+    # SSL connections are never parked.
+    park_idle = False
+
+    # The limits on slow and idle clients, in seconds (None means no limit):
+    # idle_timeout -- how long a keep-alive connection may wait for the next request (parked or not);
+    # header_timeout -- how long the request line and the headers may take to arrive
+    #                   (for the first request on a connection, counted from the moment its handler starts,
+    #                   so the time spent waiting for a free slot, at most max_queue_wait, is not included);
+    # body_timeout -- how long each read of wsgi.input may wait for data.
+    # The connections that exceed them are closed. They are enforced by a single periodic timer per server,
+    # which checks the deadlines the handlers keep, so they do not cost a timer per request.
+    idle_timeout = None
+    header_timeout = None
+    body_timeout = None
+
+    # the maximum number of requests served on a connection; the last response gets "Connection: close"
+    max_requests = None
+
+    # If not None, the request bodies that are chunked or larger than this many bytes get a SpooledInput
+    # as wsgi.input: the bodies above the threshold are written to an unlinked temporary file in spool_dir
+    # (the default temporary directory if None) before the application reads them.
+    spool_threshold = None
+    spool_dir = None
+
+    # the timer that enforces the timeouts
+    _sweeper = None
+
+    # Response compression: if gzip is true, the responses are compressed for the clients that accept gzip
+    # if their Content-Type starts with one of gzip_types and they are not known to be shorter than gzip_min_length.
+    # The bodies known up front (a list of strings or a FileWrapper with Content-Length) of at most gzip_buffer_size
+    # bytes are compressed as a whole and sent with Content-Length; the others are compressed incrementally
+    # as they are written and sent chunked. The bodies of at least gzip_threadpool_size bytes are compressed
+    # in the hub's threadpool. The compressed bodies of up to gzip_cache_size responses with an ETag are kept,
+    # keyed by the path, the query and the ETag, so that the repeated static responses are compressed once.
+    gzip = False
+    gzip_level = 6
+    gzip_min_length = 1024
+    gzip_types = ('text/', 'application/json', 'application/javascript', 'application/xml', 'image/svg+xml')
+    gzip_buffer_size = 1024 * 1024
+    gzip_threadpool_size = 128 * 1024
+    gzip_cache_size = 64
+    _gzip_cache = None
+
+    # the ServerMetrics of this server or None if they are not collected (see enable_metrics())
+    metrics = None
+    # the path at which the metrics are served as text (see enable_metrics())
+    metrics_path = None
+
+    # Load shedding: while the server is overloaded, the new connections are answered with a precomputed
+    # "503 Service Unavailable" (with "Retry-After: 1") and closed without reading the request.
+    # The server becomes overloaded once the event loop lag (see loop_delay) exceeds max_loop_lag seconds
+    # or once max_in_flight requests are being handled, and stops being overloaded only once both
+    # drop below shed_resume times their limits, so that it does not flap around the thresholds.
+    # The connections are shed in the Hub, before a greenlet (or a pool slot) is taken for them.
+    max_loop_lag = None
+    max_in_flight = None
+    shed_resume = 0.5
+    # the number of requests being handled (the idle keep-alive connections are not counted)
+    in_flight = 0
+    # how often the loop lag is sampled, in seconds
+    loop_delay_interval = 0.1
+    # How late a periodic timer fires, in seconds, smoothed over the recent samples (only measured if max_loop_lag
+    # is set). Unlike loop_lag(), which is how long the current loop iteration has been running, it reflects
+    # the recent iterations as well.
+    loop_delay = 0.0
+    # true while the new connections are being rejected
+    overloaded = False
+    # the timer that measures loop_delay
+    _delay_timer = None
+
     base_env = {'GATEWAY_INTERFACE': 'CGI/1.1',
                 'SERVER_SOFTWARE': 'gevent/%d.%d Python/%d.%d' % (gevent.version_info[:2] + sys.version_info[:2]),
                 'SCRIPT_NAME': '',
                 'wsgi.version': (1, 0),
                 'wsgi.multithread': False,
                 'wsgi.multiprocess': False,
-                'wsgi.run_once': False}
+                'wsgi.run_once': False,
+                'wsgi.file_wrapper': FileWrapper,
+                # wsgi.input returns EOF at the end of the request body
+                'wsgi.input_terminated': True}
 
     def __init__(self, listener, application=None, backlog=None, spawn='default', log='default', handler_class=None,
-                 environ=None, **ssl_args):
-        StreamServer.__init__(self, listener, backlog=backlog, spawn=spawn, **ssl_args)
+                 environ=None, listener_options=None, **ssl_args):
+        StreamServer.__init__(self, listener, backlog=backlog, spawn=spawn, listener_options=listener_options, **ssl_args)
+        self.handlers = set()
+        self._parked = set()
+        self._no_handlers = Event()
+        self._no_handlers.set()
         if application is not None:
             self.application = application
         if handler_class is not None:
@@ -653,6 +2145,166 @@ class WSGIServer(StreamServer):
             self.environ.setdefault('SERVER_NAME', '')
             self.environ.setdefault('SERVER_PORT', '')
 
-    def handle(self, socket, address):
+    def handle(self, socket, address, requests=0):
+        if self._sweeper is None:
+            self._start_sweeper()
         handler = self.handler_class(socket, address, self)
-        handler.handle()
+        handler.greenlet = getcurrent()
+        if requests:
+            # a connection coming back from park(): keep counting its requests
+            handler.requests = requests
+        self.handlers.add(handler)
+        self._no_handlers.clear()
+        try:
+            handler.handle()
+        finally:
+            self.handlers.discard(handler)
+            if not self.handlers:
+                self._no_handlers.set()
+
+    def do_handle(self, socket, address, requests=0):
+        if self.max_loop_lag is not None or self.max_in_flight is not None:
+            if self.check_overload():
+                if self.metrics is not None:
+                    self.metrics.shed += 1
+                self._send_and_close(socket, _OVERLOADED_RESPONSE)
+                return
+        StreamServer.do_handle(self, socket, address, requests)
+
+    def enable_metrics(self, path=None):
+        """Start collecting the request metrics into :attr:`metrics` (a :class:`ServerMetrics`) and return it.
+
+        If *path* is given (e.g. ``'/metrics'``), the GET requests for it are answered with
+        :meth:`ServerMetrics.format` instead of being passed to the application.
+        """
+        if self.metrics is None:
+            self.metrics = ServerMetrics(self)
+        self.metrics_path = path
+        return self.metrics
+
+    def stop(self, timeout=None):
+        """Stop accepting the connections and wait for the active requests to finish.
+
+        The connections that are waiting for the next request (idle keep-alive connections) are closed right away.
+        The requests that are being handled complete normally, but their responses get
+        ``Connection: close``. :meth:`stop` returns as soon as all the connections are closed
+        or after *timeout* seconds (default :attr:`stop_timeout`), killing the handlers that are still running.
+        """
+        self.close()
+        if timeout is None:
+            timeout = self.stop_timeout
+        for handler in list(self.handlers):
+            handler.close_if_idle()
+        for connection in list(self._parked):
+            connection.close()
+        self._no_handlers.wait(timeout)
+        if self.handlers:
+            # StreamServer.stop() kills only the greenlets of a pool, so kill the handlers themselves
+            hub = get_hub()
+            for handler in list(self.handlers):
+                if handler.greenlet is not None and handler.greenlet is not hub:
+                    kill(handler.greenlet)
+            self._no_handlers.wait(1)
+        StreamServer.stop(self, timeout=0)
+        if isinstance(self.log, BufferedLog):
+            self.log.flush()
+
+    def park(self, socket, address, requests=0):
+        """Keep the connection open until the next request arrives without holding a greenlet.
+
+        Called by the handler after a response if :attr:`park_idle` is true; *requests* is the number
+        of requests served on the connection so far, passed on to the next handler.
+        """
+        if self.closed:
+            _close_socket(socket)
+            return
+        self._parked.add(_ParkedConnection(self, socket, address, requests))
+        if self._sweeper is None:
+            self._start_sweeper()
+
+    def check_overload(self):
+        """Update and return :attr:`overloaded` (see :attr:`max_loop_lag`)."""
+        if self.max_loop_lag is not None and self._delay_timer is None:
+            self._start_delay_timer()
+        in_flight = self.in_flight
+        if self.overloaded:
+            resume = self.shed_resume
+            if (self.max_loop_lag is None or self.loop_delay <= self.max_loop_lag * resume) and \
+               (self.max_in_flight is None or in_flight <= self.max_in_flight * resume):
+                self.overloaded = False
+        elif (self.max_loop_lag is not None and self.loop_delay > self.max_loop_lag) or \
+             (self.max_in_flight is not None and in_flight >= self.max_in_flight):
+            self.overloaded = True
+        return self.overloaded
+
+    def _start_delay_timer(self):
+        if not self.closed:
+            interval = self.loop_delay_interval
+            self._delay_tick = self.loop.now()
+            self._delay_timer = self.loop.timer(interval, interval, ref=False)
+            self._delay_timer.start(self._measure_delay)
+
+    def _measure_delay(self):
+        now = self.loop.now()
+        lag = max(now - self._delay_tick - self.loop_delay_interval, 0.0)
+        self._delay_tick = now
+        # smooth out the single slow iterations
+        self.loop_delay = 0.5 * self.loop_delay + 0.5 * lag
+
+    def _start_sweeper(self):
+        timeouts = [timeout for timeout in (self.idle_timeout, self.header_timeout, self.body_timeout)
+                    if timeout is not None]
+        if timeouts and not self.closed:
+            interval = min([1.0] + [timeout / 2.0 for timeout in timeouts])
+            self._sweeper = self.loop.timer(interval, interval, ref=False)
+            self._sweeper.start(self._sweep)
+
+    def _sweep(self):
+        now = self.loop.now()
+        expired = [handler for handler in self.handlers if handler.deadline is not None and handler.deadline <= now]
+        for handler in expired:
+            handler.timeout_read()
+        expired = [connection for connection in self._parked if connection.deadline is not None and connection.deadline <= now]
+        for connection in expired:
+            connection.close()
+
+    def close(self):
+        StreamServer.close(self)
+        if self._sweeper is not None:
+            self._sweeper.stop()
+            self._sweeper = None
+        if self._delay_timer is not None:
+            self._delay_timer.stop()
+            self._delay_timer = None
+
+    def _unpark(self, socket, address, requests=0):
+        if self.closed:
+            _close_socket(socket)
+        elif self.full():
+            # wait for a free slot like a new connection would
+            self._enqueue((socket, address, requests))
+        else:
+            try:
+                self.do_handle(socket, address, requests)
+            except:
+                self.loop.handle_error((address, self), *sys.exc_info())
+                _close_socket(socket)
+
+    def reject(self, client_socket, address, requests=0):
+        # called in the Hub, so only a non-blocking send is possible here
+        self._send_and_close(client_socket, _SERVICE_UNAVAILABLE_RESPONSE)
+
+    def _send_and_close(self, client_socket, response):
+        # SSL connections are just closed: they may be not wrapped yet and a non-blocking send is not possible
+        sock = client_socket._sock
+        try:
+            try:
+                if not self.ssl_enabled:
+                    sock.send(response)
+                    # read out the request that has already arrived so that close() does not reset the connection
+                    sock.recv(16384)
+            finally:
+                sock.close()
+                client_socket.close()
+        except socket.error:
+            pass
@@ -0,0 +1,223 @@
+"""Rate limiting primitives.
+
+:class:`TokenBucket` limits how often something happens: the tokens are added at a constant *rate*
+up to the *capacity* of the bucket, and each operation takes some. :class:`Limiter` adds a limit
+on the number of operations in progress.
+
+    bucket = TokenBucket(100)    # 100 calls per second
+    for request in requests:
+        bucket.acquire()
+        pool.spawn(send, request)
+
+The greenlets waiting for tokens are served in the order they came, and they are woken up by a single
+timer armed for the moment the first of them can go, rather than each polling with :func:`gevent.sleep`.
+"""
+import sys
+from collections import deque
+from time import time
+
+from gevent.hub import get_hub, getcurrent
+from gevent.timeout import Timeout
+from gevent.lock import Semaphore, DummySemaphore
+
+
+__all__ = ['TokenBucket', 'Limiter']
+
+
+class _Waiter(object):
+    __slots__ = ['switch', 'tokens', 'granted']
+
+    def __init__(self, switch, tokens):
+        self.switch = switch
+        self.tokens = tokens
+        # true once the timer has taken the tokens for the waiter
+        self.granted = False
+
+
+class TokenBucket(object):
+    """A bucket filled with *rate* tokens per second, holding at most *capacity* tokens (*rate* by default).
+
+    The bucket starts full, so up to *capacity* tokens can be taken at once (a burst); after that,
+    the tokens can be taken only as fast as they are added.
+    """
+
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise ValueError('rate must be positive: %r' % (rate, ))
+        if capacity is None:
+            capacity = rate
+        elif capacity <= 0:
+            raise ValueError('capacity must be positive: %r' % (capacity, ))
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = self.capacity
+        # the loop time when _tokens was computed; we don't want to do get_hub() here
+        # to allow module-level buckets without initializing the hub
+        self._updated = None
+        self._waiters = deque()
+        self._timer = None
+
+    def __str__(self):
+        params = (self.__class__.__name__, self.rate, self.capacity, self.tokens, len(self._waiters))
+        return '<%s rate=%s capacity=%s tokens=%.2f _waiters[%s]>' % params
+
+    @property
+    def tokens(self):
+        """The number of tokens available now."""
+        self._refill()
+        return self._tokens
+
+    def _refill(self):
+        now = get_hub().loop.now()
+        if self._updated is not None:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, tokens=1, blocking=True, timeout=None):
+        """Take *tokens* from the bucket, waiting for them if necessary. Return ``True`` on success.
+
+        If *blocking* is ``False``, or if the tokens are not available within *timeout* seconds, return ``False``.
+        A call does not overtake the greenlets already waiting, even if the tokens it asks for are available.
+        """
+        if tokens > self.capacity:
+            raise ValueError('Cannot take more tokens than the capacity of the bucket: %r' % (tokens, ))
+        self._refill()
+        waiters = self._waiters
+        if not waiters and self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        if not blocking:
+            return False
+        waiter = _Waiter(getcurrent().switch, tokens)
+        waiters.append(waiter)
+        if len(waiters) == 1:
+            self._schedule()
+        timer = Timeout.start_new(timeout)
+        try:
+            try:
+                result = get_hub().switch()
+                assert result is self, 'Invalid switch into TokenBucket.acquire(): %r' % (result, )
+            except:
+                if waiter.granted:
+                    # timed out or killed after the timer took the tokens but before getting them: put them back
+                    self._refill()
+                    self._tokens = min(self.capacity, self._tokens + tokens)
+                    self._schedule()
+                # timed out or killed: give up the place in the queue (the tokens were not taken)
+                elif waiters and waiters[0] is waiter:
+                    waiters.popleft()
+                    self._schedule()
+                else:
+                    try:
+                        waiters.remove(waiter)
+                    except ValueError:
+                        pass
+                ex = sys.exc_info()[1]
+                if ex is timer:
+                    return False
+                raise
+        finally:
+            timer.cancel()
+        return True
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *args):
+        pass
+
+    def _schedule(self):
+        # arm the timer for the moment the first waiter can take its tokens
+        if self._timer is not None:
+            self._timer.stop()
+            self._timer = None
+        if self._waiters:
+            self._refill()
+            delay = max(0.0, (self._waiters[0].tokens - self._tokens) / self.rate)
+            self._timer = get_hub().loop.timer(delay)
+            self._timer.start(self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._refill()
+        waiters = self._waiters
+        ready = []
+        while waiters and waiters[0].tokens <= self._tokens:
+            waiter = waiters.popleft()
+            self._tokens -= waiter.tokens
+            waiter.granted = True
+            ready.append(waiter)
+        self._schedule()
+        for waiter in ready:
+            try:
+                waiter.switch(self)
+            except:
+                getcurrent().handle_error((waiter.switch, self), *sys.exc_info())
+
+
+class Limiter(object):
+    """Limit both the rate at which operations start (*rate* per second, in bursts of up to *burst*)
+    and the number of operations in progress (*concurrency*). Either limit can be ``None``.
+
+        limiter = Limiter(rate=50, concurrency=10)
+        with limiter:
+            call_backend()
+
+    :meth:`spawn` composes it with a pool: ``limiter.spawn(pool.spawn, call_backend)``.
+    """
+
+    def __init__(self, rate=None, concurrency=None, burst=None):
+        if rate is None:
+            self.bucket = None
+        else:
+            self.bucket = TokenBucket(rate, burst)
+        if concurrency is None:
+            self.semaphore = DummySemaphore()
+        else:
+            self.semaphore = Semaphore(concurrency)
+
+    def acquire(self, blocking=True, timeout=None):
+        """Wait for a free slot and then for a token. Return ``True`` on success.
+
+        If *blocking* is ``False``, or if both are not available within *timeout* seconds, return ``False``.
+        Each successful call must be matched by :meth:`release`.
+        """
+        if timeout is not None:
+            deadline = time() + timeout
+        if self.semaphore.acquire(blocking, timeout) is False:
+            return False
+        if self.bucket is not None:
+            if timeout is not None:
+                timeout = max(0.0, deadline - time())
+            if not self.bucket.acquire(1, blocking, timeout):
+                self.semaphore.release()
+                return False
+        return True
+
+    def release(self):
+        """Give back the slot taken by :meth:`acquire`."""
+        self.semaphore.release()
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+    def spawn(self, spawn, function, *args, **kwargs):
+        """Wait until the limits allow another call and start ``function(*args, **kwargs)``
+        with *spawn* (:meth:`gevent.pool.Pool.spawn`, :func:`gevent.spawn`, ...).
+
+        The slot is released when the greenlet finishes.
+        """
+        self.acquire()
+        try:
+            greenlet = spawn(function, *args, **kwargs)
+        except:
+            self.release()
+            raise
+        greenlet.rawlink(self._on_finished)
+        return greenlet
+
+    def _on_finished(self, greenlet):
+        self.release()
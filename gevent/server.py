@@ -15,6 +15,30 @@ if sys.platform == 'win32':
 else:
     DEFAULT_REUSE_ADDR = 1
 
+if sys.platform.startswith('linux'):
+    # older Pythons do not export these even though the kernel supports them
+    SO_REUSEPORT = getattr(_socket, 'SO_REUSEPORT', 15)
+    TCP_FASTOPEN = getattr(_socket, 'TCP_FASTOPEN', 23)
+else:
+    SO_REUSEPORT = getattr(_socket, 'SO_REUSEPORT', None)
+    TCP_FASTOPEN = getattr(_socket, 'TCP_FASTOPEN', None)
+TCP_DEFER_ACCEPT = getattr(_socket, 'TCP_DEFER_ACCEPT', None)
+# the families of the sockets that TCP_NODELAY applies to
+_TCP_FAMILIES = tuple(getattr(_socket, name) for name in ('AF_INET', 'AF_INET6') if hasattr(_socket, name))
+
+
+class _classorinstancemethod(object):
+    # Like classmethod, but called on an instance it gets the instance: this way get_listener() keeps
+    # working on the class and still sees the listener options set for a single server.
+
+    def __init__(self, func):
+        self.func = func
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            obj = cls
+        return self.func.__get__(obj, cls)
+
 
 class StreamServer(BaseServer):
     """A generic TCP server. Accepts connections on a listening socket and spawns user-provided *handle*
@@ -38,15 +62,37 @@ class StreamServer(BaseServer):
 
     The delay starts with :attr:`min_delay` and doubles with each successive error until it reaches :attr:`max_delay`.
     A successful :func:`accept` resets the delay to :attr:`min_delay` again.
+
+    The kernel-level behaviour of the listening and the accepted sockets can be tuned with
+    the class attributes listed in :attr:`listener_options`. They can be overridden in a subclass
+    or for a single server by passing *listener_options*, a dictionary that maps the attribute
+    names to values. ``None`` leaves the operating system default in place. All the options except
+    *nodelay* affect the listening socket, so they can only be used when the server creates it.
     """
     # the default backlog to use if none was provided in __init__
     backlog = 256
 
     reuse_addr = DEFAULT_REUSE_ADDR
 
-    def __init__(self, listener, handle=None, backlog=None, spawn='default', **ssl_args):
+    # SO_REUSEPORT: let several processes bind to the same address and have the kernel balance between them
+    reuse_port = None
+    # TCP_DEFER_ACCEPT: the number of seconds to wait for the client data before reporting the connection (Linux)
+    defer_accept = None
+    # TCP_FASTOPEN: the length of the queue of the pending TCP Fast Open requests
+    fastopen = None
+    # SO_RCVBUF and SO_SNDBUF of the listening socket; the accepted sockets inherit them
+    rcvbuf = None
+    sndbuf = None
+    # TCP_NODELAY on every accepted TCP socket
+    nodelay = None
+
+    listener_options = ('reuse_addr', 'reuse_port', 'defer_accept', 'fastopen', 'rcvbuf', 'sndbuf', 'nodelay')
+
+    def __init__(self, listener, handle=None, backlog=None, spawn='default', listener_options=None, **ssl_args):
         BaseServer.__init__(self, listener, handle=handle, spawn=spawn)
         try:
+            if listener_options:
+                self.set_listener_options(listener_options)
             if ssl_args:
                 ssl_args.setdefault('server_side', True)
                 from gevent.ssl import wrap_socket
@@ -66,6 +112,14 @@ class StreamServer(BaseServer):
     def ssl_enabled(self):
         return self.ssl_args is not None
 
+    def set_listener_options(self, options):
+        for name, value in options.items():
+            if name not in self.listener_options:
+                raise TypeError('Unexpected listener option: %r' % (name, ))
+            if name != 'nodelay' and hasattr(self, 'socket'):
+                raise TypeError('%s must be None when a socket instance is passed' % (name, ))
+            setattr(self, name, value)
+
     def set_listener(self, listener):
         BaseServer.set_listener(self, listener)
         try:
@@ -82,11 +136,15 @@ class StreamServer(BaseServer):
         else:
             self._handle = self.handle
 
-    @classmethod
+    @_classorinstancemethod
     def get_listener(self, address, backlog=None, family=None):
         if backlog is None:
             backlog = self.backlog
-        return _tcp_listener(address, backlog=backlog, reuse_addr=self.reuse_addr, family=family)
+        if family is None:
+            family = _socket.AF_INET
+        return _tcp_listener(address, backlog=backlog, reuse_addr=self.reuse_addr, family=family,
+                             reuse_port=self.reuse_port, defer_accept=self.defer_accept, fastopen=self.fastopen,
+                             rcvbuf=self.rcvbuf, sndbuf=self.sndbuf)
 
     def do_read(self):
         try:
@@ -95,6 +153,8 @@ class StreamServer(BaseServer):
             if err[0] == EWOULDBLOCK:
                 return
             raise
+        if self.nodelay and client_socket.family in _TCP_FAMILIES:
+            client_socket.setsockopt(_socket.IPPROTO_TCP, _socket.TCP_NODELAY, 1)
         return socket(_sock=client_socket), address
 
     def wrap_socket_and_handle(self, client_socket, address):
@@ -144,11 +204,18 @@ class DatagramServer(BaseServer):
             self._writelock.release()
 
 
-def _tcp_listener(address, backlog=50, reuse_addr=None, family=_socket.AF_INET):
+def _tcp_listener(address, backlog=50, reuse_addr=None, family=_socket.AF_INET, reuse_port=None,
+                  defer_accept=None, fastopen=None, rcvbuf=None, sndbuf=None):
     """A shortcut to create a TCP socket, bind it and put it into listening state."""
     sock = socket(family=family)
     if reuse_addr is not None:
         sock.setsockopt(_socket.SOL_SOCKET, _socket.SO_REUSEADDR, reuse_addr)
+    if reuse_port is not None:
+        _setsockopt(sock, _socket.SOL_SOCKET, SO_REUSEPORT, 'SO_REUSEPORT', reuse_port)
+    if rcvbuf is not None:
+        sock.setsockopt(_socket.SOL_SOCKET, _socket.SO_RCVBUF, rcvbuf)
+    if sndbuf is not None:
+        sock.setsockopt(_socket.SOL_SOCKET, _socket.SO_SNDBUF, sndbuf)
     try:
         sock.bind(address)
     except _socket.error:
@@ -157,11 +224,22 @@ def _tcp_listener(address, backlog=50, reuse_addr=None, family=_socket.AF_INET):
         if strerror is not None:
             ex.strerror = strerror + ': ' + repr(address)
         raise
+    if defer_accept is not None:
+        _setsockopt(sock, _socket.IPPROTO_TCP, TCP_DEFER_ACCEPT, 'TCP_DEFER_ACCEPT', defer_accept)
+    if fastopen is not None:
+        _setsockopt(sock, _socket.IPPROTO_TCP, TCP_FASTOPEN, 'TCP_FASTOPEN', fastopen)
     sock.listen(backlog)
     sock.setblocking(0)
     return sock
 
 
+def _setsockopt(sock, level, option, name, value):
+    if option is None:
+        sock.close()
+        raise ValueError('%s is not supported on this platform' % name)
+    sock.setsockopt(level, option, value)
+
+
 def _udp_socket(address, backlog=50, reuse_addr=None, family=_socket.AF_INET):
     # we want gevent.socket.socket here
     sock = socket(family=family, type=_socket.SOCK_DGRAM)
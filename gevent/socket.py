@@ -83,7 +83,7 @@ __imports__ = ['error',
 
 import sys
 import time
-from gevent.hub import get_hub, string_types, integer_types
+from gevent.hub import get_hub, string_types, integer_types, GreenletExit
 from gevent.timeout import Timeout
 
 is_windows = sys.platform == 'win32'
@@ -551,8 +551,11 @@ try:
 except AttributeError:
     _GLOBAL_DEFAULT_TIMEOUT = object()
 
+# the "Connection Attempt Delay" recommended by RFC 8305
+HAPPY_EYEBALLS_DELAY = 0.25
 
-def create_connection(address, timeout=_GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+
+def create_connection(address, timeout=_GLOBAL_DEFAULT_TIMEOUT, source_address=None, happy_eyeballs_delay=None):
     """Connect to *address* and return the socket object.
 
     Convenience function.  Connect to *address* (a 2-tuple ``(host,
@@ -563,11 +566,20 @@ def create_connection(address, timeout=_GLOBAL_DEFAULT_TIMEOUT, source_address=N
     is used. If *source_address* is set it must be a tuple of (host, port)
     for the socket to bind as a source address before making the connection.
     An host of '' or port 0 tells the OS to use the default.
+
+    If *happy_eyeballs_delay* is not ``None``, the addresses returned by :func:`getaddrinfo`
+    are tried concurrently, as described in :rfc:`8305`: the address families are interleaved
+    and a new attempt is started in a separate greenlet every *happy_eyeballs_delay* seconds
+    (or as soon as the previous attempt fails). The first connected socket is returned and
+    the other attempts are cancelled. :data:`HAPPY_EYEBALLS_DELAY` is the recommended value.
     """
 
     host, port = address
     err = None
-    for res in getaddrinfo(host, port, 0 if has_ipv6 else AF_INET, SOCK_STREAM):
+    addrinfo = getaddrinfo(host, port, 0 if has_ipv6 else AF_INET, SOCK_STREAM)
+    if happy_eyeballs_delay is not None and len(addrinfo) > 1:
+        return _happy_eyeballs_connect(_interleave_addrinfo(addrinfo), timeout, source_address, happy_eyeballs_delay)
+    for res in addrinfo:
         af, socktype, proto, _canonname, sa = res
         sock = None
         try:
@@ -593,6 +605,87 @@ def create_connection(address, timeout=_GLOBAL_DEFAULT_TIMEOUT, source_address=N
         raise error("getaddrinfo returns an empty list")
 
 
+def _interleave_addrinfo(addrinfo):
+    """Reorder *addrinfo* so that the address families alternate, starting with the first one returned."""
+    families = []
+    by_family = {}
+    for res in addrinfo:
+        family = res[0]
+        if family not in by_family:
+            families.append(family)
+            by_family[family] = []
+        by_family[family].append(res)
+    result = []
+    while families:
+        for family in families[:]:
+            items = by_family[family]
+            result.append(items.pop(0))
+            if not items:
+                families.remove(family)
+    return result
+
+
+def _connect_attempt(res, timeout, source_address, results):
+    af, socktype, proto, _canonname, sa = res
+    sock = None
+    try:
+        sock = socket(af, socktype, proto)
+        if timeout is not _GLOBAL_DEFAULT_TIMEOUT:
+            sock.settimeout(timeout)
+        if source_address:
+            sock.bind(source_address)
+        sock.connect(sa)
+    except GreenletExit:
+        # killed because another attempt has already won
+        if sock is not None:
+            sock.close()
+        raise
+    except:
+        # any other error is reported to _happy_eyeballs_connect, which re-raises it unless it is a socket.error
+        ex = sys.exc_info()[1]
+        sys.exc_clear()
+        if sock is not None:
+            sock.close()
+        results.put((None, ex))
+    else:
+        results.put((sock, None))
+
+
+def _happy_eyeballs_connect(addrinfo, timeout, source_address, delay):
+    from gevent.greenlet import Greenlet, killall
+    from gevent.queue import Queue, Empty
+    results = Queue()
+    attempts = []
+    running = 0
+    err = None
+    addrinfo = list(addrinfo)
+    addrinfo.reverse()
+    try:
+        while addrinfo or running:
+            if addrinfo:
+                attempts.append(Greenlet.spawn(_connect_attempt, addrinfo.pop(), timeout, source_address, results))
+                running += 1
+            try:
+                # while there are addresses left, wait at most *delay* seconds before starting the next attempt
+                sock, ex = results.get(timeout=delay if addrinfo else None)
+            except Empty:
+                continue
+            running -= 1
+            if sock is not None:
+                return sock
+            if not isinstance(ex, error):
+                raise ex
+            err = ex
+    finally:
+        killall([attempt for attempt in attempts if not attempt.dead])
+        # the attempts that succeeded after the winner are not needed
+        while not results.empty():
+            sock, ex = results.get()
+            if sock is not None:
+                sock.close()
+    raise err
+
+
 class BlockingResolver(object):
 
     def __init__(self, hub=None):
@@ -249,8 +249,12 @@ class ThreadPool(object):
             kwds = {}
         return Greenlet.spawn(self.apply_cb, func, args, kwds, callback)
 
-    def map(self, func, iterable):
-        return list(self.imap(func, iterable))
+    def map(self, func, iterable, chunksize=None):
+        """Return the list of ``func(item)`` for each item of *iterable*.
+
+        With *chunksize*, *iterable* is split into lists of that many items and each list is
+        a single task for the threads, which saves the per-item overhead for many small items."""
+        return list(self.imap(func, iterable, chunksize=chunksize))
 
     def map_cb(self, func, iterable, callback=None):
         result = self.map(func, iterable)
@@ -267,14 +271,14 @@ class ThreadPool(object):
         """
         return Greenlet.spawn(self.map_cb, func, iterable, callback)
 
-    def imap(self, func, iterable):
-        """An equivalent of itertools.imap()"""
-        return IMap.spawn(func, iterable, spawn=self.spawn)
+    def imap(self, func, iterable, maxsize=None, chunksize=None):
+        """An equivalent of itertools.imap(); see :meth:`gevent.pool.Group.imap` for *maxsize* and *chunksize*."""
+        return IMap.spawn(func, iterable, spawn=self.spawn, maxsize=maxsize, chunksize=chunksize)
 
-    def imap_unordered(self, func, iterable):
+    def imap_unordered(self, func, iterable, maxsize=None, chunksize=None):
         """The same as imap() except that the ordering of the results from the
         returned iterator should be considered in arbitrary order."""
-        return IMapUnordered.spawn(func, iterable, spawn=self.spawn)
+        return IMapUnordered.spawn(func, iterable, spawn=self.spawn, maxsize=maxsize, chunksize=chunksize)
 
 
 class ThreadResult(object):
@@ -0,0 +1,318 @@
+"""WebSocket (:rfc:`6455`) support for :mod:`gevent.pywsgi`.
+
+When a request asks to upgrade the connection to WebSocket, :class:`gevent.pywsgi.WSGIHandler` puts
+a :class:`WebSocket` instance into the environ as ``environ['wsgi.websocket']``. The handshake is
+completed when the application first uses it (or calls :meth:`WebSocket.accept`). After that,
+the connection belongs to the WebSocket: the response returned by the application is discarded
+and the connection is closed when the application returns.
+
+    def application(environ, start_response):
+        ws = environ.get('wsgi.websocket')
+        if ws is None:
+            start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+            return ['WebSocket expected']
+        while True:
+            message = ws.receive()
+            if message is None:
+                break
+            ws.send(message)
+        return []
+"""
+import base64
+import hashlib
+import struct
+import sys
+from array import array
+
+from gevent import socket
+from gevent.lock import Semaphore
+
+
+__all__ = ['WebSocket', 'WebSocketError']
+
+
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+
+GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+_OPCODES = (OPCODE_CONTINUATION, OPCODE_TEXT, OPCODE_BINARY, OPCODE_CLOSE, OPCODE_PING, OPCODE_PONG)
+
+CLOSE_NORMAL = 1000
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_INVALID_DATA = 1007
+CLOSE_TOO_BIG = 1009
+
+# frames with smaller payloads are sent with a single sendall() together with their header
+_COPY_THRESHOLD = 16384
+
+# the array typecode of the 32-bit words that the payloads are unmasked by
+if array('I').itemsize == 4:
+    _WORD = 'I'
+else:
+    _WORD = 'L'
+
+
+class WebSocketError(Exception):
+    """Raised when the peer violates the protocol or when sending on a closed :class:`WebSocket`.
+
+    :attr:`code` is the close status code sent to the peer."""
+
+    def __init__(self, code, reason):
+        Exception.__init__(self, reason)
+        self.code = code
+
+
+class _ConnectionLost(Exception):
+    pass
+
+
+def accept_key(key):
+    """Return the value of the ``Sec-WebSocket-Accept`` header for the client's ``Sec-WebSocket-Key``."""
+    return base64.b64encode(hashlib.sha1(key + GUID).digest())
+
+
+def mask(data, key):
+    """Return *data* XORed with the 4-byte *key* repeated (the masking of the client frames).
+
+    The buffer is XORed a 32-bit word at a time; only the last 0-3 bytes are done one by one."""
+    length = len(data)
+    if not length:
+        return ''
+    tail = length % 4
+    words = array(_WORD, data[:length - tail])
+    # both are in the native byte order, so the word XOR matches the bytewise one
+    key_word = array(_WORD, key)[0]
+    result = array(_WORD, [word ^ key_word for word in words]).tostring()
+    if tail:
+        result += ''.join([chr(ord(byte) ^ ord(key_byte)) for byte, key_byte in zip(data[-tail:], key)])
+    return result
+
+
+class WebSocket(object):
+    """A server side WebSocket connection; see the module description.
+
+    Messages are received with :meth:`receive` and sent with :meth:`send`. Pings from the peer are
+    answered automatically. The frames are written with the cooperative :meth:`socket.sendall`,
+    so a sender blocks (without blocking the other greenlets) while the peer does not keep up;
+    concurrent senders are serialized, so their frames never interleave.
+    """
+
+    # The maximum size of a message after its fragments are put together.
+    # A larger message closes the connection with status 1009.
+    max_message_size = 16 * 1024 * 1024
+
+    def __init__(self, handler, key, protocols=()):
+        self.handler = handler
+        self.socket = handler.socket
+        self.rfile = handler.rfile
+        self.key = key
+        # the subprotocols requested by the client, in the order of preference
+        self.protocols = list(protocols)
+        self.protocol = None
+        self.accepted = False
+        self.closed = False
+        # the status code and the reason of the close, from whichever side closed first
+        self.close_code = None
+        self.close_reason = None
+        self._send_lock = Semaphore()
+
+    def accept(self, protocol=None):
+        """Complete the handshake, choosing the subprotocol *protocol* (one of :attr:`protocols`).
+
+        Called automatically on the first :meth:`receive` or :meth:`send`."""
+        if self.accepted:
+            return
+        if protocol is not None and protocol not in self.protocols:
+            raise ValueError('Subprotocol was not requested by the client: %r' % (protocol, ))
+        headers = [('Upgrade', 'websocket'),
+                   ('Connection', 'Upgrade'),
+                   ('Sec-WebSocket-Accept', accept_key(self.key))]
+        if protocol is not None:
+            headers.append(('Sec-WebSocket-Protocol', protocol))
+        self.handler.upgrade('101 Switching Protocols', headers)
+        self.protocol = protocol
+        self.accepted = True
+
+    def receive(self):
+        """Return the next message: :class:`unicode` for a text message, :class:`str` for a binary one.
+
+        Return ``None`` once the connection is closed, either by the peer or because of a protocol error
+        (see :attr:`close_code`)."""
+        if not self.accepted:
+            self.accept()
+        if self.closed:
+            return None
+        fragments = []
+        size = 0
+        opcode = None
+        try:
+            while True:
+                fin, frame_opcode, payload = self._read_frame()
+                if frame_opcode >= OPCODE_CLOSE:
+                    if frame_opcode == OPCODE_CLOSE:
+                        self._on_close(payload)
+                        return None
+                    if frame_opcode == OPCODE_PING:
+                        self._send_frame(payload, OPCODE_PONG)
+                    continue
+                if frame_opcode == OPCODE_CONTINUATION:
+                    if opcode is None:
+                        raise WebSocketError(CLOSE_PROTOCOL_ERROR, 'Unexpected continuation frame')
+                elif opcode is not None:
+                    raise WebSocketError(CLOSE_PROTOCOL_ERROR, 'Expected a continuation frame')
+                else:
+                    opcode = frame_opcode
+                fragments.append(payload)
+                size += len(payload)
+                if size > self.max_message_size:
+                    raise WebSocketError(CLOSE_TOO_BIG, 'Message is too big')
+                if fin:
+                    break
+            if len(fragments) == 1:
+                message = fragments[0]
+            else:
+                message = ''.join(fragments)
+            if opcode == OPCODE_TEXT:
+                try:
+                    message = message.decode('utf-8')
+                except UnicodeDecodeError:
+                    raise WebSocketError(CLOSE_INVALID_DATA, 'Invalid UTF-8 in a text message')
+            return message
+        except WebSocketError:
+            ex = sys.exc_info()[1]
+            self.close(ex.code, str(ex))
+            return None
+        except (_ConnectionLost, socket.error):
+            self.closed = True
+            sys.exc_clear()
+            return None
+
+    def send(self, message, binary=None):
+        """Send *message* in a single frame.
+
+        Unless *binary* says otherwise, :class:`unicode` is sent as a text message (encoded to UTF-8)
+        and :class:`str` as a binary one."""
+        if binary is None:
+            binary = not isinstance(message, text_type)
+        if isinstance(message, text_type):
+            message = message.encode('utf-8')
+        if binary:
+            self._send_frame(message, OPCODE_BINARY)
+        else:
+            self._send_frame(message, OPCODE_TEXT)
+
+    def send_fragments(self, fragments, binary=False):
+        """Send the strings from the iterable *fragments* as a single fragmented message.
+
+        The message does not have to be held in memory as a whole. Other greenlets cannot send
+        frames while it is being sent."""
+        opcode = OPCODE_BINARY if binary else OPCODE_TEXT
+        self._send_lock.acquire()
+        try:
+            previous = None
+            for fragment in fragments:
+                if isinstance(fragment, text_type):
+                    fragment = fragment.encode('utf-8')
+                if previous is not None:
+                    self._write_frame(previous, opcode, False)
+                    opcode = OPCODE_CONTINUATION
+                previous = fragment
+            self._write_frame(previous or '', opcode, True)
+        finally:
+            self._send_lock.release()
+
+    def ping(self, data=''):
+        """Send a ping; the peer's pong is consumed by :meth:`receive`."""
+        self._send_frame(data, OPCODE_PING)
+
+    def close(self, code=CLOSE_NORMAL, reason=''):
+        """Send a close frame with *code* and *reason*. The TCP connection is closed when the application returns."""
+        if self.closed:
+            return
+        if self.close_code is None:
+            self.close_code = code
+            self.close_reason = reason
+        if self.accepted:
+            if isinstance(reason, text_type):
+                reason = reason.encode('utf-8')
+            try:
+                self._send_frame(struct.pack('!H', code) + reason[:123], OPCODE_CLOSE)
+            except socket.error:
+                sys.exc_clear()
+        self.closed = True
+
+    def _on_close(self, payload):
+        code = CLOSE_NORMAL
+        if len(payload) >= 2:
+            code = struct.unpack('!H', payload[:2])[0]
+            self.close_code = code
+            self.close_reason = payload[2:]
+        elif payload:
+            code = CLOSE_PROTOCOL_ERROR
+        self.close(code)
+
+    def _read(self, size):
+        data = self.rfile.read(size)
+        if len(data) < size:
+            raise _ConnectionLost
+        return data
+
+    def _read_frame(self):
+        first, second = struct.unpack('!BB', self._read(2))
+        fin = first & 0x80
+        opcode = first & 0x0F
+        if first & 0x70:
+            raise WebSocketError(CLOSE_PROTOCOL_ERROR, 'Reserved bits are set')
+        if opcode not in _OPCODES:
+            raise WebSocketError(CLOSE_PROTOCOL_ERROR, 'Unknown opcode: %s' % opcode)
+        if not second & 0x80:
+            raise WebSocketError(CLOSE_PROTOCOL_ERROR, 'Client frames must be masked')
+        length = second & 0x7F
+        if opcode >= OPCODE_CLOSE and (length > 125 or not fin):
+            raise WebSocketError(CLOSE_PROTOCOL_ERROR, 'Invalid control frame')
+        if length == 126:
+            length = struct.unpack('!H', self._read(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self._read(8))[0]
+        if length > self.max_message_size:
+            raise WebSocketError(CLOSE_TOO_BIG, 'Message is too big')
+        key = self._read(4)
+        return fin, opcode, mask(self._read(length), key)
+
+    def _send_frame(self, payload, opcode):
+        self._send_lock.acquire()
+        try:
+            self._write_frame(payload, opcode, True)
+        finally:
+            self._send_lock.release()
+
+    def _write_frame(self, payload, opcode, fin):
+        if self.closed:
+            raise WebSocketError(self.close_code, 'WebSocket is closed')
+        if not self.accepted:
+            self.accept()
+        first = opcode
+        if fin:
+            first |= 0x80
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', first, length)
+        elif length < 65536:
+            header = struct.pack('!BBH', first, 126, length)
+        else:
+            header = struct.pack('!BBQ', first, 127, length)
+        if length < _COPY_THRESHOLD:
+            self.socket.sendall(header + payload)
+        else:
+            self.socket.sendall(header)
+            self.socket.sendall(payload)
@@ -0,0 +1,50 @@
+"""Benchmarking the killing of many greenlets: Group.kill(), killall() and kill() one by one.
+
+USAGE: python bench_killall.py [N ...]   (the default is 10000 100000 1000000)
+"""
+import sys
+from time import time
+
+import gevent
+from gevent.pool import Group
+
+
+def spawn(n):
+    greenlets = [gevent.spawn(gevent.sleep, 100) for _ in range(n)]
+    gevent.sleep(0)
+    return greenlets
+
+
+def bench_group_kill(n):
+    group = Group(spawn(n))
+    start = time()
+    group.kill()
+    return time() - start
+
+
+def bench_killall(n):
+    greenlets = spawn(n)
+    start = time()
+    gevent.killall(greenlets)
+    return time() - start
+
+
+def bench_kill_each(n):
+    greenlets = spawn(n)
+    start = time()
+    for greenlet in greenlets:
+        greenlet.kill(block=False)
+    gevent.joinall(greenlets)
+    return time() - start
+
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [10000, 100000, 1000000]
+    for n in sizes:
+        for bench in (bench_group_kill, bench_killall, bench_kill_each):
+            delta = bench(n)
+            print('%s(%s): %.3f seconds, %.2f microseconds per greenlet' % (bench.__name__[6:], n, delta, delta * 1000000.0 / n))
+
+
+if __name__ == '__main__':
+    main()
@@ -115,6 +115,61 @@ class Test(greentest.TestCase):
         p1.kill(SpecialError)
         p2.kill(SpecialError)
 
+    def test_kill_many(self):
+        s = pool.Group([gevent.spawn(gevent.sleep, 10) for _ in range(1000)])
+        greenlets = list(s)
+        s.spawn(gevent.sleep, 10)
+        s.kill()
+        assert not s, s
+        assert not s.dying, s.dying
+        for g in greenlets:
+            assert g.dead, g
+
+    def test_kill_waits_for_undead(self):
+        s = pool.Group()
+
+        def slow_death():
+            try:
+                gevent.sleep(10)
+            except gevent.GreenletExit:
+                gevent.sleep(DELAY)
+
+        p1 = s.spawn(slow_death)
+        p2 = s.spawn(slow_death)
+        gevent.sleep(0)
+        start = time.time()
+        s.kill()
+        assert DELAY * 0.9 <= time.time() - start < DELAY * 3, time.time() - start
+        assert p1.dead and p2.dead
+        assert not s, s
+
+    def test_killall_waits_for_undead(self):
+        def slow_death():
+            try:
+                gevent.sleep(10)
+            except gevent.GreenletExit:
+                gevent.sleep(DELAY)
+
+        greenlets = [gevent.spawn(slow_death) for _ in range(3)] + [gevent.spawn(gevent.sleep, 10)]
+        gevent.sleep(0)
+        start = time.time()
+        gevent.killall(greenlets)
+        assert DELAY * 0.9 <= time.time() - start < DELAY * 3, time.time() - start
+        for g in greenlets:
+            assert g.dead, g
+
+    def test_killall_timeout_unlinks(self):
+        undead = Undead()
+        g = gevent.spawn(undead)
+        gevent.sleep(0)
+        links = list(g._links)
+        for _ in range(3):
+            self.assertRaises(gevent.Timeout, gevent.killall, [g], timeout=DELAY / 10.)
+        assert not g.dead, g
+        self.assertEqual(list(g._links), links)
+        g.kill(SpecialError)
+        assert g.dead, g
+
     def test_killall_subclass(self):
         p1 = GreenletSubclass.spawn(lambda: 1 / 0)
         p2 = GreenletSubclass.spawn(lambda: gevent.sleep(10))
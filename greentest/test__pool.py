@@ -1,4 +1,6 @@
 
+import sys
+import traceback
 from time import time
 import gevent
 from gevent import pool
@@ -286,6 +288,68 @@ class TestPool(greentest.TestCase):
             self.assertEqual(six.advance_iterator(it), i * i)
         self.assertRaises(StopIteration, lambda: six.advance_iterator(it))
 
+    def test_imap_maxsize(self):
+        for imap in (self.pool.imap, self.pool.imap_unordered):
+            taken = []
+
+            def items():
+                for i in range(20):
+                    taken.append(i)
+                    yield i
+
+            it = imap(sqr_random_sleep, items(), maxsize=3)
+            results = []
+            for value in it:
+                # the iterable is consumed no further than 3 items ahead of the consumed results
+                assert len(taken) <= len(results) + 1 + 3, (len(taken), len(results))
+                results.append(value)
+                gevent.sleep(0.001)
+            self.assertEqual(sorted(results), list(map(squared, list(range(20)))))
+        self.assertRaises(ValueError, self.pool.imap, sqr, [], maxsize=0)
+
+    def test_imap_maxsize_close(self):
+        for imap in (self.pool.imap, self.pool.imap_unordered):
+            taken = []
+
+            def items():
+                for i in range(20):
+                    taken.append(i)
+                    yield i
+
+            with imap(sqr, items(), maxsize=2) as it:
+                self.assertEqual(next(it), 0)
+                gevent.sleep(0.01)
+            assert it.dead, it
+            # the iteration ends after the results already taken
+            self.assertEqual(sorted(it), list(map(squared, taken[1:])))
+            assert len(taken) <= 3, taken
+            gevent.sleep(0.01)
+            assert len(taken) <= 3, taken
+
+    def test_map_chunksize(self):
+        calls = []
+
+        def record(x):
+            calls.append(x)
+            return x * x
+
+        for chunksize in (1, 3, 7, 1000):
+            self.assertEqual(self.pool.map(record, range(100), chunksize=chunksize), [x * x for x in range(100)])
+        self.assertEqual(len(calls), 400)
+        self.assertEqual(self.pool.map(record, [], chunksize=10), [])
+        self.assertEqual(sorted(self.pool.imap_unordered(record, range(50), chunksize=4)), [x * x for x in range(50)])
+        self.assertRaises(ValueError, self.pool.map, record, range(10), chunksize=0)
+
+    def test_imap_chunksize_greenlet(self):
+        it = self.pool.imap(sqr, range(10), chunksize=3)
+        assert isinstance(it, gevent.Greenlet), it
+        self.assertEqual(next(it), 0)
+        it.kill()
+        assert it.dead, it
+        it = self.pool.imap_unordered(sqr, range(10), chunksize=3)
+        assert isinstance(it, gevent.Greenlet), it
+        self.assertEqual(sorted(it), list(map(squared, range(10))))
+
     def test_imap_random(self):
         it = self.pool.imap(sqr_random_sleep, list(range(10)))
         self.assertEqual(list(it), list(map(squared, list(range(10)))))
@@ -420,6 +484,12 @@ def divide_by(x):
     return 1.0 / x
 
 
+def fail_on_4(x):
+    if x == 4:
+        raise ExpectedException(x)
+    return x * x
+
+
 class TestErrorInHandler(greentest.TestCase):
     error_fatal = False
 
@@ -443,6 +513,124 @@ class TestErrorInHandler(greentest.TestCase):
         self.assertEqual(next(it), 0.5)
         self.assertRaises(StopIteration, it.__next__)
 
+    def test_imap_chunksize(self):
+        p = pool.Pool(3)
+        it = p.imap(fail_on_4, range(10), chunksize=3)
+        self.assertEqual([next(it) for _ in range(3)], [0, 1, 4])
+        self.assertRaises(ExpectedException, next, it)
+        # the iteration ends: the results of the chunks after the failed one are not given out
+        self.assertRaises(StopIteration, next, it)
+        self.assertRaises(StopIteration, next, it)
+        assert it.dead, it
+
+    def test_imap_unordered_chunksize(self):
+        p = pool.Pool(3)
+        it = p.imap_unordered(fail_on_4, range(10), chunksize=3)
+        results = []
+        self.assertRaises(ExpectedException, lambda: results.extend(it))
+        self.assertRaises(StopIteration, next, it)
+        # the rest of the failed chunk is lost
+        assert not set(results) & set([9, 16, 25]), results
+
+
+class TestTaskGroup(greentest.TestCase):
+    error_fatal = False
+
+    def test_join(self):
+        results = []
+        with pool.TaskGroup() as tasks:
+            for x in range(3):
+                tasks.spawn(lambda x: results.append(sqr(x)), x)
+        self.assertEqual(sorted(results), [0, 1, 4])
+        self.assertEqual(len(tasks), 0)
+
+    def test_fail_fast(self):
+        finished = []
+
+        def slow():
+            gevent.sleep(10)
+            finished.append(True)
+
+        def fail():
+            gevent.sleep(0.01)
+            raise ExpectedException('fail')
+
+        def run():
+            with pool.TaskGroup() as tasks:
+                for _ in range(5):
+                    tasks.spawn(slow)
+                tasks.spawn(fail)
+            return tasks
+
+        with gevent.Timeout(1):
+            self.assertRaises(ExpectedException, run)
+        self.assertEqual(finished, [])
+
+    def test_traceback(self):
+        def fail():
+            raise ExpectedException('fail')
+
+        try:
+            with pool.TaskGroup() as tasks:
+                tasks.spawn(fail)
+        except ExpectedException:
+            tb = sys.exc_info()[2]
+        else:
+            raise AssertionError('ExpectedException was not raised')
+        # the traceback reaches into the failed greenlet
+        names = [frame[2] for frame in traceback.extract_tb(tb)]
+        self.assertEqual(names[-1], 'fail')
+
+    def test_body_error(self):
+        greenlets = []
+        try:
+            with pool.TaskGroup() as tasks:
+                greenlets.append(tasks.spawn(gevent.sleep, 10))
+                raise ExpectedException('body')
+        except ExpectedException:
+            pass
+        self.assertTrue(greenlets[0].dead)
+        self.assertEqual(len(tasks), 0)
+
+    def test_timeout(self):
+        start = time()
+        tasks = pool.TaskGroup(0.05)
+
+        def run():
+            with tasks:
+                tasks.spawn(gevent.sleep, 10)
+
+        self.assertRaises(gevent.Timeout, run)
+        self.assertTrue(time() - start < 1)
+        self.assertEqual(len(tasks), 0)
+        # silent
+        with pool.TaskGroup(0.05, False) as tasks:
+            g = tasks.spawn(gevent.sleep, 10)
+        self.assertTrue(g.dead)
+
+    def test_nested(self):
+        inner_greenlets = []
+
+        def inner():
+            with pool.TaskGroup() as tasks:
+                inner_greenlets.append(tasks.spawn(gevent.sleep, 10))
+
+        with pool.TaskGroup(0.05, False) as outer:
+            outer.spawn(inner)
+            with pool.TaskGroup() as tasks:
+                inner_greenlets.append(tasks.spawn(gevent.sleep, 10))
+        self.assertEqual(len(inner_greenlets), 2)
+        for g in inner_greenlets:
+            self.assertTrue(g.dead)
+
+    def test_cancel(self):
+        with pool.TaskGroup() as tasks:
+            g = tasks.spawn(gevent.sleep, 10)
+            gevent.spawn_later(0.01, tasks.cancel)
+        self.assertTrue(g.dead)
+        self.assertTrue(tasks.cancelled)
+        self.assertEqual(tasks.exception, None)
+
 
 if __name__ == '__main__':
     greentest.main()
@@ -22,8 +22,12 @@ monkey.patch_all(thread=False)
 
 import cgi
 import os
+import shutil
 import sys
+import tempfile
+import time
 import io
+import zlib
 try:
     from wsgiref.validate import validator
 except ImportError:
@@ -35,7 +39,8 @@ import greentest
 import gevent
 from gevent import socket
 from gevent import pywsgi
-from gevent.pywsgi import Input
+from gevent.event import Event
+from gevent.pywsgi import Input, Headers, LatencyHistogram
 
 
 CONTENT_LENGTH = 'Content-Length'
@@ -507,6 +512,94 @@ class TestChunkedPost(TestCase):
         read_http(fd, body='oh hai')
 
 
+class TestStreamingPost(TestCase):
+
+    validator = None
+
+    @staticmethod
+    def application(env, start_response):
+        assert env['wsgi.input_terminated'] is True
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        if env['PATH_INFO'] == '/readinto':
+            buf = bytearray(3)
+            result = []
+            while True:
+                count = env['wsgi.input'].readinto(buf)
+                if not count:
+                    break
+                result.append(str(buf[:count]))
+            return result
+        return list(env['wsgi.input'].iter_chunks(3))
+
+    def test_chunked(self):
+        for path in ('/readinto', '/iter_chunks'):
+            fd = self.makefile()
+            fd.write('POST %s HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n'
+                     'Transfer-Encoding: chunked\r\n\r\n'
+                     '2\r\noh\r\n4\r\n hai\r\n0\r\n\r\n' % path)
+            read_http(fd, body='oh hai')
+
+    def test_content_length(self):
+        for path in ('/readinto', '/iter_chunks'):
+            fd = self.makefile()
+            fd.write('POST %s HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n'
+                     'Content-Length: 6\r\n\r\noh hai' % path)
+            read_http(fd, body='oh hai')
+
+
+class TestSpooledInput(TestCase):
+
+    validator = None
+
+    def application(self, env, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        wsgi_input = env['wsgi.input']
+        if env['PATH_INFO'] == '/ignore':
+            return ['ignored']
+        self.inputs.append(wsgi_input)
+        first = wsgi_input.readline()
+        rest = wsgi_input.read()
+        on_disk = False
+        if isinstance(wsgi_input, pywsgi.SpooledInput):
+            wsgi_input.seek(0)
+            assert wsgi_input.read() == first + rest
+            on_disk = not isinstance(wsgi_input.file, io.BytesIO)
+        return ['%s %s %s' % (type(wsgi_input).__name__, len(first + rest), on_disk)]
+
+    def init_server(self, application):
+        self.inputs = []
+        self.server = pywsgi.WSGIServer(('127.0.0.1', 0), application)
+        self.server.spool_threshold = 1000
+
+    def test_large(self):
+        body = 'x' * 100 + '\n' + 'y' * 300000
+        fd = self.makefile()
+        fd.write('POST / HTTP/1.1\r\nHost: localhost\r\nContent-Length: %s\r\n\r\n%s' % (len(body), body))
+        read_http(fd, body='SpooledInput 300101 True')
+        # the file is closed after the response
+        self.assertTrue(self.inputs[0].file.closed)
+        fd.write('POST / HTTP/1.1\r\nHost: localhost\r\nContent-Length: 5\r\n\r\nsmall')
+        read_http(fd, body='Input 5 False')
+
+    def test_chunked(self):
+        fd = self.makefile()
+        fd.write('POST / HTTP/1.1\r\nHost: localhost\r\nTransfer-Encoding: chunked\r\n\r\n'
+                 '2\r\noh\r\n4\r\n hai\r\n0\r\n\r\n')
+        # small enough to stay in memory
+        read_http(fd, body='SpooledInput 6 False')
+        chunk = 'z' * 4000
+        fd.write('POST / HTTP/1.1\r\nHost: localhost\r\nTransfer-Encoding: chunked\r\n\r\n' +
+                 ('%x\r\n%s\r\n' % (len(chunk), chunk)) * 3 + '0\r\n\r\n')
+        read_http(fd, body='SpooledInput 12000 True')
+
+    def test_not_read(self):
+        fd = self.makefile()
+        fd.write('POST /ignore HTTP/1.1\r\nHost: localhost\r\nContent-Length: 2000\r\n\r\n' + 'a' * 2000)
+        read_http(fd, body='ignored')
+        fd.write('POST / HTTP/1.1\r\nHost: localhost\r\nContent-Length: 2000\r\n\r\n' + 'a' * 2000)
+        read_http(fd, body='SpooledInput 2000 True')
+
+
 class TestUseWrite(TestCase):
 
     body = 'abcde'
@@ -1218,6 +1311,852 @@ class TestInputRaw(greentest.BaseTestCase):
         i = self.make_input("2\r\n1", chunked_input=True)
         self.assertRaises(IOError, i.readline)
 
+    def test_readinto(self):
+        i = self.make_input("12345", content_length=5)
+        buf = bytearray(3)
+        self.assertEqual(i.readinto(buf), 3)
+        self.assertEqual(buf, bytearray("123"))
+        self.assertEqual(i.readinto(buf), 2)
+        self.assertEqual(buf[:2], bytearray("45"))
+        self.assertEqual(i.readinto(buf), 0)
+
+    def test_chunked_readinto(self):
+        i = self.make_input(["12", "345", ""])
+        buf = bytearray(4)
+        self.assertEqual(i.readinto(buf), 4)
+        self.assertEqual(buf, bytearray("1234"))
+        self.assertEqual(i.readinto(buf), 1)
+        self.assertEqual(buf[:1], bytearray("5"))
+        self.assertEqual(i.readinto(buf), 0)
+
+    def test_chunked_readinto_missing_chunk(self):
+        i = self.make_input(["1", "2"])
+        self.assertRaises(IOError, i.readinto, bytearray(10))
+
+    def test_iter_chunks(self):
+        i = self.make_input("12345", content_length=5)
+        self.assertEqual(list(i.iter_chunks(2)), ["12", "34", "5"])
+
+    def test_chunked_iter_chunks(self):
+        i = self.make_input(["12", "345", ""])
+        self.assertEqual(list(i.iter_chunks(2)), ["12", "34", "5"])
+
+
+class CountingHandler(pywsgi.WSGIHandler):
+
+    def _flush_output(self):
+        if self._output:
+            self.server.writes.append(str(self._output))
+        pywsgi.WSGIHandler._flush_output(self)
+
+    def _sendall(self, data):
+        if self._output is None:
+            self.server.writes.append(str(data))
+        pywsgi.WSGIHandler._sendall(self, data)
+
+    def _take_pending(self):
+        data = pywsgi.WSGIHandler._take_pending(self)
+        self.server.writes.append(str(data))
+        return data
+
+
+class TestPipelineBatching(TestCase):
+
+    validator = None
+
+    @staticmethod
+    def application(env, start_response):
+        if env['PATH_INFO'] == '/post':
+            body = env['wsgi.input'].read()
+        else:
+            body = env['PATH_INFO']
+        start_response('200 OK', [('Content-Type', 'text/plain'), ('Content-Length', str(len(body)))])
+        return [body]
+
+    def init_server(self, application):
+        self.server = pywsgi.WSGIServer(('127.0.0.1', 0), application, handler_class=CountingHandler)
+        self.server.writes = []
+
+    def test_batched(self):
+        fd = self.makefile()
+        fd.write(''.join('GET /%s HTTP/1.1\r\nHost: localhost\r\n\r\n' % x for x in 'abc'))
+        for x in 'abc':
+            read_http(fd, body='/' + x)
+        self.assertEqual(len(self.server.writes), 1, self.server.writes)
+        self.assertEqual(self.server.writes[0].count('HTTP/1.1 200 OK'), 3)
+
+    def test_body_flushes(self):
+        # a request with a body sends the collected responses before reading it
+        fd = self.makefile()
+        fd.write('GET /a HTTP/1.1\r\nHost: localhost\r\n\r\n'
+                 'POST /post HTTP/1.1\r\nHost: localhost\r\nContent-Length: 5\r\n\r\nhe')
+        read_http(fd, body='/a')
+        fd.write('llo')
+        fd.flush()
+        read_http(fd, body='hello')
+        self.assertEqual(len(self.server.writes), 2, self.server.writes)
+
+    def test_not_pipelined(self):
+        fd = self.makefile()
+        for x in 'ab':
+            fd.write('GET /%s HTTP/1.1\r\nHost: localhost\r\n\r\n' % x)
+            read_http(fd, body='/' + x)
+        self.assertEqual(len(self.server.writes), 2, self.server.writes)
+
+
+class TestWriteCoalescing(TestCase):
+
+    validator = None
+
+    def application(self, env, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        if env['PATH_INFO'] == '/small':
+            return ('%03d' % x for x in range(1000))
+        if env['PATH_INFO'] == '/large':
+            return ('%s' % x * 50000 for x in range(10))
+        return self.blocking()
+
+    def blocking(self):
+        yield 'head'
+        yield 'a'
+        yield 'b'
+        self.event.wait()
+        yield 'c'
+
+    def init_server(self, application):
+        self.event = Event()
+        self.server = pywsgi.WSGIServer(('127.0.0.1', 0), application, handler_class=CountingHandler)
+        self.server.writes = []
+
+    def test_small(self):
+        fd = self.makefile()
+        fd.write('GET /small HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        read_http(fd, body=''.join('%03d' % x for x in range(1000)))
+        # the headers with the first chunk, then all the other chunks at once
+        self.assertEqual(len(self.server.writes), 2, self.server.writes)
+
+    def test_large(self):
+        fd = self.makefile()
+        fd.write('GET /large HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        read_http(fd, body=''.join('%s' % x * 50000 for x in range(10)))
+        self.assertTrue(2 < len(self.server.writes) < 11, len(self.server.writes))
+
+    def test_blocking(self):
+        # what was written before the application blocked is sent meanwhile
+        fd = self.makefile()
+        fd.write('GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        read_headers(fd)
+        chunks = iread_chunks(fd)
+        self.assertEqual(next(chunks), 'head')
+        self.assertEqual(next(chunks), 'a')
+        self.assertEqual(next(chunks), 'b')
+        self.assertEqual(len(self.server.writes), 2, self.server.writes)
+        self.event.set()
+        self.assertEqual(list(chunks), ['c'])
+
+    def test_disabled(self):
+        self.server.handler_class = type('Handler', (CountingHandler, ), {'write_buffer_high': None})
+        fd = self.makefile()
+        fd.write('GET /small HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        read_http(fd, body=''.join('%03d' % x for x in range(1000)))
+        self.assertEqual(len(self.server.writes), 1001)
+
+
+class TestFileWrapper(TestCase):
+
+    validator = None
+
+    def application(self, env, start_response):
+        if env['PATH_INFO'] == '/pipe':
+            r, w = os.pipe()
+            os.write(w, 'hello from a pipe')
+            os.close(w)
+            filelike = os.fdopen(r, 'rb')
+        else:
+            filelike = open(__file__, 'rb')
+            filelike.seek(int(env['QUERY_STRING'] or 0))
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return env['wsgi.file_wrapper'](filelike)
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.calls = []
+        self.original_sendfile = pywsgi.sendfile
+        if self.original_sendfile is not None:
+            pywsgi.sendfile = self.sendfile
+
+    def tearDown(self):
+        pywsgi.sendfile = self.original_sendfile
+        TestCase.tearDown(self)
+
+    def sendfile(self, *args):
+        self.calls.append(args)
+        return self.original_sendfile(*args)
+
+    def test_regular_file(self):
+        data = open(__file__, 'rb').read()
+        fd = self.makefile()
+        fd.write('GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        response = read_http(fd, body=data)
+        self.assertEqual(response.headers['Content-Length'], str(len(data)))
+        fd.write('GET /?100 HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        read_http(fd, body=data[100:])
+        if self.original_sendfile is not None:
+            self.assertTrue(self.calls)
+
+    def test_pipe(self):
+        fd = self.makefile()
+        fd.write('GET /pipe HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        response = read_http(fd, body='hello from a pipe')
+        self.assertEqual(response.headers.get('Transfer-Encoding'), 'chunked')
+        self.assertEqual(self.calls, [])
+
+
+class TestGzip(TestCase):
+
+    validator = None
+    text = 'hello world ' * 1000
+
+    def application(self, env, start_response):
+        path = env['PATH_INFO']
+        headers = [('Content-Type', 'text/plain')]
+        if path == '/small':
+            start_response('200 OK', headers)
+            return ['hello']
+        if path == '/image':
+            start_response('200 OK', [('Content-Type', 'image/png')])
+            return [self.text]
+        if path == '/stream':
+            start_response('200 OK', headers + [('Vary', 'Cookie')])
+            return iter([self.text[:5000], self.text[5000:]])
+        if path == '/etag':
+            start_response('200 OK', headers + [('ETag', '"1"')])
+            return [self.text]
+        start_response('200 OK', headers + [('Content-Length', str(len(self.text)))])
+        return [self.text]
+
+    def init_server(self, application):
+        self.server = pywsgi.WSGIServer(('127.0.0.1', 0), application)
+        self.server.gzip = True
+
+    def get(self, fd, path, accept_encoding='gzip, deflate'):
+        fd.write('GET %s HTTP/1.1\r\nHost: localhost\r\nAccept-Encoding: %s\r\n\r\n' % (path, accept_encoding))
+        return read_http(fd)
+
+    def assertCompressed(self, response, body):
+        self.assertEqual(response.headers.get('Content-Encoding'), 'gzip')
+        self.assertEqual(zlib.decompress(response.body, 16 + zlib.MAX_WBITS), body)
+
+    def test_buffered(self):
+        fd = self.makefile()
+        response = self.get(fd, '/')
+        self.assertCompressed(response, self.text)
+        self.assertEqual(response.headers['Content-Length'], str(len(response.body)))
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        assert len(response.body) < len(self.text) / 10, len(response.body)
+
+    def test_stream(self):
+        fd = self.makefile()
+        response = self.get(fd, '/stream')
+        self.assertCompressed(response, self.text)
+        self.assertEqual(response.headers['Transfer-Encoding'], 'chunked')
+        self.assertEqual(response.headers['Vary'], 'Cookie, Accept-Encoding')
+
+    def test_not_compressed(self):
+        fd = self.makefile()
+        response = self.get(fd, '/small')
+        self.assertEqual(response.body, 'hello')
+        self.assertEqual(response.headers.get('Content-Encoding'), None)
+        for path, accept_encoding in (('/image', 'gzip'), ('/', 'identity'), ('/', 'gzip;q=0')):
+            response = self.get(fd, path, accept_encoding)
+            self.assertEqual(response.body, self.text)
+            self.assertEqual(response.headers.get('Content-Encoding'), None)
+
+    def test_threadpool(self):
+        self.server.gzip_threadpool_size = 1000
+        fd = self.makefile()
+        self.assertCompressed(self.get(fd, '/'), self.text)
+
+    def test_cache(self):
+        fd = self.makefile()
+        first = self.get(fd, '/etag')
+        self.assertCompressed(first, self.text)
+        self.assertEqual(list(self.server._gzip_cache.keys()), [('localhost', '/etag', '', '"1"')])
+        self.server._gzip_cache[('localhost', '/etag', '', '"1"')] = 'cached'
+        second = self.get(fd, '/etag')
+        self.assertEqual(second.body, 'cached')
+
+
+class TestStaticFiles(TestCase):
+
+    validator = None
+    application = None
+
+    def init_server(self, application):
+        self.root = tempfile.mkdtemp()
+        self.data = ''.join(chr(x % 256) for x in range(100000))
+        self.write_file('data.bin', self.data)
+        self.write_file('hello.txt', 'hello world')
+        self.files = pywsgi.StaticFiles(self.root, cache_size=2, revalidate=0)
+        self.server = pywsgi.WSGIServer(('127.0.0.1', 0), self.files)
+
+    def tearDown(self):
+        TestCase.tearDown(self)
+        self.files.clear()
+        shutil.rmtree(self.root)
+
+    def write_file(self, name, data):
+        f = open(os.path.join(self.root, name), 'wb')
+        f.write(data)
+        f.close()
+
+    def read_bodyless(self, fd, code):
+        # read_http() would wait for the body of a HEAD or 304 response
+        response_line, headers = read_headers(fd)
+        self.assertTrue(response_line.startswith('HTTP/1.1 %s ' % code), response_line)
+        return headers
+
+    def test_get(self):
+        fd = self.makefile()
+        fd.write('GET /data.bin HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        response = read_http(fd, body=self.data)
+        self.assertEqual(response.headers['Content-Length'], '100000')
+        self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+        fd.write('HEAD /hello.txt HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        headers = self.read_bodyless(fd, 200)
+        self.assertEqual(headers['Content-Type'], 'text/plain')
+        self.assertEqual(headers['Content-Length'], '11')
+        fd.write('GET /hello.txt HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        read_http(fd, body='hello world')
+
+    def test_without_sendfile(self):
+        original_sendfile = pywsgi.sendfile
+        pywsgi.sendfile = None
+        try:
+            fd = self.makefile()
+            fd.write('GET /data.bin HTTP/1.1\r\nHost: localhost\r\nRange: bytes=10-99999\r\n\r\n')
+            read_http(fd, code=206, body=self.data[10:])
+        finally:
+            pywsgi.sendfile = original_sendfile
+
+    def test_not_found(self):
+        fd = self.makefile()
+        for path in ('/missing', '/../etc/passwd', '/', '/hello.txt/..'):
+            fd.write('GET %s HTTP/1.1\r\nHost: localhost\r\n\r\n' % path)
+            read_http(fd, code=404)
+        fd.write('POST /hello.txt HTTP/1.1\r\nHost: localhost\r\nContent-Length: 0\r\n\r\n')
+        response = read_http(fd, code=405)
+        self.assertEqual(response.headers['Allow'], 'GET, HEAD')
+
+    def test_conditional(self):
+        fd = self.makefile()
+        fd.write('GET /hello.txt HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        response = read_http(fd, body='hello world')
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+        fd.write('GET /hello.txt HTTP/1.1\r\nHost: localhost\r\nIf-None-Match: "x", %s\r\n\r\n' % etag)
+        headers = self.read_bodyless(fd, 304)
+        self.assertEqual(headers['ETag'], etag)
+        fd.write('GET /hello.txt HTTP/1.1\r\nHost: localhost\r\nIf-Modified-Since: %s\r\n\r\n' % last_modified)
+        self.read_bodyless(fd, 304)
+        fd.write('GET /hello.txt HTTP/1.1\r\nHost: localhost\r\nIf-None-Match: "x"\r\n\r\n')
+        read_http(fd, body='hello world')
+        # a changed file is noticed
+        self.write_file('hello.txt', 'hello again')
+        os.utime(os.path.join(self.root, 'hello.txt'), (time.time() + 10, time.time() + 10))
+        fd.write('GET /hello.txt HTTP/1.1\r\nHost: localhost\r\nIf-None-Match: %s\r\n\r\n' % etag)
+        read_http(fd, body='hello again')
+
+    def test_ranges(self):
+        fd = self.makefile()
+        fd.write('GET /data.bin HTTP/1.1\r\nHost: localhost\r\nRange: bytes=100-199\r\n\r\n')
+        response = read_http(fd, code=206, body=self.data[100:200])
+        self.assertEqual(response.headers['Content-Range'], 'bytes 100-199/100000')
+        fd.write('GET /data.bin HTTP/1.1\r\nHost: localhost\r\nRange: bytes=-10\r\n\r\n')
+        read_http(fd, code=206, body=self.data[-10:])
+        fd.write('GET /data.bin HTTP/1.1\r\nHost: localhost\r\nRange: bytes=99990-\r\n\r\n')
+        read_http(fd, code=206, body=self.data[99990:])
+        fd.write('GET /data.bin HTTP/1.1\r\nHost: localhost\r\nRange: bytes=200000-\r\n\r\n')
+        response = read_http(fd, code=416)
+        self.assertEqual(response.headers['Content-Range'], 'bytes */100000')
+        # multiple ranges are not supported: the whole file is sent
+        fd.write('GET /hello.txt HTTP/1.1\r\nHost: localhost\r\nRange: bytes=0-1,3-4\r\n\r\n')
+        read_http(fd, code=200, body='hello world')
+        fd.write('GET /hello.txt HTTP/1.1\r\nHost: localhost\r\nRange: bytes=0-4\r\nIf-Range: "old"\r\n\r\n')
+        read_http(fd, code=200, body='hello world')
+
+    def test_gzip(self):
+        self.server.gzip = True
+        text = 'static text ' * 1000
+        self.write_file('big.txt', text)
+        fd = self.makefile()
+        for _ in range(2):
+            fd.write('GET /big.txt HTTP/1.1\r\nHost: localhost\r\nAccept-Encoding: gzip\r\n\r\n')
+            response = read_http(fd)
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(zlib.decompress(response.body, 16 + zlib.MAX_WBITS), text)
+        self.assertEqual(len(self.server._gzip_cache), 1)
+        self.assertEqual(self.files._cache[os.path.join(self.root, 'big.txt')].users, 0)
+
+    def test_gzip_range(self):
+        # a partial response is never compressed nor does it get into the cache of the compressed bodies
+        self.server.gzip = True
+        text = ''.join('line %05d\n' % x for x in range(2000))
+        self.write_file('big.txt', text)
+        fd = self.makefile()
+        fd.write('GET /big.txt HTTP/1.1\r\nHost: localhost\r\nAccept-Encoding: gzip\r\nRange: bytes=0-1999\r\n\r\n')
+        response = read_http(fd, code=206, body=text[:2000])
+        self.assertTrue('Content-Encoding' not in response.headers, response.headers)
+        self.assertFalse(self.server._gzip_cache)
+        fd.write('GET /big.txt HTTP/1.1\r\nHost: localhost\r\nAccept-Encoding: gzip\r\n\r\n')
+        response = read_http(fd, code=200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(zlib.decompress(response.body, 16 + zlib.MAX_WBITS), text)
+
+    def test_cache(self):
+        self.write_file('third.txt', 'third')
+        fd = self.makefile()
+        for name in ('hello.txt', 'data.bin', 'third.txt', 'hello.txt'):
+            fd.write('GET /%s HTTP/1.1\r\nHost: localhost\r\n\r\n' % name)
+            read_http(fd)
+        self.assertTrue(len(self.files._cache) <= 2, self.files._cache)
+        entry = self.files._cache[os.path.join(self.root, 'hello.txt')]
+        self.assertEqual(entry.users, 0)
+
+
+class TestBufferedLog(TestCase):
+
+    validator = None
+
+    @staticmethod
+    def application(env, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['hello']
+
+    def init_server(self, application):
+        self.log = pywsgi.BufferedLog(io.StringIO(), flush_interval=0.1)
+        self.server = pywsgi.WSGIServer(('127.0.0.1', 0), application, log=self.log)
+
+    def test(self):
+        fd = self.makefile()
+        fd.write('GET /hello HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        read_http(fd, body='hello')
+        gevent.sleep(0.3)
+        line = self.log.file.getvalue()
+        self.assertTrue(line.startswith('127.0.0.1 - - ['), line)
+        self.assertIn('"GET /hello HTTP/1.1" 200 ', line)
+        self.assertEqual(line.count('\n'), 1)
+
+    def test_drop(self):
+        log = pywsgi.BufferedLog(io.StringIO(), maxsize=2, flush_interval=0.1)
+        for x in 'abc':
+            log.write(x)
+        self.assertEqual(log.dropped, 1)
+        log.flush()
+        self.assertEqual(log.file.getvalue(), 'ab')
+
+    def test_block(self):
+        log = pywsgi.BufferedLog(io.StringIO(), maxsize=2, flush_interval=10, policy='block')
+        log.write('a')
+        log.write('b')
+        writer = gevent.spawn(log.write, 'c')
+        gevent.sleep(0.01)
+        # the full buffer wakes up the background writer, which makes room for the blocked write
+        writer.join(1)
+        self.assertTrue(writer.dead)
+        log.flush()
+        self.assertEqual(log.file.getvalue(), 'abc')
+        self.assertEqual(log.dropped, 0)
+
+
+class TestParkIdle(TestCase):
+
+    validator = None
+
+    @staticmethod
+    def application(env, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [env['PATH_INFO']]
+
+    def init_server(self, application):
+        self.server = pywsgi.WSGIServer(('127.0.0.1', 0), application, spawn=1)
+        self.server.park_idle = True
+
+    def test_park(self):
+        fd = self.makefile()
+        fd.write('GET /a HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        read_http(fd, body='/a')
+        gevent.sleep(0.01)
+        self.assertEqual(len(self.server._parked), 1)
+        self.assertEqual(len(self.server.handlers), 0)
+        # the parked connection does not occupy the only slot in the pool
+        fd2 = self.makefile()
+        fd2.write('GET /b HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        read_http(fd2, body='/b')
+        fd.write('GET /c HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        read_http(fd, body='/c')
+        gevent.sleep(0.01)
+        self.assertEqual(len(self.server._parked), 2)
+        fd.close()
+        fd2.close()
+
+    def test_idle_timeout(self):
+        self.server.idle_timeout = 0.1
+        fd = self.makefile()
+        fd.write('GET /a HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        read_http(fd, body='/a')
+        gevent.sleep(0.2)
+        self.assertEqual(len(self.server._parked), 0)
+        self.assertEqual(fd.read(), '')
+
+    def test_stop(self):
+        fd = self.makefile()
+        fd.write('GET /a HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        read_http(fd, body='/a')
+        gevent.sleep(0.01)
+        self.server.stop()
+        self.assertEqual(len(self.server._parked), 0)
+        self.assertEqual(fd.read(), '')
+
+    def test_max_requests(self):
+        # the count of the requests survives parking
+        self.server.max_requests = 2
+        fd = self.makefile()
+        fd.write('GET /a HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        response = read_http(fd, body='/a')
+        self.assertNotEqual(response.headers.get('Connection'), 'close')
+        gevent.sleep(0.01)
+        self.assertEqual(len(self.server._parked), 1)
+        fd.write('GET /b HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        response = read_http(fd, body='/b')
+        self.assertEqual(response.headers.get('Connection'), 'close')
+        self.assertEqual(fd.read(), '')
+
+
+class TestTimeouts(TestCase):
+
+    validator = None
+
+    @staticmethod
+    def application(env, start_response):
+        body = env['wsgi.input'].read()
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [body or 'hello']
+
+    def init_server(self, application):
+        self.server = pywsgi.WSGIServer(('127.0.0.1', 0), application)
+        self.server.idle_timeout = 0.2
+        self.server.header_timeout = 0.1
+        self.server.body_timeout = 0.1
+
+    def assertClosedWithin(self, fd, seconds):
+        start = time.time()
+        self.assertEqual(fd.read(), '')
+        self.assertLess(time.time() - start, seconds)
+
+    def test_header_timeout(self):
+        fd = self.makefile()
+        fd.write('GET / HTTP/1.1\r\nHost: localhost\r\n')
+        read_http(fd, code=408)
+        self.assertClosedWithin(fd, 0.5)
+
+    def test_header_timeout_without_request(self):
+        fd = self.makefile()
+        self.assertClosedWithin(fd, 0.5)
+
+    def test_idle_timeout(self):
+        fd = self.makefile()
+        fd.write('GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        read_http(fd, body='hello')
+        # the header_timeout does not apply between the requests
+        gevent.sleep(0.15)
+        fd.write('GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        read_http(fd, body='hello')
+        self.assertClosedWithin(fd, 0.5)
+
+    def test_body_timeout(self):
+        self.expect_one_error()
+        fd = self.makefile()
+        fd.write('POST / HTTP/1.1\r\nHost: localhost\r\nContent-Length: 10\r\n\r\nhello')
+        fd.flush()
+        read_http(fd, code=500)
+        self.assert_error(socket.timeout)
+
+
+class TestMaxRequests(TestCase):
+
+    validator = None
+
+    @staticmethod
+    def application(env, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['hello']
+
+    def init_server(self, application):
+        self.server = pywsgi.WSGIServer(('127.0.0.1', 0), application)
+        self.server.max_requests = 2
+
+    def test(self):
+        fd = self.makefile()
+        fd.write('GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        response = read_http(fd, body='hello')
+        self.assertEqual(response.headers.get('Connection'), None)
+        fd.write('GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        response = read_http(fd, body='hello')
+        self.assertEqual(response.headers.get('Connection'), 'close')
+        self.assertEqual(fd.read(), '')
+
+
+class TestMetrics(TestCase):
+
+    validator = None
+
+    @staticmethod
+    def application(env, start_response):
+        if env['PATH_INFO'] == '/error':
+            start_response('500 Internal Server Error', [('Content-Type', 'text/plain')])
+            return ['error']
+        body = env['wsgi.input'].read()
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['hello' + body]
+
+    def init_server(self, application):
+        self.server = pywsgi.WSGIServer(('127.0.0.1', 0), application)
+        self.metrics = self.server.enable_metrics('/metrics')
+
+    def test(self):
+        fd = self.makefile()
+        fd.write('GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        read_http(fd, body='hello')
+        fd.write('POST / HTTP/1.1\r\nHost: localhost\r\nTransfer-Encoding: chunked\r\n\r\n'
+                 '3\r\nabc\r\n2\r\nde\r\n0\r\n\r\n')
+        read_http(fd, body='helloabcde')
+        fd.write('GET /error HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        read_http(fd, code=500, body='error')
+        gevent.sleep(0.01)
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot['latency']['2xx']['count'], 2)
+        self.assertEqual(snapshot['latency']['5xx']['count'], 1)
+        self.assertEqual(snapshot['latency']['4xx']['count'], 0)
+        self.assertEqual(snapshot['in_flight'], 0)
+        self.assertEqual(snapshot['keepalive'], 1)
+        requests = ('GET / HTTP/1.1\r\nHost: localhost\r\n\r\n'
+                    'POST / HTTP/1.1\r\nHost: localhost\r\nTransfer-Encoding: chunked\r\n\r\n'
+                    'GET /error HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        # the chunked framing is not counted, only the 5 bytes of the body
+        self.assertEqual(snapshot['bytes_received'], len(requests) + 5)
+        assert snapshot['bytes_sent'] > 0, snapshot
+
+        fd.write('GARBAGE\r\n\r\n')
+        read_http(fd, code=400)
+        self.assertEqual(self.metrics.parse_errors, 1)
+
+        fd = self.makefile()
+        fd.write('GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        body = read_http(fd).body
+        assert 'pywsgi_request_duration_seconds_count{status="2xx"} 2\n' in body, body
+        assert 'pywsgi_request_duration_seconds_bucket{status="5xx",le="+Inf"} 1\n' in body, body
+        # all the buckets are listed, cumulatively, even for the status classes without requests
+        for name in ('2xx', '4xx'):
+            start = 'pywsgi_request_duration_seconds_bucket{status="%s"' % name
+            lines = [line for line in body.split('\n') if line.startswith(start)]
+            self.assertEqual(len(lines), len(self.metrics.latency[name].counts))
+            assert 'le="+Inf"} ' in lines[-1], lines[-1]
+            counts = [int(line.rsplit(' ', 1)[1]) for line in lines]
+            self.assertEqual(counts, sorted(counts))
+            assert 'pywsgi_request_duration_seconds_count{status="%s"} %d\n' % (name, counts[-1]) in body, body
+        assert 'pywsgi_requests_in_flight 1\n' in body, body
+        assert 'pywsgi_parse_errors_total 1\n' in body, body
+
+
+class TestLoadShedding(TestCase):
+
+    validator = None
+
+    def application(self, env, start_response):
+        if env['PATH_INFO'] == '/wait':
+            self.event.wait()
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['hello']
+
+    def init_server(self, application):
+        self.event = Event()
+        self.server = pywsgi.WSGIServer(('127.0.0.1', 0), application)
+
+    def test_in_flight(self):
+        self.server.max_in_flight = 1
+        metrics = self.server.enable_metrics()
+        fd = self.makefile()
+        fd.write('GET /wait HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+        gevent.sleep(0.01)
+        fd2 = self.makefile()
+        fd2.write('GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        response = read_http(fd2, code=503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        self.assertEqual(fd2.read(), '')
+        self.assertEqual(metrics.shed, 1)
+        assert self.server.overloaded
+        self.event.set()
+        read_http(fd, body='hello')
+        gevent.sleep(0.01)
+        fd = self.makefile()
+        fd.write('GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        read_http(fd, body='hello')
+        assert not self.server.overloaded
+
+    def test_idle_not_in_flight(self):
+        self.server.max_in_flight = 2
+        idle = self.makefile()
+        idle.write('GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        read_http(idle, body='hello')
+        fd = self.makefile()
+        fd.write('GET /wait HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+        gevent.sleep(0.01)
+        self.assertEqual(self.server.in_flight, 1)
+        # the idle keep-alive connection does not count
+        fd2 = self.makefile()
+        fd2.write('GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        read_http(fd2, body='hello')
+        assert not self.server.overloaded
+        self.event.set()
+        read_http(fd, body='hello')
+        gevent.sleep(0.01)
+        self.assertEqual(self.server.in_flight, 0)
+
+    def test_shed_without_greenlet(self):
+        self.server.max_in_flight = 1
+        handled = []
+        handle = self.server._handle
+        self.server._handle = lambda *args: handled.append(args[1]) or handle(*args)
+        fd = self.makefile()
+        fd.write('GET /wait HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+        gevent.sleep(0.01)
+        fd2 = self.makefile()
+        fd2.write('GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        read_http(fd2, code=503)
+        self.assertEqual(len(handled), 1)
+        self.event.set()
+        read_http(fd, body='hello')
+
+    def test_loop_lag(self):
+        self.server.max_loop_lag = 0.05
+        self.server.loop_delay_interval = 0.01
+        fd = self.makefile()
+        fd.write('GET / HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+        read_http(fd, body='hello')
+        # block the event loop
+        end = time.time() + 0.3
+        while time.time() < end:
+            pass
+        gevent.sleep(0.001)
+        assert self.server.loop_delay > 0.05, self.server.loop_delay
+        fd = self.makefile()
+        fd.write('GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        read_http(fd, code=503)
+        # the lag is gone once the loop keeps up again
+        gevent.sleep(0.2)
+        assert self.server.loop_delay < 0.025, self.server.loop_delay
+        fd = self.makefile()
+        fd.write('GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        read_http(fd, body='hello')
+
+
+class TestLatencyHistogram(greentest.BaseTestCase):
+
+    def test_buckets(self):
+        histogram = LatencyHistogram(minimum=0.001, maximum=10, subbuckets=4)
+        for value in (0.0001, 0.003, 0.0031, 0.5, 1000):
+            histogram.record(value)
+        self.assertEqual(histogram.count, 5)
+        buckets = histogram.buckets()
+        self.assertEqual([count for bound, count in buckets], [1, 3, 4, 5])
+        self.assertEqual(buckets[0][0], 0.001)
+        self.assertEqual(buckets[-1][0], float('inf'))
+        # log-linear: each bucket is at most 1/4 of its magnitude wide
+        bound = buckets[1][0]
+        assert 0.0031 <= bound <= 0.0031 * 1.25, bound
+        bound = buckets[2][0]
+        assert 0.5 <= bound <= 0.5 * 1.25, bound
+        buckets = histogram.buckets(empty=True)
+        self.assertEqual(len(buckets), len(histogram.counts))
+        self.assertEqual(buckets[-1], (float('inf'), 5))
+        self.assertEqual([bound for bound, count in buckets], sorted(bound for bound, count in buckets))
+
+    def test_percentile(self):
+        histogram = LatencyHistogram()
+        self.assertEqual(histogram.percentile(0.5), None)
+        for index in range(100):
+            histogram.record(0.001 * (index + 1))
+        assert 0.05 <= histogram.percentile(0.5) <= 0.05 * 1.25, histogram.percentile(0.5)
+        assert 0.099 <= histogram.percentile(0.99) <= 0.1 * 1.25, histogram.percentile(0.99)
+
+
+class TestHeadersRaw(greentest.BaseTestCase):
+
+    def make_headers(self, data):
+        return Headers(io.StringIO(data.replace('\n', '\r\n')))
+
+    def test_fields(self):
+        headers = self.make_headers('Host: localhost\nX-Forwarded-For:  1.2.3.4 \nContent-Type: text/plain\n\nbody')
+        self.assertEqual(headers.status, '')
+        self.assertEqual(headers.fields, [('HTTP_HOST', 'localhost'),
+                                          ('HTTP_X_FORWARDED_FOR', '1.2.3.4'),
+                                          ('CONTENT_TYPE', 'text/plain')])
+        self.assertEqual(headers.typeheader, 'text/plain')
+        self.assertEqual(headers.get('x-forwarded-for'), '1.2.3.4')
+        self.assertEqual(headers['HOST'], 'localhost')
+        self.assertEqual(len(headers.headers), 3)
+        # the body is left in the file
+        self.assertEqual(headers.fp.read(), 'body')
+
+    def test_continuation(self):
+        headers = self.make_headers('Content-Type: multipart/related;\n type="text/xml"\n\n')
+        self.assertEqual(headers.getheader('content-type'), 'multipart/related; type="text/xml"')
+        self.assertEqual(headers.fields, [('CONTENT_TYPE', 'multipart/related; type="text/xml"')])
+
+    def test_repeated(self):
+        headers = self.make_headers('Cookie: a=1\nCookie: b=2\n\n')
+        self.assertEqual(headers.getheaders('Cookie'), ['a=1', 'b=2'])
+        self.assertEqual(headers.get('cookie'), 'b=2')
+
+    def test_underscore(self):
+        headers = self.make_headers('X-Real-IP: 1.2.3.4\nX_Real_IP: 6.6.6.6\n folded\nHost: localhost\n\n')
+        self.assertEqual(headers.status, '')
+        self.assertEqual(headers.fields, [('HTTP_X_REAL_IP', '1.2.3.4'), ('HTTP_HOST', 'localhost')])
+        self.assertEqual(headers.get('x_real_ip'), None)
+        self.assertEqual(headers.getheaders('X-Real-IP'), ['1.2.3.4'])
+        self.assertEqual(headers.getheaders('X_Real_IP'), [])
+        self.assertEqual(len(headers.headers), 4)
+
+    def test_del(self):
+        headers = self.make_headers('Content-Length: 5\nTransfer-Encoding: chunked\n\n')
+        del headers['content-length']
+        self.assertEqual(headers.getheader('content-length'), None)
+        self.assertEqual(headers.fields, [('HTTP_TRANSFER_ENCODING', 'chunked')])
+        self.assertEqual(headers.headers, ['Transfer-Encoding: chunked\r\n'])
+        self.assertRaises(KeyError, headers.__delitem__, 'content-length')
+
+    def test_invalid(self):
+        self.assertEqual(self.make_headers('Host: localhost\nbad line\n\n').status,
+                         'Non-header line where header expected')
+        self.assertEqual(self.make_headers(' folded\n\n').status, 'Non-header line where header expected')
+        self.assertEqual(self.make_headers('Host: localhost\n').status, 'EOF in headers')
+
+    def test_too_long(self):
+        self.assertRaises(ValueError, self.make_headers, 'Hello: %s\n\n' % ('x' * 10000))
+
+
+class TestHeaderTooLong(TestCase):
+
+    @staticmethod
+    def application(env, start_response):
+        raise AssertionError('should not get there')
+
+    def test(self):
+        fd = self.makefile()
+        fd.write('GET / HTTP/1.0\r\nHello: %s\r\n\r\n' % ('x' * 20000))
+        read_http(fd, code=400)
+
 
 class Test414(TestCase):
 
@@ -1232,6 +2171,53 @@ class Test414(TestCase):
         read_http(fd, code=414)
 
 
+class TestGracefulStop(TestCase):
+
+    def application(self, env, start_response):
+        if env['PATH_INFO'] == '/slow':
+            gevent.sleep(0.2)
+        elif env['PATH_INFO'] == '/hang':
+            try:
+                gevent.sleep(10)
+            except gevent.GreenletExit:
+                self.killed.append(env['PATH_INFO'])
+                raise
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['hello']
+
+    def test(self):
+        idle = self.makefile()
+        idle.write('GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        read_http(idle, body='hello')
+        active = self.makefile()
+        active.write('GET /slow HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        gevent.sleep(0.05)
+        self.assertEqual(len(self.server.handlers), 2)
+        start = time.time()
+        stopper = gevent.spawn(self.server.stop, timeout=5)
+        gevent.sleep(0.01)
+        # the idle keep-alive connection is closed right away
+        self.assertEqual(idle.readline(), '')
+        response = read_http(active, body='hello')
+        response.assertHeader('Connection', 'close')
+        stopper.get()
+        assert time.time() - start < 1, time.time() - start
+        self.assertEqual(len(self.server.handlers), 0)
+
+    def test_timeout(self):
+        # the server has no pool: the handlers still running after the timeout are killed by stop() itself
+        assert self.server.pool is None, self.server.pool
+        self.killed = []
+        hanging = self.makefile()
+        hanging.write('GET /hang HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        gevent.sleep(0.05)
+        start = time.time()
+        self.server.stop(timeout=0.1)
+        assert time.time() - start < 1, time.time() - start
+        self.assertEqual(self.killed, ['/hang'])
+        self.assertEqual(len(self.server.handlers), 0)
+
+
 del CommonTests
 
 if __name__ == '__main__':
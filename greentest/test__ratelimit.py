@@ -0,0 +1,122 @@
+from time import time
+import greentest
+import gevent
+from gevent.pool import Pool
+from gevent.ratelimit import TokenBucket, Limiter
+
+
+class TestTokenBucket(greentest.TestCase):
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(100, 5)
+        start = time()
+        for _ in range(5):
+            assert bucket.acquire(blocking=False)
+        assert not bucket.acquire(blocking=False)
+        for _ in range(5):
+            bucket.acquire()
+        delta = time() - start
+        assert 0.04 <= delta < 0.2, delta
+
+    def test_fifo(self):
+        bucket = TokenBucket(100, 2)
+        bucket.acquire(2)
+        order = []
+
+        def take(name, tokens):
+            bucket.acquire(tokens)
+            order.append(name)
+
+        big = gevent.spawn(take, 'big', 2)
+        gevent.sleep(0)
+        small = gevent.spawn(take, 'small', 1)
+        gevent.sleep(0)
+        # the small request does not overtake the big one that came first
+        self.assertEqual(bucket.acquire(blocking=False), False)
+        gevent.joinall([big, small])
+        self.assertEqual(order, ['big', 'small'])
+
+    def test_timeout(self):
+        bucket = TokenBucket(1)
+        bucket.acquire()
+        start = time()
+        result = bucket.acquire(timeout=0.05)
+        assert result is False, repr(result)
+        assert time() - start < 0.5
+        # the expired waiter left the queue
+        assert not bucket._waiters, bucket._waiters
+
+    def test_killed_waiter(self):
+        bucket = TokenBucket(20, 1)
+        bucket.acquire()
+        g = gevent.spawn(bucket.acquire)
+        gevent.sleep(0)
+        g.kill()
+        assert not bucket._waiters, bucket._waiters
+        with gevent.Timeout(1):
+            bucket.acquire()
+
+    def test_killed_granted_waiter(self):
+        bucket = TokenBucket(20, 2)
+        bucket.acquire(2)
+        granted = []
+
+        def first():
+            bucket.acquire()
+            granted.append(True)
+            # the second waiter has got its token from the same timer but has not run yet
+            second.throw()
+
+        first = gevent.spawn(first)
+        second = gevent.spawn(bucket.acquire)
+        gevent.sleep(0)
+        # block the loop until both tokens are back, so that the timer grants both waiters at once
+        end = time() + 0.15
+        while time() < end:
+            pass
+        gevent.sleep(0.001)
+        self.assertEqual(granted, [True])
+        assert second.dead, second
+        # the token of the killed waiter is not lost
+        assert bucket.tokens >= 1, bucket.tokens
+        first.kill()
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, TokenBucket, 0)
+        self.assertRaises(ValueError, TokenBucket(10, 2).acquire, 3)
+
+
+class TestLimiter(greentest.TestCase):
+
+    def test_concurrency(self):
+        limiter = Limiter(concurrency=2)
+        running = []
+        peak = []
+
+        def work():
+            running.append(1)
+            peak.append(len(running))
+            gevent.sleep(0.01)
+            running.pop()
+
+        pool = Pool()
+        for _ in range(6):
+            limiter.spawn(pool.spawn, work)
+        pool.join()
+        self.assertEqual(max(peak), 2)
+        assert limiter.acquire(blocking=False)
+        assert limiter.acquire(blocking=False)
+        assert not limiter.acquire(blocking=False)
+
+    def test_rate_and_timeout(self):
+        limiter = Limiter(rate=10, burst=1)
+        with limiter:
+            pass
+        result = limiter.acquire(timeout=0.01)
+        assert result is False, repr(result)
+        with gevent.Timeout(1):
+            assert limiter.acquire()
+
+
+if __name__ == '__main__':
+    greentest.main()
@@ -61,6 +61,17 @@ class Settings:
     def assertPoolFull(self):
         self.assertRaises(socket.timeout, self.assertRequestSucceeded, timeout=0.01)
 
+    @staticmethod
+    def assertRejected(self, conn):
+        try:
+            result = conn.read()
+        except socket.error:
+            ex = sys.exc_info()[1]
+            if ex.args[0] != errno.ECONNRESET:
+                raise
+        else:
+            assert not result, repr(result)
+
 
 class TestCase(greentest.TestCase):
 
@@ -111,6 +122,9 @@ class TestCase(greentest.TestCase):
     def assertPoolFull(self):
         Settings.assertPoolFull(self)
 
+    def assertRejected(self, conn):
+        Settings.assertRejected(self, conn)
+
     def assertNotAccepted(self):
         conn = self.makefile()
         conn.write('GET / HTTP/1.0\r\n\r\n')
@@ -297,6 +311,82 @@ class TestDefaultSpawn(TestCase):
         assert self.server.started
 
 
+class TestListenerOptions(TestCase):
+
+    def get_spawn(self):
+        return gevent.spawn
+
+    def test_options(self):
+        options = {'reuse_port': 1, 'rcvbuf': 65536, 'sndbuf': 65536, 'nodelay': True}
+        if sys.platform.startswith('linux'):
+            options['defer_accept'] = 1
+        self.server = self.ServerSubClass(('127.0.0.1', 0), listener_options=options)
+        self.server.start()
+        sock = self.server.socket
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) >= 65536
+        if sys.platform.startswith('linux'):
+            from gevent.server import SO_REUSEPORT
+            self.assertEqual(sock.getsockopt(socket.SOL_SOCKET, SO_REUSEPORT), 1)
+            assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_DEFER_ACCEPT) > 0
+        self.assertRequestSucceeded()
+
+    def test_get_listener(self):
+        self.switch_expected = False
+
+        class Server(StreamServer):
+            rcvbuf = 65536
+
+        sock = Server.get_listener(('127.0.0.1', 0))
+        try:
+            assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) >= 65536
+        finally:
+            sock.close()
+
+    def test_get_listener_override(self):
+        created = []
+
+        class Server(Settings.ServerSubClass):
+
+            @classmethod
+            def get_listener(cls, address, backlog=None, family=None):
+                sock = StreamServer.get_listener(address, backlog, family)
+                created.append(sock)
+                return sock
+
+        self.server = Server(('127.0.0.1', 0), spawn=self.get_spawn())
+        self.server.start()
+        self.assertEqual(created, [self.server.socket])
+        self.assertRequestSucceeded()
+
+    if hasattr(socket, 'AF_UNIX'):
+
+        def test_nodelay_unix(self):
+            path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test__server.sock')
+            if os.path.exists(path):
+                os.unlink(path)
+            listener = socket.socket(socket.AF_UNIX)
+            listener.bind(path)
+            listener.listen(5)
+            try:
+                self.server = self.ServerSubClass(listener, listener_options={'nodelay': True})
+                self.server.start()
+                sock = socket.socket(socket.AF_UNIX)
+                sock.connect(path)
+                sock.sendall('GET /ping HTTP/1.0\r\n\r\n')
+                assert sock.makefile().read().endswith('PONG')
+                sock.close()
+            finally:
+                os.unlink(path)
+
+    def test_unknown_option(self):
+        self.switch_expected = False
+        self.assertRaises(TypeError, self.ServerClass, ('127.0.0.1', 0), handle=False, listener_options={'nodelya': True})
+
+    def test_listener_option_is_not_accepted_for_socket(self):
+        self.switch_expected = False
+        self.assertRaises(TypeError, self.ServerClass, self.get_listener(), handle=False, listener_options={'reuse_port': 1})
+
+
 class TestRawSpawn(TestDefaultSpawn):
 
     def get_spawn(self):
@@ -326,6 +416,79 @@ class TestPoolSpawn(TestDefaultSpawn):
     test_pool_full.error_fatal = False
 
 
+class TestDeferredSpawn(TestPoolSpawn):
+
+    def ServerClass(self, *args, **kwargs):
+        server = TestPoolSpawn.ServerClass(self, *args, **kwargs)
+        server.defer_spawn = True
+        server.adaptive_accept = True
+        return server
+
+    def ServerSubClass(self, *args, **kwargs):
+        server = TestPoolSpawn.ServerSubClass(self, *args, **kwargs)
+        server.defer_spawn = True
+        server.adaptive_accept = True
+        return server
+
+    def test_adjust_accept_batch(self):
+        self.switch_expected = False
+        self.server = self.ServerSubClass(('127.0.0.1', 0))
+        self.server.max_accept = 8
+        self.server.loop_lag = lambda: 0
+        self.server._adjust_accept_batch(2, 2)
+        self.assertEqual(self.server.accept_batch, 4)
+        self.server._adjust_accept_batch(8, 8)
+        self.assertEqual(self.server.accept_batch, 8)
+        self.server._adjust_accept_batch(8, 3)
+        self.assertEqual(self.server.accept_batch, 8)
+        self.server.loop_lag = lambda: 1
+        self.server._adjust_accept_batch(8, 8)
+        self.assertEqual(self.server.accept_batch, 4)
+        self.server._adjust_accept_batch(1, 1)
+        self.assertEqual(self.server.accept_batch, 1)
+
+
+class TestAdmissionQueue(TestCase):
+
+    def get_spawn(self):
+        return 2
+
+    def init_server(self, max_queue, max_queue_wait=1):
+        self.server = self.ServerSubClass(('127.0.0.1', 0))
+        self.server.max_queue = max_queue
+        self.server.max_queue_wait = max_queue_wait
+        self.server.start()
+        self.long_requests = [self.send_request('/long'), self.send_request('/long')]
+        gevent.sleep(0.01)
+        assert self.server.full()
+
+    def test_admitted_when_slot_is_free(self):
+        self.init_server(max_queue=5)
+        conn = self.send_request('/ping', timeout=2)
+        gevent.sleep(0.01)
+        self.assertEqual(len(self.server._queue), 1)
+        list(self.server.pool)[0].kill()
+        result = conn.read()
+        assert result.endswith('PONG'), repr(result)
+
+    def test_queue_overflow(self):
+        self.init_server(max_queue=1)
+        queued = self.send_request('/ping', timeout=2)
+        rejected = self.send_request('/ping', timeout=2)
+        self.assertRejected(rejected)
+        self.assertEqual(len(self.server._queue), 1)
+        # the connection that fit in the queue is still served once a slot frees up
+        list(self.server.pool)[0].kill()
+        result = queued.read()
+        assert result.endswith('PONG'), repr(result)
+
+    def test_queue_wait_expired(self):
+        self.init_server(max_queue=5, max_queue_wait=0.1)
+        conn = self.send_request('/ping', timeout=2)
+        self.assertRejected(conn)
+        self.assertEqual(len(self.server._queue), 0)
+
+
 class TestNoneSpawn(TestCase):
 
     def get_spawn(self):
@@ -58,6 +58,11 @@ class Settings:
 
     assertAcceptedConnectionError = assert500
 
+    @staticmethod
+    def assertRejected(self, conn):
+        result = conn.read()
+        assert result.startswith('HTTP/1.1 503 Service Unavailable\r\n'), repr(result)
+
     @staticmethod
     def assert503(self):
         conn = self.makefile()
@@ -183,5 +183,66 @@ class TestCreateConnection(greentest.TestCase):
             raise AssertionError('create_connection did not raise socket.error as expected')
 
 
+class TestHappyEyeballs(greentest.TestCase):
+
+    __timeout__ = 5
+
+    def setUp(self):
+        greentest.TestCase.setUp(self)
+        import gevent.socket
+        self.listener = socket.socket()
+        greentest.bind_and_listen(self.listener, ('127.0.0.1', 0))
+        self.port = self.listener.getsockname()[1]
+        self._getaddrinfo = gevent.socket.getaddrinfo
+
+    def cleanup(self):
+        import gevent.socket
+        gevent.socket.getaddrinfo = self._getaddrinfo
+        self.listener.close()
+
+    def set_addresses(self, *addresses):
+        import gevent.socket
+
+        def getaddrinfo(host, *args):
+            if host == 'example.com':
+                return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', address) for address in addresses]
+            return self._getaddrinfo(host, *args)
+
+        gevent.socket.getaddrinfo = getaddrinfo
+
+    def test_unreachable_first(self):
+        # 192.0.2.1 belongs to TEST-NET-1: connecting to it either hangs or fails
+        self.set_addresses(('192.0.2.1', self.port), ('127.0.0.1', self.port))
+        start = time.time()
+        sock = socket.create_connection(('example.com', self.port), timeout=3, happy_eyeballs_delay=0.1)
+        try:
+            self.assertEqual(sock.getpeername(), ('127.0.0.1', self.port))
+            self.assertTrue(time.time() - start < 1, time.time() - start)
+        finally:
+            sock.close()
+
+    def test_all_refused(self):
+        self.set_addresses(('127.0.0.1', get_port()), ('127.0.0.1', get_port()))
+        try:
+            socket.create_connection(('example.com', 80), timeout=3, happy_eyeballs_delay=0.1)
+        except socket.error:
+            ex = sys.exc_info()[1]
+            if 'refused' not in str(ex).lower():
+                raise
+        else:
+            raise AssertionError('create_connection did not raise socket.error as expected')
+
+    def test_unexpected_error(self):
+        # an error other than socket.error is raised rather than leaving create_connection waiting
+        self.set_addresses('not an address', 'not an address either')
+        self.assertRaises(TypeError, socket.create_connection, ('example.com', 80),
+                          timeout=3, happy_eyeballs_delay=0.1)
+
+    def test_interleave(self):
+        from gevent.socket import _interleave_addrinfo
+        addrinfo = [(socket.AF_INET6, 1), (socket.AF_INET6, 2), (socket.AF_INET6, 3), (socket.AF_INET, 4)]
+        self.assertEqual([x[1] for x in _interleave_addrinfo(addrinfo)], [1, 4, 2, 3])
+
+
 if __name__ == '__main__':
     greentest.main()
@@ -134,6 +134,20 @@ class TestPool(TestCase):
             self.assertEqual(six.advance_iterator(it), i * i)
         self.assertRaises(StopIteration, lambda: six.advance_iterator(it))
 
+    def test_map_chunksize(self):
+        calls = []
+
+        def record(x):
+            calls.append(x)
+            return x * x
+
+        for chunksize in (1, 3, 7, 1000):
+            self.assertEqual(self.pool.map(record, range(100), chunksize=chunksize), [x * x for x in range(100)])
+        self.assertEqual(len(calls), 400)
+        self.assertEqual(self.pool.map(record, [], chunksize=10), [])
+        self.assertEqual(sorted(self.pool.imap_unordered(record, range(50), chunksize=4)), [x * x for x in range(50)])
+        self.assertRaises(ValueError, self.pool.map, record, range(10), chunksize=0)
+
     def test_imap_random(self):
         it = self.pool.imap(sqr_random_sleep, list(range(10)))
         self.assertEqual(list(it), list(map(sqr, list(range(10)))))
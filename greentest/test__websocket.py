@@ -0,0 +1,185 @@
+import os
+import struct
+import greentest
+import gevent
+from gevent import websocket
+from test__pywsgi import TestCase, read_headers, read_http
+
+
+KEY = 'dGhlIHNhbXBsZSBub25jZQ=='
+HANDSHAKE = ('GET /chat HTTP/1.1\r\n'
+             'Host: localhost\r\n'
+             'Upgrade: websocket\r\n'
+             'Connection: keep-alive, Upgrade\r\n'
+             'Sec-WebSocket-Key: %s\r\n'
+             'Sec-WebSocket-Version: 13\r\n'
+             '%s'
+             '\r\n')
+
+
+def frame(payload, opcode=websocket.OPCODE_TEXT, fin=True, masked=True):
+    first = opcode
+    if fin:
+        first |= 0x80
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', first, length | (0x80 if masked else 0))
+    else:
+        header = struct.pack('!BBH', first, 126 | (0x80 if masked else 0), length)
+    if not masked:
+        return header + payload
+    key = os.urandom(4)
+    return header + key + websocket.mask(payload, key)
+
+
+def read_frame(fd):
+    first, second = struct.unpack('!BB', fd.read(2))
+    assert not second & 0x80, 'Server frames must not be masked'
+    length = second & 0x7F
+    if length == 126:
+        length = struct.unpack('!H', fd.read(2))[0]
+    elif length == 127:
+        length = struct.unpack('!Q', fd.read(8))[0]
+    return bool(first & 0x80), first & 0x0F, fd.read(length)
+
+
+class TestMask(greentest.TestCase):
+
+    def test_roundtrip(self):
+        key = '\x01\x82\xff\x00'
+        for size in (0, 1, 3, 4, 5, 127, 4096):
+            data = os.urandom(size)
+            masked = websocket.mask(data, key)
+            self.assertEqual(len(masked), size)
+            self.assertEqual(websocket.mask(masked, key), data)
+
+    def test_bytewise(self):
+        key = '\x01\x82\xff\x00'
+        for size in range(1, 10):
+            data = os.urandom(size)
+            expected = ''.join([chr(ord(byte) ^ ord(key[index % 4])) for index, byte in enumerate(data)])
+            self.assertEqual(websocket.mask(data, key), expected)
+
+    def test_known(self):
+        self.assertEqual(websocket.mask('\x00\x00\x00\x00\xff', '\x01\x02\x03\x04'), '\x01\x02\x03\x04\xfe')
+
+    def test_accept_key(self):
+        # the example from RFC 6455
+        self.assertEqual(websocket.accept_key(KEY), 's3pPLMBiTxaQ9kYGzzhZRbK+xOo=')
+
+
+class TestEcho(TestCase):
+
+    validator = None
+
+    def application(self, env, start_response):
+        ws = env.get('wsgi.websocket')
+        if ws is None:
+            start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+            return ['WebSocket expected']
+        if 'echo' in ws.protocols:
+            ws.accept('echo')
+        while True:
+            message = ws.receive()
+            if message is None:
+                break
+            ws.send(message)
+        self.close_code = ws.close_code
+        return ['ignored']
+
+    def handshake(self, extra=''):
+        fd = self.makefile()
+        fd.write(HANDSHAKE % (KEY, extra))
+        response_line, headers = read_headers(fd)
+        self.assertEqual(response_line, 'HTTP/1.1 101 Switching Protocols\r\n')
+        self.assertEqual(headers['Sec-WebSocket-Accept'], 's3pPLMBiTxaQ9kYGzzhZRbK+xOo=')
+        self.assertEqual(headers['Upgrade'], 'websocket')
+        return fd, headers
+
+    def test_echo(self):
+        fd, headers = self.handshake()
+        assert 'Sec-WebSocket-Protocol' not in headers, headers
+        fd.write(frame('hello'))
+        fd.flush()
+        self.assertEqual(read_frame(fd), (True, websocket.OPCODE_TEXT, 'hello'))
+        data = os.urandom(70000)
+        fd.write(frame(data[:1000], websocket.OPCODE_BINARY))
+        fd.flush()
+        self.assertEqual(read_frame(fd), (True, websocket.OPCODE_BINARY, data[:1000]))
+        fd.write(frame(u'\u0444'.encode('utf-8') * 100))
+        fd.flush()
+        self.assertEqual(read_frame(fd), (True, websocket.OPCODE_TEXT, u'\u0444'.encode('utf-8') * 100))
+        fd.write(frame(struct.pack('!H', 1000), websocket.OPCODE_CLOSE))
+        fd.flush()
+        self.assertEqual(read_frame(fd), (True, websocket.OPCODE_CLOSE, struct.pack('!H', 1000)))
+        self.assertEqual(fd.read(), '')
+        self.assertEqual(self.close_code, 1000)
+
+    def test_fragments_and_ping(self):
+        fd, headers = self.handshake('Sec-WebSocket-Protocol: chat, echo\r\n')
+        self.assertEqual(headers['Sec-WebSocket-Protocol'], 'echo')
+        fd.write(frame('hel', fin=False))
+        fd.write(frame('ping!', websocket.OPCODE_PING))
+        fd.write(frame('lo ', websocket.OPCODE_CONTINUATION, fin=False))
+        fd.write(frame('world', websocket.OPCODE_CONTINUATION))
+        fd.flush()
+        self.assertEqual(read_frame(fd), (True, websocket.OPCODE_PONG, 'ping!'))
+        self.assertEqual(read_frame(fd), (True, websocket.OPCODE_TEXT, 'hello world'))
+        fd.close()
+
+    def test_unmasked(self):
+        fd, headers = self.handshake()
+        fd.write(frame('hello', masked=False))
+        fd.flush()
+        fin, opcode, payload = read_frame(fd)
+        self.assertEqual(opcode, websocket.OPCODE_CLOSE)
+        self.assertEqual(struct.unpack('!H', payload[:2])[0], 1002)
+        self.assertEqual(fd.read(), '')
+        self.assertEqual(self.close_code, 1002)
+
+    def test_invalid_utf8(self):
+        fd, headers = self.handshake()
+        fd.write(frame('\xff\xfe'))
+        fd.flush()
+        fin, opcode, payload = read_frame(fd)
+        self.assertEqual(opcode, websocket.OPCODE_CLOSE)
+        self.assertEqual(struct.unpack('!H', payload[:2])[0], 1007)
+
+    def test_not_upgrade(self):
+        fd = self.makefile()
+        fd.write('GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        read_http(fd, code=400, body='WebSocket expected')
+        # a bad version is not an upgrade request
+        fd.write(HANDSHAKE.replace('Version: 13', 'Version: 8') % (KEY, ''))
+        read_http(fd, code=400, body='WebSocket expected')
+        # nor is an upgrade to another protocol
+        fd.write(HANDSHAKE.replace('Upgrade: websocket', 'Upgrade: h2c') % (KEY, ''))
+        read_http(fd, code=400, body='WebSocket expected')
+
+
+class TestServerSend(TestCase):
+
+    validator = None
+
+    def application(self, env, start_response):
+        ws = env['wsgi.websocket']
+        ws.send_fragments(['a' * 10, u'b', 'c' * 20000])
+        ws.send('x' * 70000)
+        gevent.sleep(0.01)
+        ws.close(1001, 'going away')
+        return []
+
+    def test_send(self):
+        fd = self.makefile()
+        fd.write(HANDSHAKE % (KEY, ''))
+        read_headers(fd)
+        self.assertEqual(read_frame(fd), (False, websocket.OPCODE_TEXT, 'a' * 10))
+        self.assertEqual(read_frame(fd), (False, websocket.OPCODE_CONTINUATION, 'b'))
+        self.assertEqual(read_frame(fd), (True, websocket.OPCODE_CONTINUATION, 'c' * 20000))
+        self.assertEqual(read_frame(fd), (True, websocket.OPCODE_BINARY, 'x' * 70000))
+        self.assertEqual(read_frame(fd), (True, websocket.OPCODE_CLOSE, struct.pack('!H', 1001) + 'going away'))
+        self.assertEqual(fd.read(), '')
+
+
+if __name__ == '__main__':
+    greentest.main()